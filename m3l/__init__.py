@@ -1,3 +1,6 @@
 from m3l.core.m3l_functions import *
 from m3l.core.m3l_classes import *
-# from m3l.core.m3l_standard_operations import * 
\ No newline at end of file
+from m3l.core.in_line_evaluation import set_in_line_evaluation_backend, set_lazy_evaluation
+from m3l.core.model_cache import set_model_cache, clear_model_cache
+from m3l.core.evaluation_map_cache import set_evaluation_map_cache, clear_evaluation_map_cache
+# from m3l.core.m3l_standard_operations import * 
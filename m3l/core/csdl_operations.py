@@ -1,12 +1,23 @@
 import csdl
 # import csdl_om
 import numpy as np
+import scipy.linalg
+import scipy.sparse as sps
+import scipy.sparse.linalg as spla
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 class Eig(csdl.Model):
-
+    '''
+    Computes the eigenvalues of a matrix A (all of them, or only the num_eigenvalues eigenvalues closest to sigma).
+    '''
     def initialize(self):
         # size and value of A
         self.parameters.declare('size')
+        self.parameters.declare('num_eigenvalues', default=None, allow_none=True)
+        self.parameters.declare('sigma', default=None, allow_none=True)
+        self.parameters.declare('symmetric', types=bool, default=False)
+        self.parameters.declare('sparsity_pattern', default=None, allow_none=True)
 
     def define(self):
         # size and value of A
@@ -17,65 +28,999 @@ class Eig(csdl.Model):
         A = self.create_input('A', shape=(size,size))
 
         # custom operation insertion
-        e_r, e_i = csdl.custom(A, op=EigExplicit(size=size))
+        e_r, e_i = csdl.custom(A, op=EigExplicit(size=size, num_eigenvalues=self.parameters['num_eigenvalues'],
+                                                 sigma=self.parameters['sigma'], symmetric=self.parameters['symmetric'],
+                                                 sparsity_pattern=self.parameters['sparsity_pattern']))
 
         # eigenvalues as output
         self.register_output('e_real', e_r)
         self.register_output('e_imag', e_i)
 
 
+def compute_eigenpairs(matrix, num_eigenvalues:int=None, sigma:float=None, symmetric:bool=False) -> tuple:
+    '''
+    Computes the eigenvalues and the right and left eigenvectors of a (dense or sparse) matrix. If num_eigenvalues is
+    given, only the eigenvalues closest to sigma are computed with shift-invert Lanczos (symmetric) or Arnoldi iterations.
+
+    Parameters
+    ----------
+    matrix : np.ndarray or sps.spmatrix
+        The (n,n) matrix A.
+    num_eigenvalues : int, optional
+        The number of eigenvalues k that are computed. By default, all of the eigenvalues are computed densely.
+    sigma : float, optional, default: 0.
+        The shift that the computed eigenvalues are closest to (only used if num_eigenvalues is given).
+    symmetric : bool, optional, default: False
+        If True, the matrix is assumed to be symmetric, so the left and right eigenvectors are the same.
+
+    Returns
+    -------
+    eigenvalues : np.ndarray
+        The (k,) eigenvalues, sorted by their distance to sigma if num_eigenvalues is given.
+    right_eigenvectors : np.ndarray
+        The (n,k) right eigenvectors v (A v = w v).
+    left_eigenvectors : np.ndarray
+        The (n,k) left eigenvectors u (u^T A = w u^T), scaled such that u^T v = 1.
+    '''
+    size = matrix.shape[0]
+    if sigma is None:
+        sigma = 0.
+
+    # The iterative solvers need k < n - 1, so small or full spectra are computed densely
+    if num_eigenvalues is None or num_eigenvalues >= size - 1:
+        dense_matrix = matrix.toarray() if sps.issparse(matrix) else np.asarray(matrix)
+        if symmetric:
+            eigenvalues, right_eigenvectors = np.linalg.eigh(dense_matrix)
+            left_eigenvectors = right_eigenvectors
+        else:
+            eigenvalues, right_eigenvectors = np.linalg.eig(dense_matrix)
+            left_eigenvectors = np.linalg.inv(right_eigenvectors).T
+        if num_eigenvalues is None:
+            return eigenvalues, right_eigenvectors, left_eigenvectors
+    else:
+        sparse_matrix = sps.csc_matrix(matrix)
+        if symmetric:
+            eigenvalues, right_eigenvectors = spla.eigsh(sparse_matrix, k=num_eigenvalues, sigma=sigma, which='LM')
+            left_eigenvectors = right_eigenvectors
+        else:
+            # A real matrix has complex conjugate pairs of eigenvalues, so one more eigenvalue is computed than is
+            # returned so that the computed eigenvalues never end with half of a pair
+            num_computed = num_eigenvalues
+            if not np.iscomplexobj(sparse_matrix) and num_eigenvalues + 1 < size - 1:
+                num_computed = num_eigenvalues + 1
+            eigenvalues, right_eigenvectors = spla.eigs(sparse_matrix, k=num_computed, sigma=sigma, which='LM')
+            left_eigenvalues, left_eigenvectors = spla.eigs(sparse_matrix.T.tocsc(), k=num_computed, sigma=sigma,
+                                                            which='LM')
+            if not np.iscomplexobj(sparse_matrix):
+                # The left eigenvector of conj(w) of a real matrix is the conjugate of the left eigenvector of w, so the
+                # left iterations may have found either half of a pair
+                left_eigenvalues = np.concatenate((left_eigenvalues, np.conj(left_eigenvalues)))
+                left_eigenvectors = np.hstack((left_eigenvectors, np.conj(left_eigenvectors)))
+            # Pairs each eigenvalue with the left eigenvector of the closest left eigenvalue
+            left_indices = np.argmin(np.abs(eigenvalues[:,None] - left_eigenvalues[None,:]), axis=1)
+            left_eigenvectors = normalize_left_eigenvectors(left_eigenvectors[:,left_indices], right_eigenvectors)
+
+    order = np.lexsort((np.imag(eigenvalues), np.real(eigenvalues), np.abs(eigenvalues - sigma)))[:num_eigenvalues]
+    return eigenvalues[order], right_eigenvectors[:,order], left_eigenvectors[:,order]
+
+
+def normalize_left_eigenvectors(left_eigenvectors:np.ndarray, right_eigenvectors:np.ndarray) -> np.ndarray:
+    '''
+    Scales the (n,k) left eigenvectors u such that u^T v = 1 for the (n,k) right eigenvectors v. Raises an error if
+    u^T v is (nearly) zero, i.e., if a left eigenvector does not belong to its right eigenvector or the eigenvalue is
+    defective, since the eigenvalue derivatives are not defined then.
+    '''
+    products = np.sum(left_eigenvectors*right_eigenvectors, axis=0)
+    norms = np.linalg.norm(left_eigenvectors, axis=0)*np.linalg.norm(right_eigenvectors, axis=0)
+    if np.any(np.abs(products) <= 1e-8*norms):
+        raise ValueError('The left and right eigenvectors of an eigenvalue are (nearly) orthogonal, so the eigenvalue '
+                         'is defective or its left eigenvector was not found.')
+    return left_eigenvectors/products
+
+
+def compute_eigenvalue_derivatives(right_eigenvectors:np.ndarray, left_eigenvectors:np.ndarray,
+                                   sparsity_pattern:tuple=None) -> np.ndarray:
+    '''
+    Computes the derivatives dw_j/dA_lk = u_lj v_kj of the eigenvalues with respect to the entries of A (flattened in
+    row-major order) for all of the eigenvalues at once.
+
+    Parameters
+    ----------
+    right_eigenvectors : np.ndarray
+        The (n,k) right eigenvectors v.
+    left_eigenvectors : np.ndarray
+        The (n,k) left eigenvectors u, scaled such that u^T v = 1.
+    sparsity_pattern : tuple, optional
+        The (rows, cols) indices of the entries of A that the derivatives are computed with respect to. By default, the
+        derivatives are computed with respect to all of the entries.
+
+    Returns
+    -------
+    derivatives : np.ndarray
+        The (k,n*n) derivatives, or the (k,nnz) derivatives with respect to the entries of the sparsity pattern.
+    '''
+    if sparsity_pattern is None:
+        size, num_eigenvalues = right_eigenvectors.shape
+        return np.einsum('lj,kj->jlk', left_eigenvectors, right_eigenvectors).reshape((num_eigenvalues, size*size))
+    rows, cols = sparsity_pattern
+    return left_eigenvectors[rows,:].T*right_eigenvectors[cols,:].T
+
+
+def get_sparsity_pattern(sparsity_pattern) -> tuple:
+    '''
+    Returns the sorted (rows, cols) indices of the nonzero entries of a (dense or sparse) sparsity pattern.
+    '''
+    sparsity_pattern = sps.csr_matrix(sparsity_pattern, dtype=bool)
+    sparsity_pattern.sum_duplicates()
+    sparsity_pattern.sort_indices()
+    return sparsity_pattern.nonzero()
+
+
 class EigExplicit(csdl.CustomExplicitOperation):
+    '''
+    Computes the eigenvalues of a matrix A with analytic derivatives.
 
+    If num_eigenvalues is given, only the eigenvalues closest to sigma are computed (with sparse shift-invert
+    iterations). If a sparsity pattern of A is given, A is treated as a sparse matrix with that pattern and the
+    derivatives are only declared with respect to its nonzero entries. The eigendecomposition computed in compute() is
+    reused by compute_derivatives() for the same input.
+    '''
     def initialize(self):
         # size of A
         self.parameters.declare('size')
+        self.parameters.declare('num_eigenvalues', default=None, allow_none=True)
+        self.parameters.declare('sigma', default=None, allow_none=True)
+        self.parameters.declare('symmetric', types=bool, default=False)
+        self.parameters.declare('sparsity_pattern', default=None, allow_none=True)
 
     def define(self):
         # size of A
         size = self.parameters['size']
         shape = (size, size)
+        num_eigenvalues = self.parameters['num_eigenvalues']
+        if num_eigenvalues is None:
+            num_eigenvalues = size
+
+        self.eigenpairs_input = None
+        self.eigenpairs = None
+        self.sparsity_pattern = None
+        if self.parameters['sparsity_pattern'] is not None:
+            self.sparsity_pattern = get_sparsity_pattern(self.parameters['sparsity_pattern'])
 
         # Input: Matrix
         self.add_input('A', shape=shape)
 
         # Output: Eigenvalues
-        self.add_output('e_real', shape=size)
-        self.add_output('e_imag', shape=size)
+        self.add_output('e_real', shape=num_eigenvalues)
+        self.add_output('e_imag', shape=num_eigenvalues)
 
-        self.declare_derivatives('e_real', 'A')
-        self.declare_derivatives('e_imag', 'A')
+        if self.sparsity_pattern is None:
+            self.declare_derivatives('e_real', 'A')
+            self.declare_derivatives('e_imag', 'A')
+        else:
+            rows, cols = self.sparsity_pattern
+            derivative_rows = np.repeat(np.arange(num_eigenvalues), len(rows))
+            derivative_cols = np.tile(rows*size + cols, num_eigenvalues)
+            self.declare_derivatives('e_real', 'A', rows=derivative_rows, cols=derivative_cols)
+            self.declare_derivatives('e_imag', 'A', rows=derivative_rows, cols=derivative_cols)
+
+    def compute_eigenpairs(self, A:np.ndarray) -> tuple:
+        if self.eigenpairs_input is not None and np.array_equal(self.eigenpairs_input, A):
+            return self.eigenpairs
+
+        matrix = A
+        if self.sparsity_pattern is not None:
+            rows, cols = self.sparsity_pattern
+            matrix = sps.csr_matrix((A[rows, cols], (rows, cols)), shape=A.shape)
+
+        self.eigenpairs = compute_eigenpairs(matrix, num_eigenvalues=self.parameters['num_eigenvalues'],
+                                             sigma=self.parameters['sigma'], symmetric=self.parameters['symmetric'])
+        self.eigenpairs_input = np.array(A)
+        return self.eigenpairs
 
     def compute(self, inputs, outputs):
+        w, _, _ = self.compute_eigenpairs(inputs['A'])
+        outputs['e_real'] = np.real(w)
+        outputs['e_imag'] = np.imag(w)
+
+    def compute_derivatives(self, inputs, derivatives):
+        _, right_eigenvectors, left_eigenvectors = self.compute_eigenpairs(inputs['A'])
+        partials = compute_eigenvalue_derivatives(right_eigenvectors, left_eigenvectors,
+                                                  sparsity_pattern=self.sparsity_pattern)
+        if self.sparsity_pattern is None:
+            derivatives['e_real', 'A'] = np.real(partials)
+            derivatives['e_imag', 'A'] = np.imag(partials)
+        else:
+            derivatives['e_real', 'A'] = np.real(partials).flatten()
+            derivatives['e_imag', 'A'] = np.imag(partials).flatten()
+
+
+class BatchedEig(csdl.Model):
+    '''
+    Computes the eigenvalues of a stack of num_nodes matrices (e.g., the system matrices of a sweep over operating
+    points) with one batched eigen operation. The stacked (num_nodes, size, size) input is 'A', or, if input_names is
+    given, the matrices are declared as separate (size, size) inputs with those names and stacked in that order.
+    '''
+    def initialize(self):
+        self.parameters.declare('num_nodes', types=int)
+        self.parameters.declare('size', types=int)
+        self.parameters.declare('input_names', types=list, default=None, allow_none=True)
+        self.parameters.declare('num_workers', default=None, allow_none=True)
+
+    def define(self):
+        num_nodes = self.parameters['num_nodes']
+        size = self.parameters['size']
+        input_names = self.parameters['input_names']
+
+        if input_names is None:
+            A = self.create_input('A', shape=(num_nodes,size,size))
+        else:
+            A = self.create_output('A', shape=(num_nodes,size,size))
+            for i, input_name in enumerate(input_names):
+                A[i,:,:] = csdl.reshape(self.declare_variable(input_name, shape=(size,size)), new_shape=(1,size,size))
+
+        e_r, e_i = csdl.custom(A, op=BatchedEigExplicit(num_nodes=num_nodes, size=size,
+                                                        num_workers=self.parameters['num_workers']))
+
+        self.register_output('e_real', e_r)
+        self.register_output('e_imag', e_i)
+
+
+batched_eig_executors = {}     # num_workers -> ThreadPoolExecutor shared by all batched eigen operations
+batched_eig_executors_lock = threading.Lock()
+
+
+def get_batched_eig_executor(num_workers:int) -> ThreadPoolExecutor:
+    '''
+    Returns the thread pool with num_workers threads that is shared by all batched eigen operations, creating it the
+    first time it is needed. The pools are shut down when the interpreter exits.
+    '''
+    with batched_eig_executors_lock:
+        if num_workers not in batched_eig_executors:
+            batched_eig_executors[num_workers] = ThreadPoolExecutor(max_workers=num_workers)
+        return batched_eig_executors[num_workers]
+
+
+def compute_batched_eigenpairs(matrices:np.ndarray, executor=None, num_chunks:int=1) -> tuple:
+    '''
+    Computes the eigenvalues and the right and left eigenvectors of a stack of matrices with one vectorized call (per
+    chunk of the stack if an executor is given).
+
+    Parameters
+    ----------
+    matrices : np.ndarray
+        The (num_nodes, n, n) matrices.
+    executor : concurrent.futures.Executor, optional
+        The (reused) executor that the chunks are computed on. LAPACK releases the GIL, so a ThreadPoolExecutor is
+        sufficient. By default, the stack is computed in the calling thread.
+    num_chunks : int, optional, default: 1
+        The number of chunks the stack is split into.
+
+    Returns
+    -------
+    eigenvalues : np.ndarray
+        The (num_nodes, n) eigenvalues.
+    right_eigenvectors : np.ndarray
+        The (num_nodes, n, n) right eigenvectors (in the columns of each matrix).
+    left_eigenvectors : np.ndarray
+        The (num_nodes, n, n) left eigenvectors (in the columns of each matrix), scaled such that u^T v = 1.
+    '''
+    matrices = np.asarray(matrices)
+    if executor is None or num_chunks <= 1 or matrices.shape[0] <= 1:
+        eigenvalues, right_eigenvectors = np.linalg.eig(matrices)
+        return eigenvalues, right_eigenvectors, np.swapaxes(np.linalg.inv(right_eigenvectors), 1, 2)
 
-        # Numpy eigenvalues
-        w, v = np.linalg.eig(inputs['A'])
+    chunks = np.array_split(matrices, min(num_chunks, matrices.shape[0]))
+    results = list(executor.map(compute_batched_eigenpairs, chunks))
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def compute_batched_eigenvalue_derivatives(right_eigenvectors:np.ndarray, left_eigenvectors:np.ndarray) -> np.ndarray:
+    '''
+    Computes the derivatives dw_nj/dA_nlk = u_nlj v_nkj of the eigenvalues of a stack of matrices with respect to their
+    entries. The derivatives are block diagonal, so only the (num_nodes*n, n*n) nonzero blocks are returned.
+    '''
+    num_nodes, size, _ = right_eigenvectors.shape
+    return np.einsum('nlj,nkj->njlk', left_eigenvectors, right_eigenvectors).reshape((num_nodes*size, size*size))
+
+
+class BatchedEigExplicit(csdl.CustomExplicitOperation):
+    '''
+    Computes the eigenvalues of a stack of matrices with analytic block diagonal (sparse) derivatives. The
+    eigendecompositions computed in compute() are reused by compute_derivatives() for the same input. If num_workers is
+    given, the stack is split over a thread pool that is shared with the other batched eigen operations (see
+    get_batched_eig_executor).
+    '''
+    def initialize(self):
+        self.parameters.declare('num_nodes', types=int)
+        self.parameters.declare('size', types=int)
+        self.parameters.declare('num_workers', default=None, allow_none=True)
+
+    def define(self):
+        num_nodes = self.parameters['num_nodes']
+        size = self.parameters['size']
+
+        self.eigenpairs_input = None
+        self.eigenpairs = None
+
+        self.add_input('A', shape=(num_nodes, size, size))
+
+        self.add_output('e_real', shape=(num_nodes, size))
+        self.add_output('e_imag', shape=(num_nodes, size))
+
+        # Each eigenvalue only depends on the entries of its own matrix
+        rows = np.repeat(np.arange(num_nodes*size), size*size)
+        cols = (np.arange(num_nodes)[:,None,None]*size*size + np.zeros((1, size, 1), dtype=int)
+                + np.arange(size*size)[None,None,:]).flatten()
+        self.declare_derivatives('e_real', 'A', rows=rows, cols=cols)
+        self.declare_derivatives('e_imag', 'A', rows=rows, cols=cols)
+
+    def compute_eigenpairs(self, A:np.ndarray) -> tuple:
+        if self.eigenpairs_input is None or not np.array_equal(self.eigenpairs_input, A):
+            num_workers = self.parameters['num_workers']
+            executor = None
+            if num_workers is not None and num_workers > 1:
+                executor = get_batched_eig_executor(num_workers)
+            self.eigenpairs = compute_batched_eigenpairs(A, executor=executor,
+                                                         num_chunks=1 if num_workers is None else num_workers)
+            self.eigenpairs_input = np.array(A)
+        return self.eigenpairs
+
+    def compute(self, inputs, outputs):
+        w, _, _ = self.compute_eigenpairs(inputs['A'])
         outputs['e_real'] = np.real(w)
         outputs['e_imag'] = np.imag(w)
 
     def compute_derivatives(self, inputs, derivatives):
+        _, right_eigenvectors, left_eigenvectors = self.compute_eigenpairs(inputs['A'])
+        partials = compute_batched_eigenvalue_derivatives(right_eigenvectors, left_eigenvectors)
+        derivatives['e_real', 'A'] = np.real(partials).flatten()
+        derivatives['e_imag', 'A'] = np.imag(partials).flatten()
+
+
+class GeneralizedEig(csdl.Model):
+    '''
+    Computes the eigenvalues and the mass-normalized eigenvectors of the symmetric generalized eigenproblem K v = w M v
+    (all of them, or only the num_eigenvalues eigenvalues closest to sigma).
+    '''
+    def initialize(self):
+        self.parameters.declare('size')
+        self.parameters.declare('num_eigenvalues', default=None, allow_none=True)
+        self.parameters.declare('sigma', default=None, allow_none=True)
+        self.parameters.declare('sparsity_pattern', default=None, allow_none=True)
+
+    def define(self):
         size = self.parameters['size']
-        shape = (size, size)
 
-        # v are the eigenvectors in each columns
-        w, v = np.linalg.eig(inputs['A'])
+        K = self.create_input('K', shape=(size,size))
+        M = self.create_input('M', shape=(size,size))
+
+        eigenvalues, eigenvectors = csdl.custom(K, M, op=GeneralizedEigExplicit(
+            size=size, num_eigenvalues=self.parameters['num_eigenvalues'], sigma=self.parameters['sigma'],
+            sparsity_pattern=self.parameters['sparsity_pattern']))
+
+        self.register_output('eigenvalues', eigenvalues)
+        self.register_output('eigenvectors', eigenvectors)
+
+
+def compute_generalized_eigenpairs(stiffness_matrix, mass_matrix, num_eigenvalues:int=None, sigma:float=None) -> tuple:
+    '''
+    Computes the eigenvalues and the eigenvectors of the symmetric generalized eigenproblem K v = w M v. If
+    num_eigenvalues is given, only the eigenvalues closest to sigma are computed with shift-invert Lanczos iterations.
+
+    Parameters
+    ----------
+    stiffness_matrix : np.ndarray or sps.spmatrix
+        The symmetric (n,n) matrix K.
+    mass_matrix : np.ndarray or sps.spmatrix
+        The symmetric positive definite (n,n) matrix M.
+    num_eigenvalues : int, optional
+        The number of eigenvalues k that are computed. By default, all of the eigenvalues are computed densely.
+    sigma : float, optional, default: 0.
+        The shift that the computed eigenvalues are closest to (only used if num_eigenvalues is given).
+
+    Returns
+    -------
+    eigenvalues : np.ndarray
+        The (k,) eigenvalues in ascending order.
+    eigenvectors : np.ndarray
+        The (n,k) eigenvectors, scaled such that v^T M v = 1 and the entry of largest magnitude is positive.
+    '''
+    size = stiffness_matrix.shape[0]
+    if sigma is None:
+        sigma = 0.
+
+    if num_eigenvalues is None or num_eigenvalues >= size:
+        to_dense = lambda matrix : matrix.toarray() if sps.issparse(matrix) else np.asarray(matrix)
+        eigenvalues, eigenvectors = scipy.linalg.eigh(to_dense(stiffness_matrix), to_dense(mass_matrix))
+        if num_eigenvalues is not None:
+            indices = np.sort(np.argsort(np.abs(eigenvalues - sigma), kind='stable')[:num_eigenvalues])
+            eigenvalues, eigenvectors = eigenvalues[indices], eigenvectors[:,indices]
+    else:
+        mass_matrix = sps.csc_matrix(mass_matrix)
+        eigenvalues, eigenvectors = spla.eigsh(sps.csc_matrix(stiffness_matrix), k=num_eigenvalues, M=mass_matrix,
+                                               sigma=sigma, which='LM')
+        order = np.argsort(eigenvalues)
+        eigenvalues, eigenvectors = eigenvalues[order], eigenvectors[:,order]
+        eigenvectors = eigenvectors/np.sqrt(np.sum(eigenvectors*(mass_matrix@eigenvectors), axis=0))
+
+    signs = np.sign(eigenvectors[np.argmax(np.abs(eigenvectors), axis=0), np.arange(eigenvectors.shape[1])])
+    return eigenvalues, eigenvectors*signs
+
+
+def get_symmetric_part(matrix):
+    '''
+    Returns the symmetric part (A + A^T)/2 of a (dense or sparse) square matrix.
+    '''
+    return 0.5*(matrix + matrix.T)
+
+
+def get_bordered_factorization(stiffness_matrix, mass_matrix, eigenvalue:float, eigenvector:np.ndarray):
+    '''
+    Factorizes the (symmetric) bordered matrix [[K - w M, -M v], [-v^T M, 0]] of one eigenpair of K v = w M v (with
+    v^T M v = 1), which is nonsingular if the eigenvalue is simple.
+    '''
+    stiffness_matrix = sps.csc_matrix(stiffness_matrix)
+    mass_matrix = sps.csc_matrix(mass_matrix)
+    mass_eigenvector = (mass_matrix@eigenvector).reshape((-1, 1))
+    bordered_matrix = sps.bmat([[stiffness_matrix - eigenvalue*mass_matrix, -mass_eigenvector],
+                                [-mass_eigenvector.T, None]], format='csc')
+    return spla.splu(bordered_matrix)
+
+
+def compute_generalized_eigenvector_adjoints(stiffness_matrix, mass_matrix, eigenvalue:float, eigenvector:np.ndarray,
+                                             eigenvector_seeds:np.ndarray, eigenvalue_seeds:np.ndarray=None,
+                                             factorization=None) -> tuple:
+    '''
+    Solves the adjoint equations of one eigenpair of K v = w M v (with v^T M v = 1) for a set of seeds with one
+    factorization of the (symmetric) bordered matrix [[K - w M, -M v], [-v^T M, 0]].
+
+    Parameters
+    ----------
+    eigenvector_seeds : np.ndarray
+        The (n,num_seeds) derivatives of the functions of interest with respect to the eigenvector.
+    eigenvalue_seeds : np.ndarray, optional
+        The (num_seeds,) derivatives of the functions of interest with respect to the eigenvalue (zero by default).
+    factorization : scipy.sparse.linalg.SuperLU, optional
+        The factorization of the bordered matrix (see get_bordered_factorization).
+
+    Returns
+    -------
+    eigenvector_adjoints : np.ndarray
+        The (n,num_seeds) adjoints a. The derivatives of the functions of interest with respect to K and M are
+        -a v^T and w a v^T + alpha/2 v v^T respectively.
+    normalization_adjoints : np.ndarray
+        The (num_seeds,) adjoints alpha of the normalization.
+    '''
+    if factorization is None:
+        factorization = get_bordered_factorization(stiffness_matrix, mass_matrix, eigenvalue, eigenvector)
+
+    eigenvector_seeds = np.asarray(eigenvector_seeds, dtype=float).reshape((eigenvector.shape[0], -1))
+    if eigenvalue_seeds is None:
+        eigenvalue_seeds = np.zeros(eigenvector_seeds.shape[1])
+    seeds = np.vstack((eigenvector_seeds, np.reshape(eigenvalue_seeds, (1, -1))))
+    adjoints = factorization.solve(seeds)
+    return adjoints[:-1], adjoints[-1]
+
+
+def compute_generalized_eigenpair_jacvec_product(stiffness_matrix, mass_matrix, eigenvalues:np.ndarray,
+                                                 eigenvectors:np.ndarray, stiffness_perturbation, mass_perturbation,
+                                                 factorizations:list=None) -> tuple:
+    '''
+    Computes the directional derivatives of the eigenpairs of K v = w M v (with v^T M v = 1) for perturbations dK and
+    dM of K and M with one solve of the bordered system of each eigenpair,
+    [[K - w M, -M v], [-v^T M, 0]] [dv, dw] = [-(dK - w dM) v, v^T dM v/2].
+    Only the symmetric parts of the perturbations are used, consistently with compute_generalized_eigenpairs (which
+    assumes that K and M are symmetric).
 
-        # v inverse transpose
-        v_inv_T = (np.linalg.inv(v)).T
+    Parameters
+    ----------
+    stiffness_perturbation, mass_perturbation : np.ndarray or sps.spmatrix
+        The (n,n) perturbations dK and dM.
+    factorizations : list, optional
+        The factorizations of the bordered matrices of the eigenpairs (see get_bordered_factorization).
+
+    Returns
+    -------
+    eigenvalue_perturbations : np.ndarray
+        The (k,) directional derivatives of the eigenvalues.
+    eigenvector_perturbations : np.ndarray
+        The (n,k) directional derivatives of the eigenvectors.
+    '''
+    num_eigenvalues = eigenvalues.shape[0]
+    if factorizations is None:
+        factorizations = [get_bordered_factorization(stiffness_matrix, mass_matrix, eigenvalues[j], eigenvectors[:,j])
+                          for j in range(num_eigenvalues)]
+
+    stiffness_products = np.asarray(get_symmetric_part(stiffness_perturbation)@eigenvectors)
+    mass_products = np.asarray(get_symmetric_part(mass_perturbation)@eigenvectors)
+
+    eigenvalue_perturbations = np.zeros(num_eigenvalues)
+    eigenvector_perturbations = np.zeros(eigenvectors.shape)
+    for j in range(num_eigenvalues):
+        right_hand_side = np.append(eigenvalues[j]*mass_products[:,j] - stiffness_products[:,j],
+                                    0.5*eigenvectors[:,j].dot(mass_products[:,j]))
+        solution = factorizations[j].solve(right_hand_side)
+        eigenvector_perturbations[:,j] = solution[:-1]
+        eigenvalue_perturbations[j] = solution[-1]
+    return eigenvalue_perturbations, eigenvector_perturbations
+
+
+def compute_generalized_eigenpair_vecjac_product(stiffness_matrix, mass_matrix, eigenvalues:np.ndarray,
+                                                 eigenvectors:np.ndarray, eigenvalue_seeds:np.ndarray,
+                                                 eigenvector_seeds:np.ndarray, sparsity_pattern:tuple=None,
+                                                 factorizations:list=None) -> tuple:
+    '''
+    Computes the products of seeds of the eigenpairs of K v = w M v with their derivatives with respect to K and M
+    with one adjoint solve per eigenpair (see compute_generalized_eigenvector_adjoints). Only the symmetric parts of
+    the products are returned, so they are the transpose of compute_generalized_eigenpair_jacvec_product.
+
+    Parameters
+    ----------
+    eigenvalue_seeds : np.ndarray
+        The (k,) seeds of the eigenvalues.
+    eigenvector_seeds : np.ndarray
+        The (n,k) seeds of the eigenvectors.
+    sparsity_pattern : tuple, optional
+        The (rows, cols) indices of the entries of K and M that the products are computed for. By default, the
+        products are computed for all of the entries.
+    factorizations : list, optional
+        The factorizations of the bordered matrices of the eigenpairs (see get_bordered_factorization).
+
+    Returns
+    -------
+    stiffness_seeds, mass_seeds : np.ndarray
+        The (n,n) (or (nnz,) if a sparsity pattern is given) products with the derivatives with respect to K and M.
+    '''
+    num_eigenvalues = eigenvalues.shape[0]
+    eigenvalue_seeds = np.asarray(eigenvalue_seeds, dtype=float).reshape((num_eigenvalues,))
+    eigenvector_seeds = np.asarray(eigenvector_seeds, dtype=float).reshape(eigenvectors.shape)
+
+    eigenvector_adjoints = np.zeros(eigenvectors.shape)
+    normalization_adjoints = np.zeros(num_eigenvalues)
+    for j in range(num_eigenvalues):
+        if eigenvalue_seeds[j] == 0. and not np.any(eigenvector_seeds[:,j]):
+            continue
+        eigenvector_adjoint, normalization_adjoint = compute_generalized_eigenvector_adjoints(
+            stiffness_matrix, mass_matrix, eigenvalues[j], eigenvectors[:,j], eigenvector_seeds[:,j],
+            eigenvalue_seeds[j:j+1], factorization=None if factorizations is None else factorizations[j])
+        eigenvector_adjoints[:,j] = eigenvector_adjoint[:,0]
+        normalization_adjoints[j] = normalization_adjoint[0]
+
+    # The products are the symmetric parts of sum_j -a_j v_j^T and sum_j (w_j a_j + alpha_j/2 v_j) v_j^T
+    stiffness_adjoints = -eigenvector_adjoints
+    mass_adjoints = eigenvalues*eigenvector_adjoints + 0.5*normalization_adjoints*eigenvectors
+    if sparsity_pattern is None:
+        return get_symmetric_part(stiffness_adjoints@eigenvectors.T), get_symmetric_part(mass_adjoints@eigenvectors.T)
+
+    rows, cols = sparsity_pattern
+    get_entries = lambda adjoints : 0.5*(np.sum(adjoints[rows]*eigenvectors[cols], axis=1)
+                                         + np.sum(adjoints[cols]*eigenvectors[rows], axis=1))
+    return get_entries(stiffness_adjoints), get_entries(mass_adjoints)
+
+
+class GeneralizedEigExplicit(csdl.CustomExplicitOperation):
+    '''
+    Computes the eigenvalues and the mass-normalized eigenvectors of K v = w M v with matrix-free adjoint-based
+    derivatives (one solve of a sparse bordered system per eigenpair and seed, see
+    compute_generalized_eigenpair_jacvec_product and compute_generalized_eigenpair_vecjac_product).
+
+    If num_eigenvalues is given, only the eigenvalues closest to sigma are computed (with sparse shift-invert Lanczos
+    iterations). If a sparsity pattern of K and M is given, they are treated as sparse matrices with that pattern (the
+    other entries are ignored). K and M are symmetrized ((K + K^T)/2) before they are decomposed, so the derivatives are
+    exact for any (also non-symmetric) perturbation of the inputs. The eigendecomposition and the factorizations of the
+    bordered matrices are computed once per input values and reused by compute_jacvec_product().
+    '''
+    def initialize(self):
+        self.parameters.declare('size')
+        self.parameters.declare('num_eigenvalues', default=None, allow_none=True)
+        self.parameters.declare('sigma', default=None, allow_none=True)
+        self.parameters.declare('sparsity_pattern', default=None, allow_none=True)
+
+    def define(self):
+        size = self.parameters['size']
+        num_eigenvalues = self.parameters['num_eigenvalues']
+        if num_eigenvalues is None:
+            num_eigenvalues = size
+
+        self.eigenpairs_inputs = None
+        self.eigenpairs = None
+        self.factorizations = None
+        self.sparsity_pattern = None
+        if self.parameters['sparsity_pattern'] is not None:
+            self.sparsity_pattern = get_sparsity_pattern(self.parameters['sparsity_pattern'])
+
+        self.add_input('K', shape=(size, size))
+        self.add_input('M', shape=(size, size))
+
+        self.add_output('eigenvalues', shape=(num_eigenvalues,))
+        self.add_output('eigenvectors', shape=(size, num_eigenvalues))
+
+    def get_matrix(self, matrix):
+        '''
+        Returns the symmetric part of a (dense) input or of its entries in the sparsity pattern.
+        '''
+        if self.sparsity_pattern is None:
+            if self.parameters['num_eigenvalues'] is None:
+                return get_symmetric_part(np.asarray(matrix))
+            return get_symmetric_part(sps.csc_matrix(matrix))
+        rows, cols = self.sparsity_pattern
+        return get_symmetric_part(sps.csc_matrix((matrix[rows, cols], (rows, cols)), shape=matrix.shape)).tocsc()
+
+    def get_matrices(self, inputs) -> tuple:
+        return self.get_matrix(inputs['K']), self.get_matrix(inputs['M'])
+
+    def compute_eigenpairs(self, inputs) -> tuple:
+        if self.eigenpairs_inputs is not None and np.array_equal(self.eigenpairs_inputs[0], inputs['K']) \
+            and np.array_equal(self.eigenpairs_inputs[1], inputs['M']):
+            return self.eigenpairs
+
+        stiffness_matrix, mass_matrix = self.get_matrices(inputs)
+        self.eigenpairs = compute_generalized_eigenpairs(stiffness_matrix, mass_matrix,
+                                                         num_eigenvalues=self.parameters['num_eigenvalues'],
+                                                         sigma=self.parameters['sigma'])
+        self.eigenpairs_inputs = (np.array(inputs['K']), np.array(inputs['M']))
+        self.factorizations = None
+        return self.eigenpairs
+
+    def get_factorizations(self, inputs) -> list:
+        eigenvalues, eigenvectors = self.compute_eigenpairs(inputs)
+        if self.factorizations is None:
+            stiffness_matrix, mass_matrix = self.get_matrices(inputs)
+            self.factorizations = [get_bordered_factorization(stiffness_matrix, mass_matrix, eigenvalues[j],
+                                                              eigenvectors[:,j]) for j in range(eigenvalues.shape[0])]
+        return self.factorizations
+
+    def compute(self, inputs, outputs):
+        eigenvalues, eigenvectors = self.compute_eigenpairs(inputs)
+        outputs['eigenvalues'] = eigenvalues
+        outputs['eigenvectors'] = eigenvectors
+
+    def compute_jacvec_product(self, inputs, d_inputs, d_outputs, mode):
+        eigenvalues, eigenvectors = self.compute_eigenpairs(inputs)
+        factorizations = self.get_factorizations(inputs)
+        stiffness_matrix, mass_matrix = self.get_matrices(inputs)
+        if mode == 'fwd':
+            perturbations = [self.get_matrix(d_inputs[input_name]) if input_name in d_inputs
+                             else sps.csc_matrix(inputs[input_name].shape) for input_name in ('K', 'M')]
+            eigenvalue_perturbations, eigenvector_perturbations = compute_generalized_eigenpair_jacvec_product(
+                stiffness_matrix, mass_matrix, eigenvalues, eigenvectors, *perturbations, factorizations=factorizations)
+            if 'eigenvalues' in d_outputs:
+                d_outputs['eigenvalues'] += eigenvalue_perturbations
+            if 'eigenvectors' in d_outputs:
+                d_outputs['eigenvectors'] += eigenvector_perturbations
+        else:
+            eigenvalue_seeds = d_outputs['eigenvalues'] if 'eigenvalues' in d_outputs else np.zeros(eigenvalues.shape)
+            eigenvector_seeds = d_outputs['eigenvectors'] if 'eigenvectors' in d_outputs \
+                else np.zeros(eigenvectors.shape)
+            input_seeds = compute_generalized_eigenpair_vecjac_product(
+                stiffness_matrix, mass_matrix, eigenvalues, eigenvectors, eigenvalue_seeds, eigenvector_seeds,
+                sparsity_pattern=self.sparsity_pattern, factorizations=factorizations)
+            for input_name, input_seed in zip(('K', 'M'), input_seeds):
+                if input_name not in d_inputs:
+                    continue
+                if self.sparsity_pattern is None:
+                    d_inputs[input_name] += input_seed
+                else:
+                    rows, cols = self.sparsity_pattern
+                    d_inputs[input_name][rows, cols] += input_seed
+
+
+class LeastSquaresFit:
+    '''
+    Fits coefficients c to values v with a sparse evaluation map A by solving the regularized normal equations
+    (A^T A + r I) c = A^T v. The map is kept sparse and the normal equations are factorized once, so the fit can be
+    applied to any number of right hand sides.
+
+    Parameters
+    ----------
+    evaluation_map : sps.spmatrix or np.ndarray
+        The (num_values, num_coefficients) evaluation map A.
+    regularization_coeff : float, optional
+        The regularization coefficient r.
+    solver : str, optional, default: 'factorized'
+        'factorized' to solve with a sparse LU factorization of the normal equations or 'lsqr' to solve the (damped)
+        least squares problem iteratively (which also works if the normal equations are singular).
+    '''
+    def __init__(self, evaluation_map, regularization_coeff:float=None, solver:str='factorized') -> None:
+        self.evaluation_map = sps.csr_matrix(evaluation_map)
+        self.regularization_coeff = regularization_coeff
+        self.solver = solver
+        self.factorization = None
+        self.fitting_matrix = None
+
+        num_coefficients = self.evaluation_map.shape[1]
+        if solver == 'factorized':
+            normal_matrix = (self.evaluation_map.T@self.evaluation_map).tocsc()
+            if regularization_coeff is not None:
+                normal_matrix = normal_matrix + regularization_coeff*sps.identity(num_coefficients, format='csc')
+            try:
+                self.factorization = spla.splu(normal_matrix)
+            except RuntimeError as error:
+                raise ValueError('The normal equations of the fit are singular. Use a regularization coefficient or the '
+                                 '\'lsqr\' solver.') from error
+        elif solver != 'lsqr':
+            raise ValueError(f"Invalid least squares solver '{solver}'. Must be 'factorized' or 'lsqr'.")
+
+    @property
+    def nbytes(self) -> int:
+        '''
+        The (approximate) number of bytes that the map and the factorization take up.
+        '''
+        num_bytes = self.evaluation_map.data.nbytes + self.evaluation_map.indices.nbytes + self.evaluation_map.indptr.nbytes
+        if self.factorization is not None:
+            num_bytes += 12*(self.factorization.L.nnz + self.factorization.U.nnz)
+        if self.fitting_matrix is not None:
+            num_bytes += self.fitting_matrix.nbytes
+        return num_bytes
+
+    def solve(self, values:np.ndarray) -> np.ndarray:
+        '''
+        Computes the coefficients that fit the (num_values, num_physical_dimensions) values.
+        '''
+        values = np.asarray(values, dtype=float)
+        if self.solver == 'factorized':
+            return self.factorization.solve(np.asarray(self.evaluation_map.T@values))
+
+        damp = 0. if self.regularization_coeff is None else np.sqrt(self.regularization_coeff)
+        columns = [spla.lsqr(self.evaluation_map, column, damp=damp, atol=1e-12, btol=1e-12)[0]
+                   for column in values.reshape((values.shape[0], -1)).T]
+        return np.stack(columns, axis=-1).reshape((self.evaluation_map.shape[1],) + values.shape[1:])
+
+    def solve_transpose(self, coefficients:np.ndarray) -> np.ndarray:
+        '''
+        Applies the transpose of the (linear) fit to (num_coefficients, num_physical_dimensions) coefficient seeds, i.e.,
+        computes A (A^T A + r I)^-1 c, without forming the fitting matrix.
+        '''
+        coefficients = np.asarray(coefficients, dtype=float)
+        if self.solver == 'factorized':
+            return np.asarray(self.evaluation_map@self.factorization.solve(coefficients))
+
+        # A (A^T A + r I)^-1 = (A A^T + r I)^-1 A is the (damped) least squares solution of A^T x = c
+        damp = 0. if self.regularization_coeff is None else np.sqrt(self.regularization_coeff)
+        evaluation_map_transpose = self.evaluation_map.T.tocsr()
+        columns = [spla.lsqr(evaluation_map_transpose, column, damp=damp, atol=1e-12, btol=1e-12)[0]
+                   for column in coefficients.reshape((coefficients.shape[0], -1)).T]
+        return np.stack(columns, axis=-1).reshape((self.evaluation_map.shape[0],) + coefficients.shape[1:])
+
+    def get_fitting_matrix(self) -> np.ndarray:
+        '''
+        Returns the dense (num_coefficients, num_values) matrix that the fit is equivalent to. This is formed (once) on
+        request only; the derivatives of LeastSquaresSolve are applied with solve() and solve_transpose() instead.
+        '''
+        if self.fitting_matrix is None:
+            self.fitting_matrix = self.solve(np.eye(self.evaluation_map.shape[0]))
+        return self.fitting_matrix
+
+
+class LeastSquaresSolve(csdl.CustomExplicitOperation):
+    '''
+    Applies a LeastSquaresFit to the (num_values, num_physical_dimensions) values in a CSDL model. The fit is linear, so
+    its derivatives are applied as Jacobian-vector products with the factorized fit instead of forming the dense fitting
+    matrix.
+    '''
+    def initialize(self):
+        self.parameters.declare('fit', types=LeastSquaresFit)
+        self.parameters.declare('num_physical_dimensions', types=int)
+        self.parameters.declare('input_name', types=str, default='values')
+        self.parameters.declare('output_name', types=str, default='coefficients')
+
+    def define(self):
+        fit = self.parameters['fit']
+        num_physical_dimensions = self.parameters['num_physical_dimensions']
+        num_values, num_coefficients = fit.evaluation_map.shape
+
+        self.add_input(self.parameters['input_name'], shape=(num_values, num_physical_dimensions))
+        self.add_output(self.parameters['output_name'], shape=(num_coefficients, num_physical_dimensions))
+
+    def compute(self, inputs, outputs):
+        fit = self.parameters['fit']
+        outputs[self.parameters['output_name']] = fit.solve(inputs[self.parameters['input_name']])
+
+    def compute_jacvec_product(self, inputs, d_inputs, d_outputs, mode):
+        fit = self.parameters['fit']
+        input_name = self.parameters['input_name']
+        output_name = self.parameters['output_name']
+        if mode == 'fwd':
+            if input_name in d_inputs and output_name in d_outputs:
+                d_outputs[output_name] += fit.solve(d_inputs[input_name])
+        else:
+            if input_name in d_inputs and output_name in d_outputs:
+                d_inputs[input_name] += fit.solve_transpose(d_outputs[output_name])
+
+
+def compute_surface_normals(tangent_map:sps.spmatrix, coefficients:np.ndarray) -> tuple:
+    '''
+    Computes the unit normals of a surface from its coefficients with one product with the stacked tangent maps.
+
+    Parameters
+    ----------
+    tangent_map : sps.spmatrix
+        The (2*num_points, num_coefficients) map that evaluates the u-derivatives (first num_points rows) and the
+        v-derivatives (last num_points rows) of the surface.
+    coefficients : np.ndarray
+        The (num_coefficients, 3) coefficients of the surface.
+
+    Returns
+    -------
+    normals : np.ndarray
+        The (num_points, 3) unit normals.
+    u_tangents : np.ndarray
+        The (num_points, 3) u-derivatives.
+    v_tangents : np.ndarray
+        The (num_points, 3) v-derivatives.
+    '''
+    num_points = tangent_map.shape[0]//2
+    tangents = np.asarray(tangent_map@np.asarray(coefficients).reshape((tangent_map.shape[1], 3)))
+    u_tangents = tangents[:num_points]
+    v_tangents = tangents[num_points:]
+    cross_products = np.cross(u_tangents, v_tangents)
+    normals = cross_products/np.linalg.norm(cross_products, axis=1, keepdims=True)
+    return normals, u_tangents, v_tangents
+
+
+def compute_surface_normal_derivatives(tangent_map:sps.spmatrix, coefficients:np.ndarray) -> sps.csc_matrix:
+    '''
+    Computes the (3*num_points, 3*num_coefficients) derivative of the (row-major flattened) unit normals with respect to
+    the (row-major flattened) coefficients.
+    '''
+    normals, u_tangents, v_tangents = compute_surface_normals(tangent_map, coefficients)
+    num_points = normals.shape[0]
+    num_coefficients = tangent_map.shape[1]
+    cross_product_norms = np.linalg.norm(np.cross(u_tangents, v_tangents), axis=1)
+
+    # d(n)/d(c) = (I - n n^T)/|c| for the normalization of c = t_u x t_v
+    normalization_derivatives = (np.eye(3)[None,:,:] - normals[:,:,None]*normals[:,None,:])/cross_product_norms[:,None,None]
+    # d(c)/d(t_u) = -[t_v]x and d(c)/d(t_v) = [t_u]x
+    u_blocks = -normalization_derivatives@_get_cross_product_matrices(v_tangents)
+    v_blocks = normalization_derivatives@_get_cross_product_matrices(u_tangents)
+
+    tangent_map = sps.coo_matrix(tangent_map)
+    is_u_entry = tangent_map.row < num_points
+    point_indices = np.where(is_u_entry, tangent_map.row, tangent_map.row - num_points)
+    blocks = np.where(is_u_entry[:,None,None], u_blocks[point_indices], v_blocks[point_indices])*tangent_map.data[:,None,None]
+
+    component_indices = np.arange(3)
+    rows = 3*point_indices[:,None,None] + component_indices[None,:,None] + np.zeros((1,1,3), dtype=int)
+    columns = 3*tangent_map.col[:,None,None] + component_indices[None,None,:] + np.zeros((1,3,1), dtype=int)
+    return sps.csc_matrix((blocks.ravel(), (rows.ravel(), columns.ravel())), shape=(3*num_points, 3*num_coefficients))
+
+
+def _get_cross_product_matrices(vectors:np.ndarray) -> np.ndarray:
+    matrices = np.zeros((vectors.shape[0], 3, 3))
+    matrices[:,0,1] = -vectors[:,2]
+    matrices[:,0,2] = vectors[:,1]
+    matrices[:,1,0] = vectors[:,2]
+    matrices[:,1,2] = -vectors[:,0]
+    matrices[:,2,0] = -vectors[:,1]
+    matrices[:,2,1] = vectors[:,0]
+    return matrices
+
+
+class SurfaceNormals(csdl.CustomExplicitOperation):
+    '''
+    Computes the unit normals of a surface from its coefficients with analytic derivatives.
+    '''
+    def initialize(self):
+        self.parameters.declare('tangent_map')
+        self.parameters.declare('input_name', types=str, default='coefficients')
+        self.parameters.declare('output_name', types=str, default='normals')
+
+    def define(self):
+        tangent_map = self.parameters['tangent_map']
+        self.add_input(self.parameters['input_name'], shape=(tangent_map.shape[1], 3))
+        self.add_output(self.parameters['output_name'], shape=(tangent_map.shape[0]//2, 3))
+        self.declare_derivatives(self.parameters['output_name'], self.parameters['input_name'])
+
+    def compute(self, inputs, outputs):
+        normals, _, _ = compute_surface_normals(self.parameters['tangent_map'], inputs[self.parameters['input_name']])
+        outputs[self.parameters['output_name']] = normals
+
+    def compute_derivatives(self, inputs, derivatives):
+        derivatives[self.parameters['output_name'], self.parameters['input_name']] = \
+            compute_surface_normal_derivatives(self.parameters['tangent_map'], inputs[self.parameters['input_name']])
+
+
+def compute_rotation_matrices(axis_vector:np.ndarray, angles:np.ndarray) -> np.ndarray:
+    '''
+    Computes the (num_angles, 3, 3) Rodrigues' rotation matrices about an axis for all of the angles (in radians) at once.
+    '''
+    normalized_axis = np.asarray(axis_vector, dtype=float).reshape((-1,))
+    normalized_axis = normalized_axis/np.linalg.norm(normalized_axis)
+    angles = np.asarray(angles, dtype=float).reshape((-1,))
+    cross_product_matrix = _get_cross_product_matrices(normalized_axis.reshape((1, 3)))[0]
+    return np.eye(3) + np.sin(angles)[:,None,None]*cross_product_matrix \
+        + (1 - np.cos(angles))[:,None,None]*cross_product_matrix.dot(cross_product_matrix)
+
+
+def rotate_points(points:np.ndarray, axis_origin:np.ndarray, axis_vector:np.ndarray, angles:np.ndarray) -> np.ndarray:
+    '''
+    Rotates points about an axis by all of the angles (in radians) with a single einsum.
+
+    Returns
+    -------
+    rotated_points : np.ndarray
+        The (num_angles, num_points, 3) rotated points.
+    '''
+    axis_origin = np.asarray(axis_origin, dtype=float).reshape((-1,))
+    rotation_matrices = compute_rotation_matrices(axis_vector, angles)
+    points_origin_frame = np.asarray(points, dtype=float).reshape((-1, 3)) - axis_origin
+    return np.einsum('aij,pj->api', rotation_matrices, points_origin_frame) + axis_origin
+
+
+class RotationExplicit(csdl.CustomExplicitOperation):
+    '''
+    Rotates points about an axis by a set of angles with analytic derivatives with respect to the points, the origin and
+    vector of the axis and the angles.
+    '''
+    def initialize(self):
+        self.parameters.declare('points_shape', types=tuple)
+        self.parameters.declare('axis_origin_shape', types=tuple)
+        self.parameters.declare('axis_vector_shape', types=tuple)
+        self.parameters.declare('angles_shape', types=tuple)
+        self.parameters.declare('output_shape', types=tuple)
+        self.parameters.declare('output_name', types=str, default='rotated_points')
+        self.parameters.declare('angle_scaling', types=float, default=1.)   # e.g., pi/180 for angles in degrees
+
+    def define(self):
+        output_name = self.parameters['output_name']
+        self.add_input('points', shape=self.parameters['points_shape'])
+        self.add_input('axis_origin', shape=self.parameters['axis_origin_shape'])
+        self.add_input('axis_vector', shape=self.parameters['axis_vector_shape'])
+        self.add_input('angles', shape=self.parameters['angles_shape'])
+        self.add_output(output_name, shape=self.parameters['output_shape'])
+        for input_name in ('points', 'axis_origin', 'axis_vector', 'angles'):
+            self.declare_derivatives(output_name, input_name)
+
+    def compute(self, inputs, outputs):
+        angles = inputs['angles']*self.parameters['angle_scaling']
+        rotated_points = rotate_points(inputs['points'], inputs['axis_origin'], inputs['axis_vector'], angles)
+        outputs[self.parameters['output_name']] = rotated_points.reshape(self.parameters['output_shape'])
+
+    def compute_derivatives(self, inputs, derivatives):
+        output_name = self.parameters['output_name']
+        angle_scaling = self.parameters['angle_scaling']
+        axis_origin = np.asarray(inputs['axis_origin']).reshape((-1,))
+        axis_vector = np.asarray(inputs['axis_vector']).reshape((-1,))
+        angles = np.asarray(inputs['angles']).reshape((-1,))*angle_scaling
+        points_origin_frame = np.asarray(inputs['points']).reshape((-1, 3)) - axis_origin
+        num_angles = angles.shape[0]
+        num_points = points_origin_frame.shape[0]
+        num_outputs = 3*num_angles*num_points
 
-        # preallocate Jacobian: n outputs, n^2 inputs
-        temp_r = np.zeros((size, size*size))
-        temp_i = np.zeros((size, size*size))
+        axis_norm = np.linalg.norm(axis_vector)
+        normalized_axis = axis_vector/axis_norm
+        cross_product_matrix = _get_cross_product_matrices(normalized_axis.reshape((1, 3)))[0]
+        rotation_matrices = compute_rotation_matrices(axis_vector, angles)
+        sines = np.sin(angles)
+        cosines = np.cos(angles)
 
-        for j in range(len(w)):
+        # Points: a block diagonal of the rotation matrices for every (angle, point) pair
+        output_indices = np.arange(num_outputs).reshape((num_angles, num_points, 3))
+        rows = np.broadcast_to(output_indices[:,:,:,None], (num_angles, num_points, 3, 3))
+        columns = np.broadcast_to((3*np.arange(num_points)[:,None] + np.arange(3))[None,:,None,:], rows.shape)
+        values = np.broadcast_to(rotation_matrices[:,None,:,:], rows.shape)
+        derivatives[output_name, 'points'] = sps.csc_matrix((values.ravel(), (rows.ravel(), columns.ravel())),
+                                                            shape=(num_outputs, 3*num_points))
 
-            # dA/dw(j,:) = v(:,j)*(v^-T)(:j)
-            partial = np.outer(v[:, j], v_inv_T[:, j]).flatten(order='F')
-            # Note that the order of flattening matters, hence argument in flatten()
+        # Origin: y = R(x - o) + o, so dy/do = I - R
+        origin_derivative = np.broadcast_to((np.eye(3) - rotation_matrices)[:,None,:,:], (num_angles, num_points, 3, 3))
+        derivatives[output_name, 'axis_origin'] = origin_derivative.reshape((num_outputs, 3))
 
-            # Set jacobian rows
-            temp_r[j, :] = np.real(partial)
-            temp_i[j, :] = np.imag(partial)
+        # Angles: dR/dtheta = cos(theta) K + sin(theta) K^2
+        rotation_derivatives = cosines[:,None,None]*cross_product_matrix \
+            + sines[:,None,None]*cross_product_matrix.dot(cross_product_matrix)
+        angle_derivative_values = np.einsum('aij,pj->api', rotation_derivatives, points_origin_frame)*angle_scaling
+        angle_columns = np.broadcast_to(np.arange(num_angles)[:,None,None], output_indices.shape)
+        derivatives[output_name, 'angles'] = sps.csc_matrix((angle_derivative_values.ravel(), (output_indices.ravel(), angle_columns.ravel())),
+                                                            shape=(num_outputs, num_angles))
 
-        # Set Jacobian
-        derivatives['e_real', 'A'] = temp_r
-        derivatives['e_imag', 'A'] = temp_i
\ No newline at end of file
+        # Axis vector: R v = v + sin(theta) k x v + (1 - cos(theta)) (k (k.v) - (k.k) v) with k = a/|a|
+        dot_products = points_origin_frame.dot(normalized_axis)
+        cross_derivatives = -_get_cross_product_matrices(points_origin_frame)
+        double_cross_derivatives = dot_products[:,None,None]*np.eye(3) + normalized_axis[None,:,None]*points_origin_frame[:,None,:] \
+            - 2*points_origin_frame[:,:,None]*normalized_axis[None,None,:]
+        axis_derivatives = sines[:,None,None,None]*cross_derivatives[None] \
+            + (1 - cosines)[:,None,None,None]*double_cross_derivatives[None]
+        normalization_derivative = (np.eye(3) - np.outer(normalized_axis, normalized_axis))/axis_norm
+        derivatives[output_name, 'axis_vector'] = (axis_derivatives@normalization_derivative).reshape((num_outputs, 3))
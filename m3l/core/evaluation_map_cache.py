@@ -0,0 +1,283 @@
+'''
+Process-wide cache for the evaluation (and fitting) maps and the least squares fits of function spaces.
+
+The same maps are needed by the function evaluation, the normal evaluation (two derivative maps) and the inverse
+evaluation of a function, and again every time a model is assembled. The cache is disabled by default and is turned on
+with set_evaluation_map_cache().
+
+The maps are cached under the identity of the function space, a hash of its fields (for dataclass spaces, so changing
+e.g. the number of neighbors of a space in place computes new maps), the method and derivative order they are computed
+with and a hash of the parametric coordinates. The cache only holds weak references to the function spaces, so the maps
+of a space are dropped when the space is freed.
+
+The least recently used maps are evicted once the cache exceeds its memory budget. If a spill directory is set, the
+evicted maps are pickled to it instead of being discarded and are loaded again when they are needed.
+
+The cache can be used by operations that compute their CSDL models concurrently, so its state is only accessed while
+holding a lock. The maps themselves are computed outside of the lock.
+'''
+import dataclasses
+import hashlib
+import os
+import pickle
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sps
+
+
+evaluation_map_cache_options = {
+    'enabled' : False,
+    'max_memory' : 2**30,
+    'directory' : None,
+}
+
+evaluation_map_cache = OrderedDict()    # key -> [map, number of bytes], least recently used first
+spilled_evaluation_maps = {}            # key -> file path
+function_space_keys = {}                # id(function space) -> [keys of its maps, finalizer]
+freed_function_space_ids = []           # ids of freed function spaces whose maps have not been dropped yet
+evaluation_map_cache_memory = [0]
+evaluation_map_cache_lock = threading.RLock()
+
+
+def set_evaluation_map_cache(enabled:bool=True, max_memory:int=2**30, directory:str=None):
+    '''
+    Sets the options of the cache for the evaluation maps of function spaces.
+
+    Parameters
+    ----------
+    enabled : bool, optional, default: True
+        If False (which is the initial setting), the maps are computed again every time they are needed.
+    max_memory : int, optional, default: 2**30
+        The memory budget (in bytes) of the maps kept in memory. The least recently used maps are evicted first.
+    directory : str, optional
+        The directory that evicted maps are spilled to. By default, evicted maps are discarded.
+    '''
+    with evaluation_map_cache_lock:
+        evaluation_map_cache_options['enabled'] = enabled
+        evaluation_map_cache_options['max_memory'] = max_memory
+        evaluation_map_cache_options['directory'] = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        _evict()
+
+
+def clear_evaluation_map_cache():
+    '''
+    Empties the evaluation map cache and deletes the maps that were spilled to disk.
+    '''
+    with evaluation_map_cache_lock:
+        evaluation_map_cache.clear()
+        evaluation_map_cache_memory[0] = 0
+        for file_path in spilled_evaluation_maps.values():
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        spilled_evaluation_maps.clear()
+        for _, finalizer in list(function_space_keys.values()):
+            finalizer.detach()
+        function_space_keys.clear()
+        freed_function_space_ids.clear()
+
+
+def get_evaluation_map(function_space, parametric_coordinates:np.ndarray, parametric_derivative_order:tuple=None,
+                       method:str='compute_evaluation_map'):
+    '''
+    Returns the evaluation map of a function space at parametric coordinates, computing (and caching) it if it is not
+    cached. The returned map is shared, so it must not be modified in place.
+
+    Parameters
+    ----------
+    function_space : FunctionSpace
+        The function space whose map is computed.
+    parametric_coordinates : np.ndarray
+        The parametric coordinates that the map evaluates at.
+    parametric_derivative_order : tuple, optional
+        The order of the parametric derivatives that are evaluated. By default, the map is computed without passing it.
+    method : str, optional, default: 'compute_evaluation_map'
+        The method of the function space that computes the map (e.g., 'compute_fitting_map').
+    '''
+    def compute_map():
+        compute = getattr(function_space, method)
+        if parametric_derivative_order is None:
+            return compute(parametric_coordinates)
+        return compute(parametric_coordinates, parametric_derivative_order=parametric_derivative_order)
+
+    if not evaluation_map_cache_options['enabled']:
+        return compute_map()
+
+    key = _get_key(function_space, parametric_coordinates, parametric_derivative_order, method)
+    return _get_cached_map(key, function_space, compute_map)
+
+
+def get_tangent_map(function_space, parametric_coordinates:np.ndarray) -> sps.csr_matrix:
+    '''
+    Returns the (2*num_points, num_coefficients) map that evaluates the u-derivatives (first num_points rows) and the
+    v-derivatives (last num_points rows) of a function space in one product, computing (and caching) it if it is not
+    cached. The derivative maps themselves are also cached.
+    '''
+    def compute_tangent_map():
+        u_map = get_evaluation_map(function_space, parametric_coordinates, parametric_derivative_order=(1,0))
+        v_map = get_evaluation_map(function_space, parametric_coordinates, parametric_derivative_order=(0,1))
+        return sps.vstack((sps.csr_matrix(u_map), sps.csr_matrix(v_map)), format='csr')
+
+    if not evaluation_map_cache_options['enabled']:
+        return compute_tangent_map()
+
+    key = _get_key(function_space, parametric_coordinates, None, 'tangent_map')
+    return _get_cached_map(key, function_space, compute_tangent_map)
+
+
+def get_least_squares_fit(function_space, parametric_coordinates:np.ndarray, regularization_coeff:float=None,
+                          solver:str='factorized'):
+    '''
+    Returns the (factorized) least squares fit of the coefficients of a function space to values at parametric
+    coordinates, creating (and caching) it if it is not cached.
+
+    Parameters
+    ----------
+    function_space : FunctionSpace
+        The function space whose coefficients are fit.
+    parametric_coordinates : np.ndarray
+        The parametric coordinates of the values that are fit.
+    regularization_coeff : float, optional
+        The coefficient of the regularization of the normal equations.
+    solver : str, optional, default: 'factorized'
+        The solver of the least squares problem (see LeastSquaresFit).
+    '''
+    from m3l.core.csdl_operations import LeastSquaresFit
+
+    def compute_fit():
+        return LeastSquaresFit(get_evaluation_map(function_space, parametric_coordinates),
+                               regularization_coeff=regularization_coeff, solver=solver)
+
+    if not evaluation_map_cache_options['enabled']:
+        return compute_fit()
+
+    key = _get_key(function_space, parametric_coordinates, None, f'least_squares_fit_{solver}_{regularization_coeff!r}')
+    return _get_cached_map(key, function_space, compute_fit)
+
+
+def _get_cached_map(key:str, function_space, compute_map):
+    with evaluation_map_cache_lock:
+        _drop_freed_function_spaces()
+        if key in evaluation_map_cache:
+            evaluation_map_cache.move_to_end(key)
+            return evaluation_map_cache[key][0]
+        file_path = spilled_evaluation_maps.pop(key, None)
+
+    map = None
+    if file_path is not None:
+        try:
+            with open(file_path, 'rb') as file:
+                map = pickle.load(file)
+        except Exception:
+            map = None
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+    if map is None:
+        map = compute_map()
+
+    num_bytes = get_map_memory(map)
+    with evaluation_map_cache_lock:
+        if key in evaluation_map_cache:     # The same map was computed concurrently, so the cached one is shared
+            evaluation_map_cache.move_to_end(key)
+            return evaluation_map_cache[key][0]
+        if not _track_function_space(function_space, key):   # The space can not be referenced weakly
+            return map
+        evaluation_map_cache[key] = [map, num_bytes]
+        evaluation_map_cache_memory[0] += num_bytes
+        _evict(keep_key=key)
+    return map
+
+
+def _track_function_space(function_space, key:str) -> bool:
+    space_id = id(function_space)
+    if space_id not in function_space_keys:
+        try:
+            finalizer = weakref.finalize(function_space, freed_function_space_ids.append, space_id)
+        except TypeError:
+            return False
+        finalizer.atexit = False
+        function_space_keys[space_id] = [set(), finalizer]
+    function_space_keys[space_id][0].add(key)
+    return True
+
+
+def _drop_freed_function_spaces():
+    # The finalizers of freed function spaces only record their ids (they can run in the middle of any operation), so
+    # their maps are dropped here, before the ids can be matched by a new space, while holding the lock
+    while freed_function_space_ids:
+        keys, _ = function_space_keys.pop(freed_function_space_ids.pop(), (set(), None))
+        for key in keys:
+            entry = evaluation_map_cache.pop(key, None)
+            if entry is not None:
+                evaluation_map_cache_memory[0] -= entry[1]
+            file_path = spilled_evaluation_maps.pop(key, None)
+            if file_path is not None and os.path.isfile(file_path):
+                os.remove(file_path)
+
+
+def get_map_memory(map) -> int:
+    '''
+    Returns the number of bytes that the arrays of a (sparse) map (or a fit with an nbytes attribute) take up.
+    '''
+    if sps.issparse(map):
+        if hasattr(map, 'indptr'):
+            arrays = (map.data, map.indices, map.indptr)
+        elif hasattr(map, 'row'):
+            arrays = (map.data, map.row, map.col)
+        else:
+            map = map.tocsr()
+            arrays = (map.data, map.indices, map.indptr)
+        return int(sum(array.nbytes for array in arrays))
+    if hasattr(map, 'nbytes'):
+        return int(map.nbytes)
+    return int(np.asarray(map).nbytes)
+
+
+def _get_key(function_space, parametric_coordinates, parametric_derivative_order, method) -> str:
+    parametric_coordinates = np.ascontiguousarray(parametric_coordinates)
+    hasher = hashlib.sha256()
+    hasher.update(str((method, parametric_derivative_order, parametric_coordinates.dtype.str,
+                       parametric_coordinates.shape)).encode())
+    hasher.update(parametric_coordinates.tobytes())
+    if dataclasses.is_dataclass(function_space):
+        for field in dataclasses.fields(function_space):
+            value = getattr(function_space, field.name, None)
+            if sps.issparse(value):
+                value = sps.csr_matrix(value)
+                hasher.update(str((field.name, 'sparse', value.dtype.str, value.shape)).encode())
+                for array in (value.indptr, value.indices, value.data):
+                    hasher.update(np.ascontiguousarray(array).tobytes())
+            elif isinstance(value, np.ndarray) and value.dtype != object:
+                hasher.update(str((field.name, value.dtype.str, value.shape)).encode())
+                hasher.update(np.ascontiguousarray(value).tobytes())
+            else:
+                hasher.update(str((field.name, repr(value))).encode())
+    return f'{type(function_space).__qualname__}_{id(function_space)}_{hasher.hexdigest()}'
+
+
+def _evict(keep_key:str=None):
+    directory = evaluation_map_cache_options['directory']
+    while evaluation_map_cache_memory[0] > evaluation_map_cache_options['max_memory'] and evaluation_map_cache:
+        key = next(iter(evaluation_map_cache))
+        if key == keep_key:     # The map that was just added is larger than the budget, so it is kept on its own
+            if len(evaluation_map_cache) == 1:
+                break
+            evaluation_map_cache.move_to_end(key)
+            continue
+        map, num_bytes = evaluation_map_cache.pop(key)
+        evaluation_map_cache_memory[0] -= num_bytes
+        if directory is None:
+            continue
+        file_path = os.path.join(directory, f'{key}.pkl')
+        try:
+            with open(file_path, 'wb') as file:
+                pickle.dump(map, file)
+            # The spilled map is dropped (with the key of its function space) when the space is freed
+            spilled_evaluation_maps[key] = file_path
+        except Exception:   # The map can not be pickled, so it is discarded
+            if os.path.isfile(file_path):
+                os.remove(file_path)
@@ -3,17 +3,96 @@ from dataclasses import dataclass
 from m3l.core.m3l_classes import FunctionSpace
 
 import numpy as np
+import scipy.sparse as sps
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 
 
+def compute_sparse_idw_weights(targets:np.ndarray, sources:np.ndarray, order:float, num_neighbors:int=None,
+                               radius:float=None) -> sps.csr_matrix:
+    '''
+    Computes normalized inverse distance weights using only the nearest sources of each target.
+
+    Parameters
+    ----------
+    targets : np.ndarray
+        The (num_targets, num_dimensions) points that the weights are computed for.
+    sources : np.ndarray
+        The (num_sources, num_dimensions) points that the weights are applied to.
+    order : float
+        The power of the distance in the weights.
+    num_neighbors : int, optional
+        The maximum number of nearest sources of each target that are used.
+    radius : float, optional
+        Only the sources within this distance of a target are used.
+
+    Returns
+    -------
+    weights : sps.csr_matrix
+        The (num_targets, num_sources) weights. Each row sums to 1 unless there are no sources within the radius of the
+        target. If a target coincides with sources, only those get a weight (of 1), like in the dense evaluation.
+    '''
+    targets = np.asarray(targets, dtype=float).reshape((-1, np.shape(sources)[-1]))
+    sources = np.asarray(sources, dtype=float).reshape((-1, targets.shape[-1]))
+    num_targets = targets.shape[0]
+    num_sources = sources.shape[0]
+    tree = cKDTree(sources)
+
+    if num_neighbors is None and radius is None:
+        raise ValueError('Either the number of neighbors or the radius must be given for a sparse IDW evaluation.')
+    elif num_neighbors is None:
+        neighbor_lists = tree.query_ball_point(targets, r=radius)
+        rows = np.repeat(np.arange(num_targets), [len(neighbors) for neighbors in neighbor_lists])
+        columns = np.fromiter((index for neighbors in neighbor_lists for index in neighbors), dtype=int, count=len(rows))
+        distances = np.linalg.norm(targets[rows] - sources[columns], axis=1)
+    else:
+        num_neighbors = min(num_neighbors, num_sources)
+        distance_upper_bound = np.inf if radius is None else radius
+        distances, columns = tree.query(targets, k=num_neighbors, distance_upper_bound=distance_upper_bound)
+        distances = distances.reshape((num_targets, num_neighbors))
+        columns = columns.reshape((num_targets, num_neighbors))
+        rows = np.repeat(np.arange(num_targets), num_neighbors)
+        distances = distances.ravel()
+        columns = columns.ravel()
+        is_found = columns < num_sources     # Missing neighbors (outside the radius) are flagged with num_sources
+        rows, columns, distances = rows[is_found], columns[is_found], distances[is_found]
+
+    is_coincident = distances == 0.
+    with np.errstate(divide='ignore'):
+        weights = 1.0/distances**order
+    has_coincident_source = np.zeros((num_targets,), dtype=bool)
+    has_coincident_source[rows[is_coincident]] = True
+    weights[has_coincident_source[rows]] = 0.
+    weights[is_coincident] = 1.
+
+    row_sums = np.bincount(rows, weights=weights, minlength=num_targets)
+    row_sums[has_coincident_source] = 1.
+    row_sums[row_sums == 0.] = 1.
+    weights /= row_sums[rows]
+
+    return sps.csr_matrix((weights, (rows, columns)), shape=(num_targets, num_sources))
+
+
 @dataclass
 class IDWFunctionSpace(FunctionSpace): # this is a bit of a hack I guess
+    '''
+    Inverse distance weighting function space. By default, every point is weighted by every parametric coordinate
+    (dense maps). If num_neighbors and/or radius are given, only the nearest ones are found with a KD-tree and the maps
+    are returned as sparse CSR matrices.
+    '''
     name : str
     points : np.ndarray
     order : float
     coefficients_shape : tuple
+    num_neighbors : int = None
+    radius : float = None
 
     def compute_evaluation_map(self, parametric_coordinates:np.ndarray):
+        if self.num_neighbors is not None or self.radius is not None:
+            weights = compute_sparse_idw_weights(self.points, parametric_coordinates, self.order,
+                                                 self.num_neighbors, self.radius)
+            return weights.T.tocsr()
+
         dist = cdist(self.points, parametric_coordinates)
         weights = 1.0/dist**self.order
         weights = weights.T
@@ -22,6 +101,11 @@ class IDWFunctionSpace(FunctionSpace): # this is a bit of a hack I guess
         return weights
 
     def compute_fitting_map(self, parametric_coordinates:np.ndarray):
+        if self.num_neighbors is not None or self.radius is not None:
+            weights = compute_sparse_idw_weights(parametric_coordinates, self.points, self.order,
+                                                 self.num_neighbors, self.radius)
+            return weights.T.tocsr()
+
         dist = cdist(parametric_coordinates, self.points)
         weights = 1.0/dist**self.order
         weights = weights.T
@@ -32,15 +116,25 @@ class IDWFunctionSpace(FunctionSpace): # this is a bit of a hack I guess
 
 @dataclass
 class IDWFunctionSpace2(FunctionSpace):
+    '''
+    Inverse distance weighting function space whose evaluation maps are normalized over the points. If num_neighbors
+    and/or radius are given, only the nearest points are found with a KD-tree and the map is a sparse CSR matrix.
+    '''
     name : str
     points : np.ndarray
     order : float
     coefficients_shape : tuple
+    num_neighbors : int = None
+    radius : float = None
 
     def compute_evaluation_map(self, parametric_coordinates:np.ndarray):
+        if self.num_neighbors is not None or self.radius is not None:
+            return compute_sparse_idw_weights(parametric_coordinates, self.points, self.order,
+                                              self.num_neighbors, self.radius)
+
         dist = cdist(self.points, parametric_coordinates)
         weights = 1.0/dist**self.order
         weights /= weights.sum(axis=0)
         weights = weights.T
         np.nan_to_num(weights, copy=False, nan=1.) # maybe do another weights /= weights.sum(axis=0) after this
-        return weights
\ No newline at end of file
+        return weights
@@ -0,0 +1,410 @@
+'''
+Optimization passes over the M3L graph that are run before assembly.
+
+Common-subexpression elimination merges operations of the same class with the same parameters/attributes that take the
+same argument variables (e.g., the same m3l.norm(x) created twice). The output variables of the duplicate are turned
+into aliases of the outputs of the operation that is kept, in the same way Variable.__setitem__ re-points a variable.
+
+Linear operator fusion collapses maximal subgraphs of linear operations (MatVec, Add, Subtract, scalar Multiplication,
+Reshape, GetItem and SetItem) into single LinearMap operations with precomputed sparse maps. Only the outputs of the subgraph that are
+used outside of it (by nonlinear operations or as registered outputs) are kept.
+
+Dead-code elimination drops the operations that do not feed any registered output, constraint or objective.
+'''
+from dataclasses import dataclass
+
+import numpy as np
+import scipy.sparse as sps
+
+from m3l.core.model_cache import compute_definition_hash
+from m3l.core.operation_graph import OperationGraph
+
+
+@dataclass
+class GraphOptimizationStatistics:
+    '''
+    Statistics of a graph optimization pass.
+
+    Parameters
+    ----------
+    num_operations_before : int
+        The number of operations in the graph before the pass.
+    num_operations_after : int
+        The number of operations in the graph after the pass.
+    num_merged_operations : int
+        The number of duplicate operations that were merged by common-subexpression elimination.
+    num_fused_operations : int
+        The number of operations that were removed by collapsing linear subgraphs into LinearMap operations.
+    num_dead_operations : int
+        The number of operations that were removed by dead-code elimination.
+    '''
+    num_operations_before : int = 0
+    num_operations_after : int = 0
+    num_merged_operations : int = 0
+    num_fused_operations : int = 0
+    num_dead_operations : int = 0
+
+    @property
+    def num_removed_operations(self):
+        return self.num_operations_before - self.num_operations_after
+
+
+def optimize_graph(m3l_model, eliminate_common_subexpressions:bool=True, fuse_linear_operations:bool=True,
+                   eliminate_dead_code:bool=True) -> GraphOptimizationStatistics:
+    '''
+    Runs the graph optimization passes on a model. The operation graph and the operations of the model are replaced
+    with the optimized ones.
+
+    Parameters
+    ----------
+    m3l_model : Model
+        The model to optimize.
+    eliminate_common_subexpressions : bool, optional, default: True
+        If True, structurally identical operations are merged.
+    fuse_linear_operations : bool, optional, default: True
+        If True, subgraphs of linear operations are collapsed into single LinearMap operations.
+    eliminate_dead_code : bool, optional, default: True
+        If True, operations that do not feed a registered output, constraint or objective are removed.
+
+    Returns
+    -------
+    statistics : GraphOptimizationStatistics
+        The number of operations that were merged/removed.
+    '''
+    root_variables = list(m3l_model.outputs.values()) + list(m3l_model.constraints)
+    if m3l_model.objective is not None:
+        root_variables.append(m3l_model.objective)
+
+    for root_variable in root_variables:
+        m3l_model.gather_operations(root_variable)
+    operations = m3l_model.operation_graph.topological_sort()
+    statistics = GraphOptimizationStatistics(num_operations_before=len(operations))
+
+    merged_operation_ids = set()
+    if eliminate_common_subexpressions:
+        merged_operation_ids = merge_common_subexpressions(operations, root_variables)
+    statistics.num_merged_operations = len(merged_operation_ids)
+
+    fused_operation_ids = set()
+    if fuse_linear_operations:
+        remaining_operations = [operation for operation in operations if id(operation) not in merged_operation_ids]
+        fused_operation_ids, linear_map_operations = fuse_linear_subgraphs(remaining_operations, root_variables)
+        statistics.num_fused_operations = len(fused_operation_ids) - len(linear_map_operations)
+
+    # Rebuild the graph from the roots (the merged and fused operations are no longer reachable)
+    operation_graph = OperationGraph()
+    for root_variable in root_variables:
+        operation_graph.add_upstream_operations(root_variable)
+    if not eliminate_dead_code:
+        for operation in operations:
+            if id(operation) not in merged_operation_ids and id(operation) not in fused_operation_ids \
+                and operation not in operation_graph:
+                operation_graph.add_operation(operation)    # The operations are sorted, so the upstream ones are added first
+
+    m3l_model.operation_graph = operation_graph
+    m3l_model.operations = operation_graph.topological_sort()
+    m3l_model.operation_ids = set(id(operation) for operation in m3l_model.operations)
+    statistics.num_operations_after = len(m3l_model.operations)
+    statistics.num_dead_operations = statistics.num_operations_before - statistics.num_merged_operations \
+        - statistics.num_fused_operations - statistics.num_operations_after
+    return statistics
+
+
+def merge_common_subexpressions(operations:list, root_variables:list=()) -> set:
+    '''
+    Merges structurally identical operations. Only operations with a single output (stored in their output_name
+    attribute) are merged.
+
+    Parameters
+    ----------
+    operations : list[Operation]
+        The operations in topological order.
+    root_variables : list[Variable]
+        Variables that are referenced outside of the graph (e.g., registered outputs) and must also be re-pointed.
+
+    Returns
+    -------
+    merged_operation_ids : set[int]
+        The ids of the duplicate operations that were merged into another operation.
+    '''
+    output_variables = get_output_variables(operations, root_variables)
+
+    merged_operation_ids = set()
+    kept_operations = {}
+    for operation in operations:
+        output_name = getattr(operation, 'output_name', None)
+        if output_name is None:
+            continue
+        if any(variable.name != output_name for variable in output_variables.get(id(operation), [])):
+            continue    # The operation has more than one output
+
+        # The arguments are compared by identity (variables that alias the same output are identical)
+        argument_identities = [(argument_name, get_variable_key(argument)) for argument_name, argument in operation.arguments.items()]
+        key = (compute_definition_hash(operation, ignore_names=True).digest, tuple(argument_identities))
+
+        kept_operation = kept_operations.setdefault(key, operation)
+        if kept_operation is operation:
+            continue
+
+        for variable in output_variables.get(id(operation), []):
+            variable.operation = kept_operation
+            variable.name = kept_operation.output_name
+        output_variables.setdefault(id(kept_operation), []).extend(output_variables.pop(id(operation), []))
+        merged_operation_ids.add(id(operation))
+    return merged_operation_ids
+
+
+def get_variable_key(variable):
+    '''
+    Returns a key that identifies the value of a variable. Variables that alias the same output have the same key.
+    '''
+    if variable is None:
+        return None
+    if variable.operation is None:
+        return id(variable)
+    return (id(variable.operation), variable.name)
+
+
+def get_output_variables(operations:list, root_variables:list=()) -> dict:
+    '''
+    Finds the variables that reference each operation (as an argument of a downstream operation or as a root).
+
+    Returns
+    -------
+    output_variables : dict[int, list[Variable]]
+        The variables keyed by the ids of the operations that compute them.
+    '''
+    output_variables = {}
+    for variable in list(root_variables) + [argument for operation in operations for argument in operation.arguments.values()]:
+        if variable is not None and variable.operation is not None:
+            variables = output_variables.setdefault(id(variable.operation), [])
+            if not any(variable is other_variable for other_variable in variables):
+                variables.append(variable)
+    return output_variables
+
+
+def get_linear_terms(operation, is_constant=None):
+    '''
+    Returns the terms of a linear operation y = sum_i(map_i x_i) + offset, where the arguments x_i and the output y
+    are flattened.
+
+    Parameters
+    ----------
+    operation : Operation
+        The operation.
+    is_constant : callable, optional
+        Returns True for variables that may be treated as constants, so multiplying/dividing by them is linear.
+
+    Returns
+    -------
+    terms : list[tuple[Variable, sps.csr_matrix]]
+        The arguments and their maps. None if the operation is not linear.
+    offset : np.ndarray
+        The constant term (None if there is none).
+    '''
+    from m3l.core.m3l_standard_operations import MatVec, Add, Subtract, Multiplication, Division, Reshape, LinearMap, \
+        GetItem, SetItem
+
+    operation_type = type(operation)
+    arguments = operation.arguments
+    scalers = getattr(operation, 'scalers', {})
+
+    def identity(variable, scale=1.):
+        return scale*sps.identity(int(np.prod(variable.shape)), format='csr')
+
+    def elementwise(variable, constant, inverse=False):
+        constant = np.asarray(constant, dtype=float).reshape((-1,))
+        if inverse:
+            constant = 1/constant
+        size = int(np.prod(variable.shape))
+        if constant.size == 1:
+            return identity(variable, constant[0])
+        elif constant.size == size:
+            return sps.diags(constant, format='csr')
+        return None
+
+    if operation_type is MatVec:
+        x = arguments['x']
+        if int(np.prod(x.shape)) != operation.map.shape[1]:
+            return None
+        return [(x, sps.csr_matrix(operation.map))], None
+    elif operation_type is LinearMap:
+        return list(zip(arguments.values(), operation.maps)), operation.offset
+    elif operation_type is Reshape:
+        return [(arguments['x'], identity(arguments['x']))], None
+    elif operation_type is GetItem:
+        return [(arguments['x'], sps.csr_matrix(operation.get_selection_map()))], None
+    elif operation_type is SetItem:
+        unchanged_map, set_map = operation.get_maps()
+        if 'value' in arguments:
+            return [(arguments['x'], sps.csr_matrix(unchanged_map)), (arguments['value'], sps.csr_matrix(set_map))], None
+        return [(arguments['x'], sps.csr_matrix(unchanged_map))], set_map.dot(operation.constant.reshape((-1,)))
+    elif operation_type is Add:
+        x1, x2 = arguments['x1'], arguments['x2']
+        if np.prod(x1.shape) != np.prod(x2.shape):
+            return None
+        return [(x1, identity(x1)), (x2, identity(x2))], None
+    elif operation_type is Subtract:
+        if 'x1' in scalers:
+            x2 = arguments['x2']
+            return [(x2, identity(x2, -1.))], np.full((int(np.prod(x2.shape)),), float(scalers['x1']))
+        elif 'x2' in scalers:
+            x1 = arguments['x1']
+            return [(x1, identity(x1))], np.full((int(np.prod(x1.shape)),), -float(scalers['x2']))
+        x1, x2 = arguments['x1'], arguments['x2']
+        if np.prod(x1.shape) != np.prod(x2.shape):
+            return None
+        return [(x1, identity(x1)), (x2, identity(x2, -1.))], None
+    elif operation_type is Multiplication:
+        if 'x1' in scalers:
+            return [(arguments['x2'], identity(arguments['x2'], scalers['x1']))], None
+        elif 'x2' in scalers:
+            return [(arguments['x1'], identity(arguments['x1'], scalers['x2']))], None
+        elif is_constant is not None:
+            x1, x2 = arguments['x1'], arguments['x2']
+            if is_constant(x2) and x2.value is not None:
+                map = elementwise(x1, x2.value)
+                return None if map is None else ([(x1, map)], None)
+            elif is_constant(x1) and x1.value is not None:
+                map = elementwise(x2, x1.value)
+                return None if map is None else ([(x2, map)], None)
+    elif operation_type is Division and is_constant is not None:
+        x1, x2 = arguments['x1'], arguments['x2']
+        if is_constant(x2) and x2.value is not None:
+            map = elementwise(x1, x2.value, inverse=True)
+            return None if map is None else ([(x1, map)], None)
+    return None
+
+
+def compose_linear_expression(operation, is_frontier, is_constant=None, expressions:dict=None):
+    '''
+    Composes the linear operations upstream of an operation into a single linear expression of the frontier variables.
+    The traversal is iterative, so deep chains do not hit the recursion limit.
+
+    Parameters
+    ----------
+    operation : Operation
+        The (linear) operation whose output is expressed.
+    is_frontier : callable
+        Returns True for the variables that the expression is in terms of. All other arguments must be computed by
+        linear operations.
+    is_constant : callable, optional
+        See get_linear_terms.
+    expressions : dict, optional
+        Memoized expressions of the upstream operations keyed by their ids. This is updated in place.
+
+    Returns
+    -------
+    terms : dict
+        The frontier variables and their maps, {key : [variable, map]}.
+    offset : np.ndarray
+        The constant term (None if there is none).
+    '''
+    if expressions is None:
+        expressions = {}
+    linear_terms = {}
+
+    stack = [(operation, False)]
+    while stack:
+        current_operation, is_expanded = stack.pop()
+        if id(current_operation) in expressions:
+            continue
+        if id(current_operation) not in linear_terms:
+            linear_terms[id(current_operation)] = get_linear_terms(current_operation, is_constant)
+        operation_terms, operation_offset = linear_terms[id(current_operation)]
+
+        if not is_expanded:
+            stack.append((current_operation, True))
+            for argument, map in operation_terms:
+                if not is_frontier(argument) and id(argument.operation) not in expressions:
+                    stack.append((argument.operation, False))
+            continue
+
+        terms = {}
+        offset = None if operation_offset is None else np.array(operation_offset, dtype=float)
+        for argument, map in operation_terms:
+            if is_frontier(argument):
+                upstream_terms = {get_variable_key(argument) : [argument, None]}
+                upstream_offset = None
+            else:
+                upstream_terms, upstream_offset = expressions[id(argument.operation)]
+
+            for key, (variable, upstream_map) in upstream_terms.items():
+                composed_map = map if upstream_map is None else sps.csr_matrix(map.dot(upstream_map))
+                if key in terms:
+                    terms[key][1] = terms[key][1] + composed_map
+                else:
+                    terms[key] = [variable, composed_map]
+            if upstream_offset is not None:
+                mapped_offset = map.dot(upstream_offset)
+                offset = mapped_offset if offset is None else offset + mapped_offset
+        expressions[id(current_operation)] = (terms, offset)
+
+    return expressions[id(operation)]
+
+
+def fuse_linear_subgraphs(operations:list, root_variables:list=()) -> tuple:
+    '''
+    Collapses the maximal subgraphs of linear operations into LinearMap operations. The linear operations whose
+    outputs are only used by other linear operations are fused away. The outputs of the other linear operations are
+    turned into aliases of the outputs of new LinearMap operations (if anything was fused into them).
+
+    Parameters
+    ----------
+    operations : list[Operation]
+        The operations in topological order.
+    root_variables : list[Variable]
+        Variables that are referenced outside of the graph (e.g., registered outputs).
+
+    Returns
+    -------
+    fused_operation_ids : set[int]
+        The ids of the operations that were replaced.
+    linear_map_operations : list[LinearMap]
+        The new LinearMap operations.
+    '''
+    from m3l.core.m3l_standard_operations import LinearMap
+
+    linear_operation_ids = set(id(operation) for operation in operations if get_linear_terms(operation) is not None)
+
+    # The linear operations whose outputs are used outside of the linear subgraphs must be kept
+    consumed_operation_ids = set()
+    kept_operation_ids = set()
+    for operation in operations:
+        for argument in operation.arguments.values():
+            if argument is not None and argument.operation is not None:
+                consumed_operation_ids.add(id(argument.operation))
+                if id(operation) not in linear_operation_ids:
+                    kept_operation_ids.add(id(argument.operation))
+    for root_variable in root_variables:
+        if root_variable.operation is not None:
+            kept_operation_ids.add(id(root_variable.operation))
+    internal_operation_ids = (linear_operation_ids & consumed_operation_ids) - kept_operation_ids
+
+    def is_frontier(variable):
+        return variable.operation is None or id(variable.operation) not in internal_operation_ids
+
+    output_variables = get_output_variables(operations, root_variables)
+    fused_operation_ids = set(internal_operation_ids)
+    linear_map_operations = []
+    expressions = {}
+    for operation in operations:
+        if id(operation) not in linear_operation_ids or id(operation) in internal_operation_ids:
+            continue
+        if all(argument is None or is_frontier(argument) for argument in operation.arguments.values()):
+            continue    # Nothing to fuse into this operation
+        variables = output_variables.get(id(operation), [])
+        if not variables:
+            continue
+
+        terms, offset = compose_linear_expression(operation, is_frontier, expressions=expressions)
+        linear_map_operation = LinearMap(maps=[map for variable, map in terms.values()], offset=offset)
+        linear_map_output = linear_map_operation.evaluate(arguments=[variable for variable, map in terms.values()],
+                                                          shape=variables[0].shape)
+        for variable in variables:
+            variable.operation = linear_map_operation
+            variable.name = linear_map_output.name
+        fused_operation_ids.add(id(operation))
+        linear_map_operations.append(linear_map_operation)
+
+    return fused_operation_ids, linear_map_operations
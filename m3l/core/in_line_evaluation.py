@@ -0,0 +1,222 @@
+'''
+In-line evaluation of M3L operations.
+
+Operations compute the values of their outputs as soon as they are evaluated so that users can inspect them before the
+model is assembled. An operation supplies a direct NumPy/SciPy kernel for this by implementing compute_in_line().
+Operations that do not have a kernel fall back to running the CSDL model from compute() with a python_csdl_backend
+Simulator.
+
+In lazy mode, the evaluation is deferred until the value of an output is accessed. Only the upstream operations of that
+output are then computed, and their values are memoized on the operations until an upstream value changes.
+'''
+import numpy as np
+
+
+in_line_evaluation_options = {
+    'backend' : 'numpy',
+    'lazy' : False,
+}
+
+# Incremented every time the value of an existing variable is changed (e.g., a user input) or an existing variable is
+# reassigned to a new operation so deferred values know when they must be revalidated. Setting the values of new
+# variables and of new in-line evaluated outputs does not increment it.
+value_epoch = [0]
+
+
+def set_in_line_evaluation_backend(backend:str):
+    '''
+    Sets the backend used for in-line evaluations.
+
+    Parameters
+    ----------
+    backend : str
+        'numpy' to use the compute_in_line() kernels of the operations (falling back to a Simulator for operations
+        without one) or 'csdl' to always run the CSDL model of the operation with a Simulator.
+    '''
+    if backend not in ('numpy', 'csdl'):
+        raise ValueError(f"Invalid in-line evaluation backend '{backend}'. Must be 'numpy' or 'csdl'.")
+    in_line_evaluation_options['backend'] = backend
+
+
+def set_lazy_evaluation(lazy:bool=True):
+    '''
+    Turns the lazy (deferred) in-line evaluation mode on or off for all operations that are evaluated afterwards.
+    Lazy evaluation can also be turned on for the inputs of a single model with Model(lazy_evaluation=True).
+
+    Parameters
+    ----------
+    lazy : bool
+        If True, the values of operation outputs are only computed when they are accessed.
+    '''
+    in_line_evaluation_options['lazy'] = lazy
+
+
+def has_in_line_kernel(operation) -> bool:
+    '''
+    Checks if an operation implements its own compute_in_line() kernel.
+    '''
+    from m3l.core.m3l_classes import ExplicitOperation
+    kernel = getattr(type(operation), 'compute_in_line', None)
+    return kernel is not None and kernel is not ExplicitOperation.compute_in_line
+
+
+def evaluate_in_line(operation, *outputs):
+    '''
+    Computes the values of the outputs of an operation and stores them on the output variables. Nothing is computed if
+    any of the arguments of the operation does not have a value.
+
+    Parameters
+    ----------
+    operation : ExplicitOperation
+        The operation whose outputs are evaluated.
+    outputs : Variable
+        The M3L variables that are output by the operation.
+    '''
+    if in_line_evaluation_options['lazy'] or any(argument.lazy_evaluation for argument in operation.arguments.values()):
+        defer_in_line_evaluation(operation, *outputs)
+        return
+
+    for argument in operation.arguments.values():
+        if argument.value is None:
+            return
+
+    values = compute_in_line_values(operation, outputs)
+    for output in outputs:
+        set_in_line_value(output, values[output.name], operation)
+
+
+def defer_in_line_evaluation(operation, *outputs):
+    '''
+    Marks the outputs of an operation so their values are computed the first time they are accessed.
+    '''
+    operation.in_line_outputs = outputs
+    operation.in_line_values = None
+    operation.in_line_argument_versions = None
+    operation.in_line_version = 0
+    operation.in_line_epoch = None
+    for output in outputs:
+        set_in_line_value(output, None, operation)
+        output.lazy_evaluation = True
+
+
+def set_in_line_value(variable, value, operation):
+    '''
+    Sets the value of an output of an operation that is being evaluated in-line. Unlike setting the value of a variable,
+    this does not invalidate the deferred values if the output is new, since no operation downstream of it has been
+    evaluated. An existing variable that is reassigned to a new operation (e.g., the coefficients of a function that is
+    fit again) may already have consumers, so it invalidates them.
+    '''
+    if variable._value is not None or getattr(variable, '_in_line_operation', operation) is not operation:
+        value_epoch[0] += 1
+    variable._in_line_operation = operation
+    variable._value = value
+    variable._value_version = getattr(variable, '_value_version', 0) + 1
+
+
+def is_deferred(variable) -> bool:
+    '''
+    Checks if the value of a variable is computed lazily by its operation.
+    '''
+    return variable._value is None and variable.lazy_evaluation and variable.operation is not None \
+        and getattr(variable.operation, 'in_line_outputs', None) is not None
+
+
+def get_deferred_value(variable):
+    '''
+    Returns the value of a lazily evaluated variable, (re)computing the upstream operations whose arguments changed.
+    '''
+    operation = variable.operation
+    if operation.in_line_epoch != value_epoch[0]:
+        refresh_upstream_operations(operation)
+    return operation.in_line_values[variable.name]
+
+
+def refresh_upstream_operations(operation):
+    '''
+    Brings the memoized values of an operation and its lazily evaluated upstream operations up to date.
+    '''
+    # Gather the stale upstream operations in topological order (iteratively to avoid the recursion limit)
+    epoch = value_epoch[0]
+    ordered_operations = []
+    visited = set()
+    stack = [(operation, False)]
+    while stack:
+        current_operation, is_expanded = stack.pop()
+        if is_expanded:
+            ordered_operations.append(current_operation)
+            continue
+        if id(current_operation) in visited:
+            continue
+        visited.add(id(current_operation))
+        stack.append((current_operation, True))
+        for argument in current_operation.arguments.values():
+            if is_deferred(argument) and argument.operation.in_line_epoch != epoch \
+                and id(argument.operation) not in visited:
+                stack.append((argument.operation, False))
+
+    # Only recompute the operations whose arguments have changed since they were last computed
+    for current_operation in ordered_operations:
+        argument_versions = tuple((id(argument), get_value_version(argument)) 
+                                  for argument in current_operation.arguments.values())
+        if argument_versions != current_operation.in_line_argument_versions:
+            outputs = current_operation.in_line_outputs
+            if any(argument.value is None for argument in current_operation.arguments.values()):
+                current_operation.in_line_values = {output.name : None for output in outputs}
+            else:
+                current_operation.in_line_values = compute_in_line_values(current_operation, outputs)
+            current_operation.in_line_argument_versions = argument_versions
+            current_operation.in_line_version += 1
+        current_operation.in_line_epoch = epoch
+
+
+def get_value_version(variable):
+    '''
+    Returns a counter that changes whenever the value of the variable changes.
+    '''
+    if is_deferred(variable):
+        return (id(variable.operation), variable.operation.in_line_version)
+    return variable._value_version
+
+
+def compute_in_line_values(operation, outputs) -> dict:
+    '''
+    Computes the values of the outputs of an operation with its kernel or, if it does not have one, with a Simulator.
+
+    Parameters
+    ----------
+    operation : ExplicitOperation
+        The operation whose outputs are computed.
+    outputs : list[Variable]
+        The M3L variables that are output by the operation.
+
+    Returns
+    -------
+    values : dict[str, np.ndarray]
+        The output values keyed by the output names.
+    '''
+    if in_line_evaluation_options['backend'] == 'numpy' and has_in_line_kernel(operation):
+        values = operation.compute_in_line()
+        if not isinstance(values, dict):
+            values = {outputs[0].name : values}
+    else:
+        values = simulate_in_line(operation, outputs)
+
+    for output in outputs:
+        value = np.asarray(values[output.name])
+        if value.shape != tuple(output.shape) and value.size == np.prod(output.shape):
+            value = value.reshape(output.shape)
+        values[output.name] = value
+    return values
+
+
+def simulate_in_line(operation, outputs) -> dict:
+    '''
+    Runs the CSDL model of an operation with a Simulator to compute the values of its outputs.
+    '''
+    from python_csdl_backend import Simulator
+
+    sim = Simulator(operation.compute())
+    for argument_name, argument in operation.arguments.items():
+        sim[argument_name] = argument.value
+    sim.run()
+    return {output.name : sim[output.name] for output in outputs}
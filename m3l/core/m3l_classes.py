@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, is_dataclass, asdict, field
 from typing import Any, List
 
@@ -11,7 +12,13 @@ from typing import Union
 from m3l.utils.base_class import OperationBase
 # from ozone.api import ODEProblem
 
-from m3l.core.csdl_operations import Eig, EigExplicit
+from m3l.core.csdl_operations import BatchedEig, Eig, EigExplicit, GeneralizedEig, LeastSquaresFit, LeastSquaresSolve, SurfaceNormals, compute_surface_normals
+from m3l.core.in_line_evaluation import is_deferred, get_deferred_value, value_epoch, evaluate_in_line
+from m3l.core.operation_graph import OperationGraph
+from m3l.core.graph_optimization import optimize_graph
+from m3l.core.evaluation_map_cache import get_evaluation_map, get_tangent_map, get_least_squares_fit
+from m3l.core.model_cache import compute_operation_hashes, compute_assembly_hash, get_cached_model, \
+    is_model_cached, cache_model, copy_model, model_cache_options
 
 # @dataclass
 # class Node:
@@ -37,7 +44,14 @@ from m3l.core.csdl_operations import Eig, EigExplicit
 
 
 class Operation(OperationBase):
+    operation_counter = 0   # Used to break ties deterministically when sorting the operations of a model
+    # The attributes (besides the declared parameters and the argument names/shapes) that compute() depends on. They are
+    # hashed by the model cache, so subclasses that set other attributes in evaluate() that compute() uses must add them.
+    definition_attributes = ('name', 'output_name')
+
     def __init__(self, **kwargs) -> None:
+        self.operation_index = Operation.operation_counter
+        Operation.operation_counter += 1
         super().__init__(**kwargs)
         self.assign_attributes()  # Added this to make code more developer friendly (more familiar looking)
         
@@ -89,6 +103,20 @@ class ExplicitOperation(Operation):
         '''
         pass
 
+    def compute_in_line(self):
+        '''
+        -- optional --
+        Computes the values of the operation outputs directly (e.g., with NumPy/SciPy) from the values of the arguments.
+        This is used for in-line evaluations. If it is not implemented, the CSDL model from compute() is run with a
+        Simulator instead.
+
+        Returns
+        -------
+        outputs : {np.ndarray, dict[str, np.ndarray]}
+            The value of the output, or a dictionary of output values keyed by the output names.
+        '''
+        raise NotImplementedError
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -121,6 +149,13 @@ class ExplicitOperation(Operation):
 
 
 class ImplicitOperation(Operation):
+    # Optional attributes for the modal assembly: the keys of the residual partials that are the stiffness and mass
+    # matrices of the generalized eigenproblem K v = w M v, the number of lowest modes that are computed, the shift they
+    # are closest to and the sparsity pattern of K and M (see Model.add_eigenvalue_models)
+    modal_matrices = None
+    num_modes = None
+    modal_shift = None
+    modal_sparsity_pattern = None
     
     def assign_attributes(self):
         '''
@@ -201,7 +236,8 @@ class Variable:
     operation : Opeation = None
         The operation that computes this variable. If none, this variable is a top-level input.
     value : np.ndarray = None
-        The value of the variable.
+        The value of the variable. If the variable was created by an operation in lazy evaluation mode, the value is
+        computed the first time it is accessed.
     '''
     shape : tuple
     name : str = None
@@ -218,6 +254,7 @@ class Variable:
             self.name = f'{Variable.variable_counter}'
         Variable.variable_counter += 1
 
+        self.lazy_evaluation = False
         self.copy_before_use = False
         if self.operation is not None:
             for argument_name, argument in self.operation.arguments.items():
@@ -234,7 +271,8 @@ class Variable:
 
         self.name = new_me.name
         self.operation = new_me.operation
-        self.value = new_me.value
+        self.lazy_evaluation = new_me.lazy_evaluation
+        self.value = new_me._value    # NOTE: avoids forcing the evaluation of new_me in lazy mode
 
         self.copy_before_use = True
 
@@ -300,6 +338,117 @@ class Variable:
         return m3l.copy(self)
 
 
+def _get_variable_value(self):
+    if is_deferred(self):
+        return get_deferred_value(self)
+    return self._value
+
+def _set_variable_value(self, value):
+    is_new_variable = not hasattr(self, '_value')
+    self._value = value
+    self._value_version = getattr(self, '_value_version', 0) + 1
+    # Deferred values can only depend on variables that already exist, so setting the value of a new variable does not
+    # invalidate them (the in-line evaluation sets the values of its outputs with set_in_line_value for the same reason)
+    if not is_new_variable:
+        value_epoch[0] += 1
+
+# NOTE: The value is turned into a property after the dataclass is created so it stays a regular field of __init__.
+Variable.value = property(_get_variable_value, _set_variable_value)
+
+
+def get_scatter_map(indices, num_outputs:int) -> sps.csc_matrix:
+    '''
+    Returns the sparse (num_outputs, len(indices)) map that places row i of its input in row indices[i] of its output.
+    '''
+    indices = np.asarray(indices, dtype=int).reshape((-1,))
+    return sps.csc_matrix((np.ones(indices.shape), (indices, np.arange(indices.shape[0]))), shape=(num_outputs, indices.shape[0]))
+
+
+def apply_map_csdl(csdl_model:csdl.Model, map, values, map_name:str, input_indices=None, output_indices=None,
+                   num_outputs:int=None):
+    '''
+    Multiplies the (num_values, num_physical_dimensions) values with a map in a CSDL model. Sparse maps are kept sparse
+    and applied with a single sparse matvec to the flattened values instead of being declared as dense variables.
+
+    Parameters
+    ----------
+    csdl_model : csdl.Model
+        The model that the product is added to.
+    map : np.ndarray or sps.spmatrix
+        The (num_mapped_values, num_selected_values) map.
+    values : csdl.Variable
+        The (num_values, num_physical_dimensions) values.
+    map_name : str
+        The name that a dense map is declared under.
+    input_indices : np.ndarray, optional
+        The rows of the values that the map is applied to. By default, all rows are used.
+    output_indices : np.ndarray, optional
+        The rows of the output that the mapped values are placed in (the other rows are zero). By default, the mapped
+        values are the output.
+    num_outputs : int, optional
+        The number of rows of the output if output_indices is given.
+
+    Returns
+    -------
+    mapped_values : csdl.Variable
+        The mapped values.
+    '''
+    num_physical_dimensions = values.shape[-1]
+    num_values = values.shape[0]
+    gather_map = None if input_indices is None else get_scatter_map(input_indices, num_values).T
+    scatter_map = None if output_indices is None else get_scatter_map(output_indices, num_outputs)
+
+    if sps.issparse(map):
+        # The selection and placement of the rows are folded into the map so everything is one sparse matvec
+        map = sps.csc_matrix(map)
+        if gather_map is not None:
+            map = map@gather_map
+        if scatter_map is not None:
+            map = scatter_map@map
+        return _apply_sparse_map_csdl(map, values, num_physical_dimensions)
+
+    if gather_map is not None:
+        values = _apply_sparse_map_csdl(gather_map, values, num_physical_dimensions)
+    map_csdl = csdl_model.declare_variable(map_name, val=map, shape=map.shape, computed_upstream=False)
+    mapped_values = csdl.matmat(map_csdl, values)
+    if scatter_map is not None:
+        mapped_values = _apply_sparse_map_csdl(scatter_map, mapped_values, num_physical_dimensions)
+    return mapped_values
+
+
+def _apply_sparse_map_csdl(map:sps.spmatrix, values, num_physical_dimensions:int):
+    # Row-major flattening: vec(M@C) = kron(M, I)@vec(C)
+    vector_map = sps.kron(map, sps.identity(num_physical_dimensions, format='csc'), format='csc')
+    flattened_values = csdl.reshape(values, (vector_map.shape[1],))
+    flattened_mapped_values = csdl.matvec(vector_map, flattened_values)
+    return csdl.reshape(flattened_mapped_values, (map.shape[0], num_physical_dimensions))
+
+
+def summarize_map(map) -> dict:
+    '''
+    Returns the shape, number of nonzeros and density of a map.
+    '''
+    num_entries = int(np.prod(map.shape))
+    nnz = map.nnz if sps.issparse(map) else int(np.count_nonzero(map))
+    density = nnz/num_entries if num_entries else 0.
+    return {'shape' : tuple(map.shape), 'nnz' : nnz, 'density' : density, 'sparse' : sps.issparse(map)}
+
+
+def print_map_summary(operation:Operation):
+    '''
+    Prints the shapes, number of nonzeros and densities of the maps that an operation used the last time its CSDL model
+    was computed.
+    '''
+    map_summary = getattr(operation, 'map_summary', None)
+    if not map_summary:
+        print(f'{operation.name}: no maps have been computed.')
+        return
+    print(f'{operation.name}:')
+    for map_name, summary in map_summary.items():
+        storage = 'sparse' if summary['sparse'] else 'dense'
+        print(f"    {map_name}: shape={summary['shape']}, nnz={summary['nnz']}, density={summary['density']:.3e} ({storage})")
+
+
 @dataclass
 class FunctionSpace:
     '''
@@ -308,20 +457,245 @@ class FunctionSpace:
     # reference_geometry : Function = None
     pass    # do we want separate class for state functions that point to a reference geometry?
 
+@dataclass
+class IndexedParametricCoordinates:
+    '''
+    A columnar container of parametric coordinates on the surfaces of an indexed function space.
+
+    Indexing with an integer returns the (surface name, parametric coordinate) pair of a point like the list format. Slicing
+    returns views of the arrays (sharing the surface name table).
+
+    Parameters
+    ----------
+    surface_ids : np.ndarray
+        The (num_points,) indices of the surfaces (in surface_names) that the points are on.
+    parametric_coordinates : np.ndarray
+        The (num_points, num_parametric_dimensions) parametric coordinates.
+    surface_names : list[str]
+        The name table of the surfaces.
+    '''
+    surface_ids : np.ndarray
+    parametric_coordinates : np.ndarray
+    surface_names : list
+
+    def __post_init__(self):
+        self.surface_ids = np.asarray(self.surface_ids, dtype=np.int64).reshape((-1,))
+        self.parametric_coordinates = np.asarray(self.parametric_coordinates, dtype=float)
+        if self.parametric_coordinates.ndim != 2:
+            self.parametric_coordinates = self.parametric_coordinates.reshape((self.surface_ids.shape[0], -1))
+        self.surface_names = [str(name) for name in self.surface_names]
+        if self.parametric_coordinates.shape[0] != self.surface_ids.shape[0]:
+            raise ValueError(f'The number of parametric coordinates ({self.parametric_coordinates.shape[0]}) does not match '
+                             f'the number of surface ids ({self.surface_ids.shape[0]}).')
+
+    def __len__(self):
+        return self.surface_ids.shape[0]
+
+    def __getitem__(self, indices):
+        if isinstance(indices, (int, np.integer)):
+            return (self.surface_names[self.surface_ids[indices]], self.parametric_coordinates[indices:indices+1 or None])
+        return IndexedParametricCoordinates(surface_ids=self.surface_ids[indices],
+                                            parametric_coordinates=self.parametric_coordinates[indices],
+                                            surface_names=self.surface_names)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @classmethod
+    def from_surface_names(cls, surface_names, parametric_coordinates):
+        '''
+        Creates the container from the name of the surface of every point. The name table is in the order that the
+        surfaces first appear in.
+        '''
+        surface_names = np.asarray(surface_names).reshape((-1,))
+        unique_names, first_indices, inverse = np.unique(surface_names, return_index=True, return_inverse=True)
+        order = np.argsort(first_indices)
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(order.shape[0])
+        return cls(surface_ids=ranks[inverse.reshape((-1,))], parametric_coordinates=parametric_coordinates,
+                   surface_names=list(unique_names[order]))
+
+    @classmethod
+    def convert(cls, indexed_parametric_coordinates):
+        '''
+        Converts indexed parametric coordinates to this container.
+
+        Parameters
+        ----------
+        indexed_parametric_coordinates : IndexedParametricCoordinates, list[tuple[str, np.ndarray]] or tuple
+            The container itself (which is returned as is), a list of (surface name, parametric coordinate) pairs with
+            one point each or the columnar (surface names, parametric coordinates) arrays.
+        '''
+        if isinstance(indexed_parametric_coordinates, cls):
+            return indexed_parametric_coordinates
+        if isinstance(indexed_parametric_coordinates, tuple):
+            surface_names, parametric_coordinates = indexed_parametric_coordinates
+        else:
+            surface_names = [item[0] for item in indexed_parametric_coordinates]
+            parametric_coordinates = np.vstack([np.reshape(item[1], (1, -1)) for item in indexed_parametric_coordinates])
+        return cls.from_surface_names(surface_names, parametric_coordinates)
+
+    @classmethod
+    def concatenate(cls, indexed_parametric_coordinates:list):
+        '''
+        Concatenates containers (merging their name tables) with a single copy of the arrays.
+        '''
+        surface_names = list(dict.fromkeys(name for coordinates in indexed_parametric_coordinates
+                                           for name in coordinates.surface_names))
+        name_indices = {name : i for i, name in enumerate(surface_names)}
+        surface_ids = []
+        for coordinates in indexed_parametric_coordinates:
+            id_map = np.array([name_indices[name] for name in coordinates.surface_names], dtype=np.int64)
+            surface_ids.append(id_map[coordinates.surface_ids] if id_map.shape[0] else coordinates.surface_ids)
+        return cls(surface_ids=np.concatenate(surface_ids),
+                   parametric_coordinates=np.concatenate([coordinates.parametric_coordinates
+                                                          for coordinates in indexed_parametric_coordinates]),
+                   surface_names=surface_names)
+
+    def get_surface_name_array(self) -> np.ndarray:
+        '''
+        Returns the (num_points,) names of the surfaces that the points are on.
+        '''
+        return np.asarray(self.surface_names)[self.surface_ids]
+
+    def group_by_surface(self) -> dict:
+        '''
+        Groups the points by surface with a single sort.
+
+        Returns
+        -------
+        grouped_coordinates : dict[str, tuple[np.ndarray, np.ndarray]]
+            The indices of the points on each surface and their parametric coordinates. The surfaces are in the order
+            that they first appear in and the points of each surface keep their order.
+        '''
+        sorted_indices = np.argsort(self.surface_ids, kind='stable')
+        counts = np.bincount(self.surface_ids, minlength=len(self.surface_names))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        surface_ids = np.flatnonzero(counts)
+        first_indices = sorted_indices[offsets[surface_ids]]
+
+        grouped_coordinates = {}
+        for surface_id in surface_ids[np.argsort(first_indices)]:
+            indices = sorted_indices[offsets[surface_id]:offsets[surface_id+1]]
+            grouped_coordinates[self.surface_names[surface_id]] = (indices, self.parametric_coordinates[indices])
+        return grouped_coordinates
+
+    def save(self, file_path:str):
+        '''
+        Saves the container to a single .npz file.
+        '''
+        np.savez(file_path, surface_ids=self.surface_ids, parametric_coordinates=self.parametric_coordinates,
+                 surface_names=np.asarray(self.surface_names, dtype=str))
+
+    @classmethod
+    def load(cls, file_path:str):
+        '''
+        Loads a container that was saved with save().
+        '''
+        with np.load(file_path) as data:
+            return cls(surface_ids=data['surface_ids'], parametric_coordinates=data['parametric_coordinates'],
+                       surface_names=list(data['surface_names']))
+
+
+def get_columnar_parametric_coordinates(indexed_parametric_coordinates) -> tuple:
+    '''
+    Converts indexed parametric coordinates to the columnar (surface names, parametric coordinates) arrays.
+
+    Parameters
+    ----------
+    indexed_parametric_coordinates : IndexedParametricCoordinates, list[tuple[str, np.ndarray]] or tuple
+        The indexed parametric coordinates (see IndexedParametricCoordinates.convert).
+
+    Returns
+    -------
+    surface_names : np.ndarray
+        The (num_points,) names of the surfaces that the points are on.
+    parametric_coordinates : np.ndarray
+        The (num_points, num_parametric_dimensions) parametric coordinates.
+    '''
+    indexed_parametric_coordinates = IndexedParametricCoordinates.convert(indexed_parametric_coordinates)
+    return indexed_parametric_coordinates.get_surface_name_array(), indexed_parametric_coordinates.parametric_coordinates
+
+
+def group_indexed_parametric_coordinates(indexed_parametric_coordinates) -> dict:
+    '''
+    Groups indexed parametric coordinates by surface with a single sort (instead of appending points one at a time).
+
+    Parameters
+    ----------
+    indexed_parametric_coordinates : IndexedParametricCoordinates, list[tuple[str, np.ndarray]] or tuple
+        The indexed parametric coordinates (see IndexedParametricCoordinates.convert).
+
+    Returns
+    -------
+    grouped_coordinates : dict[str, tuple[np.ndarray, np.ndarray]]
+        The indices of the points on each surface and their parametric coordinates. The surfaces are in the order
+        that they first appear in and the points of each surface keep their order.
+    '''
+    return IndexedParametricCoordinates.convert(indexed_parametric_coordinates).group_by_surface()
+
+
+def get_indexed_output_shape(function, indexed_parametric_coordinates) -> tuple:
+    '''
+    Returns the (num_points, num_physical_dimensions) shape of the values of an indexed function at indexed parametric
+    coordinates.
+    '''
+    if isinstance(indexed_parametric_coordinates, tuple):
+        surface_names = indexed_parametric_coordinates[0]
+        first_surface_name = str(surface_names[0])
+    else:
+        surface_names = indexed_parametric_coordinates
+        first_surface_name = surface_names[0][0]
+    return (len(surface_names), function.coefficients[first_surface_name].shape[-1])
+
+
 @dataclass
 class IndexedFunctionSpace:
     name : str
     spaces : dict[str, FunctionSpace]
 
-    def compute_evaluation_map(self, indexed_parametric_coordinates:list[tuple[str, np.ndarray]]) -> list:
-        # TODO: use agrigated knot vectors. For now, we have this dumb loop:
-        map = []
-        for item in indexed_parametric_coordinates:
-            space = self.spaces[item[0]]
-            coords = self.spaces[item[1]]
-            map_i = space.compute_evaluation_map(coords)
-            map.append(map_i)
-        return map
+    def compute_evaluation_map(self, indexed_parametric_coordinates) -> sps.csr_matrix:
+        '''
+        Computes the evaluation map of all points at once. Each space is called once with all of its points and the
+        maps are assembled into one block-sparse map.
+
+        Parameters
+        ----------
+        indexed_parametric_coordinates : IndexedParametricCoordinates, list[tuple[str, np.ndarray]] or tuple
+            The indexed parametric coordinates (see IndexedParametricCoordinates.convert).
+
+        Returns
+        -------
+        map : sps.csr_matrix
+            The (num_points, num_coefficients) map from the concatenated coefficients of the spaces that have points (in
+            the order of self.spaces) to the values at the points (in their original order).
+        '''
+        grouped_coordinates = group_indexed_parametric_coordinates(indexed_parametric_coordinates)
+        num_points = sum(indices.shape[0] for indices, _ in grouped_coordinates.values())
+
+        rows = []
+        columns = []
+        data = []
+        num_coefficients = 0
+        for space_name in self.get_evaluated_space_names(grouped_coordinates):
+            indices, parametric_coordinates = grouped_coordinates[space_name]
+            space_map = sps.coo_matrix(get_evaluation_map(self.spaces[space_name], parametric_coordinates))
+            rows.append(indices[space_map.row])
+            columns.append(space_map.col + num_coefficients)
+            data.append(space_map.data)
+            num_coefficients += space_map.shape[1]
+
+        if not data:
+            return sps.csr_matrix((num_points, 0))
+        return sps.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+                              shape=(num_points, num_coefficients))
+
+    def get_evaluated_space_names(self, grouped_coordinates:dict) -> list:
+        '''
+        Returns the names of the spaces that have points, in the order that their coefficients are concatenated in.
+        '''
+        return [space_name for space_name in self.spaces if space_name in grouped_coordinates]
 
 @dataclass
 class Function:
@@ -387,7 +761,8 @@ class Function:
         function_values = function_evaluation_model.evaluate(self.coefficients)
         return function_values
     
-    def inverse_evaluate(self, function_values:Variable):
+    def inverse_evaluate(self, function_values:Variable, mesh:Union[Variable, np.ndarray], regularization_coeff:float=None,
+                         fitting_method:str=None) -> Variable:
         '''
         Performs an inverse evaluation to set the coefficients of this function given an input of evaluated points over a mesh.
 
@@ -395,29 +770,73 @@ class Function:
         ----------
         function_values : FunctionValues
             A variable representing the evaluated function values.
+        mesh : Variable or np.ndarray
+            The (parametric) coordinates that the function values are at.
+        regularization_coeff : float, optional
+            The coefficient of the regularization of the normal equations of the fit.
+        fitting_method : str, optional
+            The method of the fit if the function space does not have a fitting map (see IndexedFunction.inverse_evaluate).
+
+        Returns
+        -------
+        coefficients : Variable
+            The fitted coefficients of this function.
         '''
-        # map = Perform B-spline fit and potentially some sort of conversion from extrinsic to intrinsic
+        inverse_operation = FunctionInverseEvaluation(function=self, mesh=mesh, regularization_coeff=regularization_coeff,
+                                                      fitting_method=fitting_method)
+        self.coefficients = inverse_operation.evaluate(function_values)
+        return self.coefficients
 
-        # num_values = np.prod(function_values.mesh.shape[:-1])
-        num_values = np.prod(function_values.shape[:-1])
-        temp_map = np.eye(self.function_space.num_coefficients, num_values)
 
-        csdl_map = csdl.Model()
-        function_values_csdl = csdl_map.declare_variable(function_values.name, shape=(num_values,3))
-        map_csdl = csdl_map.create_input(f'{self.name}_inverse_evaluation_map', temp_map)
-        function_coefficients_csdl = csdl.matmat(map_csdl, function_values_csdl)
-        csdl_map.register_output(f'{self.name}_coefficients', function_coefficients_csdl)
+def get_mesh_parametric_coordinates(mesh:Union[Variable, np.ndarray]) -> np.ndarray:
+    '''
+    Returns the (num_points, num_parametric_dimensions) parametric coordinates of a mesh (a Variable with a value or an
+    array).
+    '''
+    if isinstance(mesh, Variable):
+        if mesh.value is None:
+            raise ValueError(f'The mesh {mesh.name} must have a value to compute the evaluation map of a function over it.')
+        mesh = mesh.value
+    mesh = np.asarray(mesh)
+    return mesh.reshape((-1, mesh.shape[-1]))
 
-        coefficients_shape = (temp_map.shape[0],3)
-        operation = CSDLOperation(name=f'{self.name}_inverse_evaluation', arguments=[function_values], operation_csdl=csdl_map)
-        function_coefficients = Variable(name=f'{self.name}_coefficients', shape=coefficients_shape, operation=operation)
-        return function_coefficients
+
+def get_fitting_operator(function_space:FunctionSpace, parametric_coordinates:np.ndarray, regularization_coeff:float=None,
+                         fitting_method:str='dense'):
+    '''
+    Returns the fitting map or the (factorized) LeastSquaresFit of the coefficients of a function space to values at
+    parametric coordinates.
+
+    Parameters
+    ----------
+    function_space : FunctionSpace
+        The function space whose coefficients are fit. Its compute_fitting_map() is used if it has one.
+    parametric_coordinates : np.ndarray
+        The parametric coordinates of the values.
+    regularization_coeff : float, optional
+        The coefficient of the regularization of the normal equations.
+    fitting_method : str, optional, default: 'dense'
+        'factorized' or 'lsqr' to return a LeastSquaresFit or 'dense' to return a dense fitting matrix (with a
+        pseudo-inverse if there is no regularization).
+    '''
+    if hasattr(function_space, 'compute_fitting_map'):
+        return get_evaluation_map(function_space, parametric_coordinates, method='compute_fitting_map')
+    if fitting_method in ('factorized', 'lsqr'):
+        return get_least_squares_fit(function_space, parametric_coordinates, regularization_coeff=regularization_coeff,
+                                     solver=fitting_method)
+
+    evaluation_matrix = get_evaluation_map(function_space, parametric_coordinates)
+    if sps.issparse(evaluation_matrix):
+        evaluation_matrix = evaluation_matrix.toarray()
+    if regularization_coeff is not None:
+        return np.linalg.inv(evaluation_matrix.T@evaluation_matrix + regularization_coeff*np.eye(evaluation_matrix.shape[1]))@evaluation_matrix.T # tested with 1e-3
+    return linalg.pinv(evaluation_matrix)
 
 
 class FunctionEvaluation(ExplicitOperation):
     def initialize(self, kwargs):
         self.parameters.declare('function', types=Function)
-        self.parameters.declare('mesh', types=Variable)
+        self.parameters.declare('mesh', types=(Variable, np.ndarray))
 
     def assign_attributes(self):
         '''
@@ -425,6 +844,9 @@ class FunctionEvaluation(ExplicitOperation):
         '''
         self.function = self.parameters['function']
         self.mesh = self.parameters['mesh']
+
+    def get_output_shape(self) -> tuple:
+        return tuple(self.mesh.shape[:-1]) + (self.function.coefficients.shape[-1],)
     
     def compute(self):
         '''
@@ -435,27 +857,32 @@ class FunctionEvaluation(ExplicitOperation):
         csdl_model : {csdl.Model}
             The csdl model  that computes the model/operation outputs.
         '''
-
-        mesh = self.mesh
-        function_space = self.function.space
         coefficients = self.arguments['coefficients']
+        evaluation_map = get_evaluation_map(self.function.space, get_mesh_parametric_coordinates(self.mesh))
+        self.map_summary = {'evaluation_map' : summarize_map(evaluation_map)}
 
-        num_values = np.prod(mesh.shape[:-1])
         num_coefficients = np.prod(coefficients.shape[:-1])
-        temp_map = np.eye(num_values, function_space.num_coefficients)
-        temp_map[function_space.num_coefficients:,0] = np.ones((num_values-function_space.num_coefficients,))
         output_name = f'evaluated_{self.function.name}'
-        output_shape = tuple(mesh.shape[:-1]) + (coefficients.shape[-1],)
+        output_shape = self.get_output_shape()
 
         csdl_map = csdl.Model()
-        function_coefficients = csdl_map.declare_variable(coefficients.name, shape=(num_coefficients, coefficients.shape[-1]),
-                                                                val=coefficients.value.reshape((-1, coefficients.shape[-1])))
-        map_csdl = csdl_map.create_input(f'{self.name}_evaluation_map', temp_map)
-        flattened_function_values_csdl = csdl.matmat(map_csdl, function_coefficients)
+        if coefficients.value is None:
+            function_coefficients = csdl_map.declare_variable('coefficients', shape=coefficients.shape)
+        else:
+            function_coefficients = csdl_map.declare_variable('coefficients', shape=coefficients.shape, val=coefficients.value)
+        if len(coefficients.shape) != 2:
+            function_coefficients = csdl.reshape(function_coefficients, new_shape=(num_coefficients, coefficients.shape[-1]))
+        flattened_function_values_csdl = apply_map_csdl(csdl_map, evaluation_map, function_coefficients, f'{self.name}_evaluation_map')
         function_values_csdl = csdl.reshape(flattened_function_values_csdl, new_shape=output_shape)
         csdl_map.register_output(output_name, function_values_csdl)
         return csdl_map
 
+    def compute_in_line(self):
+        coefficients = self.arguments['coefficients'].value
+        evaluation_map = get_evaluation_map(self.function.space, get_mesh_parametric_coordinates(self.mesh))
+        function_values = evaluation_map.dot(np.asarray(coefficients).reshape((-1, coefficients.shape[-1])))
+        return np.asarray(function_values).reshape(self.get_output_shape())
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -489,9 +916,100 @@ class FunctionEvaluation(ExplicitOperation):
         self.arguments = {'coefficients' : coefficients}
 
         # Create the M3L variables that are being output
-        function_values = Variable(name=f'evaluated_{self.function.name}', shape=self.mesh.shape, operation=self)
+        function_values = Variable(name=f'evaluated_{self.function.name}', shape=self.get_output_shape(), operation=self)
+        evaluate_in_line(self, function_values)
         return function_values
 
+
+class FunctionInverseEvaluation(ExplicitOperation):
+    def initialize(self, kwargs):
+        self.parameters.declare('function', types=Function)
+        self.parameters.declare('mesh', types=(Variable, np.ndarray))
+        self.parameters.declare('regularization_coeff', default=None)
+        self.parameters.declare('fitting_method', values=('factorized', 'lsqr', 'dense'), default=None, allow_none=True)
+
+    def assign_attributes(self):
+        '''
+        Assigns class attributes to make class more like standard python class.
+        '''
+        self.function = self.parameters['function']
+        self.mesh = self.parameters['mesh']
+        self.regularization_coeff = self.parameters['regularization_coeff']
+        self.fitting_method = self.parameters['fitting_method']
+        if self.fitting_method is None:
+            self.fitting_method = 'factorized' if self.regularization_coeff is not None else 'dense'
+
+    def get_fitting(self):
+        return get_fitting_operator(self.function.space, get_mesh_parametric_coordinates(self.mesh),
+                                    regularization_coeff=self.regularization_coeff, fitting_method=self.fitting_method)
+
+    def compute(self):
+        '''
+        Creates the CSDL model to compute the function coefficients.
+
+        Returns
+        -------
+        csdl_model : {csdl.Model}
+            The csdl model that computes the model/operation outputs.
+        '''
+        fitting = self.get_fitting()
+        function_values = self.arguments['function_values']
+        num_physical_dimensions = function_values.shape[-1]
+        values_shape = (int(np.prod(function_values.shape[:-1])), num_physical_dimensions)
+
+        csdl_model = csdl.Model()
+        function_values_csdl = csdl_model.declare_variable('function_values', shape=function_values.shape)
+        if isinstance(fitting, LeastSquaresFit):
+            self.map_summary = {'evaluation_map' : summarize_map(fitting.evaluation_map)}
+            function_values_csdl = csdl_model.register_output('reshaped_function_values', csdl.reshape(function_values_csdl, values_shape))
+            coefficients = csdl.custom(function_values_csdl, op=LeastSquaresSolve(fit=fitting, num_physical_dimensions=num_physical_dimensions,
+                                                                                  input_name='reshaped_function_values', output_name=self.output_name))
+        else:
+            self.map_summary = {'fitting_map' : summarize_map(fitting)}
+            function_values_csdl = csdl.reshape(function_values_csdl, values_shape)
+            coefficients = apply_map_csdl(csdl_model, fitting, function_values_csdl, f'{self.name}_fitting_map')
+        csdl_model.register_output(self.output_name, coefficients)
+        return csdl_model
+
+    def compute_in_line(self):
+        fitting = self.get_fitting()
+        function_values = np.asarray(self.arguments['function_values'].value)
+        function_values = function_values.reshape((-1, function_values.shape[-1]))
+        if isinstance(fitting, LeastSquaresFit):
+            return fitting.solve(function_values)
+        return np.asarray(fitting.dot(function_values))
+
+    def evaluate(self, function_values:Variable) -> Variable:
+        '''
+        User-facing method that the user will call to define a model evaluation.
+
+        Parameters
+        ----------
+        function_values : Variable
+            The values of the function at the mesh locations.
+
+        Returns
+        -------
+        coefficients : Variable
+            The fitted coefficients of the function.
+        '''
+        self.name = f'{self.function.name}_inverse_evaluation'
+        self.output_name = f'{self.function.name}_coefficients'
+
+        # Define operation arguments
+        self.arguments = {'function_values' : function_values}
+
+        # Create the M3L variables that are being output
+        fitting = self.get_fitting()
+        if isinstance(fitting, LeastSquaresFit):
+            num_coefficients = fitting.evaluation_map.shape[1]
+        else:
+            num_coefficients = fitting.shape[0]
+        coefficients = Variable(name=self.output_name, shape=(num_coefficients, function_values.shape[-1]), operation=self)
+        evaluate_in_line(self, coefficients)
+        return coefficients
+
+
 @dataclass
 class IndexedFunction:
     '''
@@ -530,7 +1048,8 @@ class IndexedFunction:
         function_evaluation_model = IndexedFunctionEvaluation(function=self, indexed_parametric_coordinates=indexed_parametric_coordinates)
         function_values = function_evaluation_model.evaluate()
         return function_values
-    def inverse_evaluate(self, indexed_parametric_coordinates, function_values:Variable, regularization_coeff:float=None):
+    def inverse_evaluate(self, indexed_parametric_coordinates, function_values:Variable, regularization_coeff:float=None,
+                         fitting_method:str=None):
         '''
         Performs an inverse evaluation to set the coefficients of this function given an input of evaluated points over a mesh.
 
@@ -538,12 +1057,20 @@ class IndexedFunction:
         ----------
         function_values : FunctionValues
             A variable representing the evaluated function values.
+        regularization_coeff : float, optional
+            The coefficient of the regularization of the normal equations of the fit.
+        fitting_method : str, optional
+            'factorized' to solve the (sparse) regularized normal equations with a cached factorization, 'lsqr' to solve
+            the least squares problem iteratively or 'dense' to form a dense fitting matrix (with a pseudo-inverse if
+            there is no regularization). By default, the factorized method is used if there is a regularization.
         '''
         # Perform B-spline fit 
-        inverse_operation = IndexedFunctionInverseEvaluation(function=self, indexed_parametric_coordinates=indexed_parametric_coordinates, regularization_coeff=regularization_coeff)
+        inverse_operation = IndexedFunctionInverseEvaluation(function=self, indexed_parametric_coordinates=indexed_parametric_coordinates, 
+                                                             regularization_coeff=regularization_coeff, fitting_method=fitting_method)
         inverse_operation.evaluate(function_values=function_values)
         for key, value in self.coefficients.items():
             value.operation = inverse_operation
+        evaluate_in_line(inverse_operation, *inverse_operation.get_fitted_coefficients())
         return self.coefficients
     
     def evaluate_normals(self, indexed_parametric_coordinates, name:str=None):
@@ -552,31 +1079,23 @@ class IndexedFunction:
         return function_values
     
     def compute(self, indexed_parametric_coordinates, coefficients):
-        associated_coords = {}
-        index = 0
-        for item in indexed_parametric_coordinates:
-            key = item[0]
-            value = item[1]
-            if key not in associated_coords.keys():
-                associated_coords[key] = [[index], value]
-            else:
-                associated_coords[key][0].append(index)
-                associated_coords[key] = [associated_coords[key][0], np.vstack((associated_coords[key][1], value))]
-            index += 1
+        indexed_parametric_coordinates = IndexedParametricCoordinates.convert(indexed_parametric_coordinates)
+        associated_coords = group_indexed_parametric_coordinates(indexed_parametric_coordinates)
 
-        output_shape = (len(indexed_parametric_coordinates), coefficients[indexed_parametric_coordinates[0][0]].shape[-1])
+        num_points = sum(len(value[0]) for value in associated_coords.values())
+        output_shape = (num_points, coefficients[next(iter(associated_coords))].shape[-1])
 
-        evaluated_points = np.zeros(output_shape)
-        for key, value in associated_coords.items(): # in the future, use submodels from the function spaces?
-            evaluation_matrix = self.space.spaces[key].compute_evaluation_map(value[1])
-            evaluated_points[value[0],:] = evaluation_matrix.dot(coefficients[key].reshape((-1, coefficients[key].shape[-1])))
-        return evaluated_points
+        # One sparse product with the block-sparse map of all spaces
+        evaluation_map = self.space.compute_evaluation_map(indexed_parametric_coordinates)
+        stacked_coefficients = [coefficients[key].reshape((-1, output_shape[-1]))
+                                for key in self.space.get_evaluated_space_names(associated_coords)]
+        return np.asarray(evaluation_map.dot(np.vstack(stacked_coefficients))).reshape(output_shape)
 
 
 class IndexedFunctionEvaluation(ExplicitOperation):
     def initialize(self, kwargs):
         self.parameters.declare('function', types=IndexedFunction)
-        self.parameters.declare('indexed_parametric_coordinates', types=list)
+        self.parameters.declare('indexed_parametric_coordinates', types=(list, tuple, IndexedParametricCoordinates))
 
     def assign_attributes(self):
         '''
@@ -595,22 +1114,11 @@ class IndexedFunctionEvaluation(ExplicitOperation):
             The csdl model  that computes the model/operation outputs.
         '''
 
-        associated_coords = {}
-        index = 0
-        for item in self.indexed_mesh:
-            key = item[0]
-            value = item[1]
-            if key not in associated_coords.keys():
-                associated_coords[key] = [[index], value]
-            else:
-                associated_coords[key][0].append(index)
-                associated_coords[key] = [associated_coords[key][0], np.vstack((associated_coords[key][1], value))]
-            index += 1
+        associated_coords = group_indexed_parametric_coordinates(self.indexed_mesh)
 
         output_name = f'evaluated_{self.function.name}'
-        output_shape = (len(self.indexed_mesh), self.function.coefficients[self.indexed_mesh[0][0]].shape[-1])
+        output_shape = get_indexed_output_shape(self.function, self.indexed_mesh)
         csdl_map = csdl.Model()
-        points = csdl_map.create_output(output_name, shape=output_shape)
         
         coefficients_csdl = {} 
         for key, coefficients in self.function.coefficients.items():
@@ -621,14 +1129,19 @@ class IndexedFunctionEvaluation(ExplicitOperation):
                 coefficients_csdl[key] = csdl_map.declare_variable(coefficients.name, shape=(num_coefficients, coefficients.shape[-1]),
                                                                     val=coefficients.value.reshape((-1, coefficients.shape[-1])))
 
+        self.map_summary = {}
+        points = None
         for key, value in associated_coords.items():
-            evaluation_matrix = self.function.space.spaces[key].compute_evaluation_map(value[1])
-            if sps.issparse(evaluation_matrix):
-                evaluation_matrix = evaluation_matrix.toarray()
-            evaluation_matrix_csdl = csdl_map.declare_variable('evaluation_matrix_'+key, val=evaluation_matrix, shape = evaluation_matrix.shape, computed_upstream=False)
-            associated_function_values = csdl.matmat(evaluation_matrix_csdl, coefficients_csdl[key])
-            for i in range(len(value[0])):
-                points[value[0][i],:] = associated_function_values[i,:]
+            evaluation_matrix = get_evaluation_map(self.function.space.spaces[key], value[1])
+            self.map_summary['evaluation_matrix_'+key] = summarize_map(evaluation_matrix)
+            # The evaluated points of each surface are placed in the output with the same (sparse) product
+            associated_function_values = apply_map_csdl(csdl_map, evaluation_matrix, coefficients_csdl[key], 'evaluation_matrix_'+key,
+                                                        output_indices=value[0], num_outputs=output_shape[0])
+            if points is None:
+                points = associated_function_values
+            else:
+                points = points + associated_function_values
+        csdl_map.register_output(output_name, points)
 
         # unique_keys = []
         # for item in self.indexed_mesh:
@@ -676,11 +1189,7 @@ class IndexedFunctionEvaluation(ExplicitOperation):
         self.name = f'{self.function.name}_evaluation'
 
         # Define operation arguments
-        surface_names = []
-        for item in self.indexed_mesh:
-            name = item[0]
-            if not name in surface_names:
-                surface_names.append(name)
+        surface_names = list(group_indexed_parametric_coordinates(self.indexed_mesh))
         self.arguments = {}
         coefficients = self.function.coefficients
         for name in surface_names:
@@ -688,7 +1197,7 @@ class IndexedFunctionEvaluation(ExplicitOperation):
         # self.arguments = self.function.coefficients
 
         # Create the M3L variables that are being output
-        output_shape = (len(self.indexed_mesh), self.function.coefficients[self.indexed_mesh[0][0]].shape[-1])
+        output_shape = get_indexed_output_shape(self.function, self.indexed_mesh)
 
         function_values = Variable(name=f'evaluated_{self.function.name}', shape=output_shape, operation=self)
         return function_values
@@ -697,7 +1206,7 @@ class IndexedFunctionEvaluation(ExplicitOperation):
 class IndexedFunctionNormalEvaluation(ExplicitOperation):
     def initialize(self, kwargs):
         self.parameters.declare('function', types=IndexedFunction)
-        self.parameters.declare('indexed_parametric_coordinates', types=list)
+        self.parameters.declare('indexed_parametric_coordinates', types=(list, tuple, IndexedParametricCoordinates))
         self.parameters.declare('name', types=str, allow_none=True)
 
     def assign_attributes(self):
@@ -718,24 +1227,13 @@ class IndexedFunctionNormalEvaluation(ExplicitOperation):
             The csdl model  that computes the model/operation outputs.
         '''
 
-        associated_coords = {}
-        index = 0
-        for item in self.indexed_mesh:
-            key = item[0]
-            value = item[1]
-            if key not in associated_coords.keys():
-                associated_coords[key] = [[index], value]
-            else:
-                associated_coords[key][0].append(index)
-                associated_coords[key] = [associated_coords[key][0], np.vstack((associated_coords[key][1], value))]
-            index += 1
+        associated_coords = group_indexed_parametric_coordinates(self.indexed_mesh)
 
         output_name = f'evaluated_normal_{self.function.name}'
         if not self.input_name is None:
             output_name = output_name + '_' + self.input_name
-        output_shape = (len(self.indexed_mesh), self.function.coefficients[self.indexed_mesh[0][0]].shape[-1])
+        output_shape = get_indexed_output_shape(self.function, self.indexed_mesh)
         csdl_map = csdl.Model()
-        points = csdl_map.create_output(output_name, shape=output_shape)
         
         coefficients_csdl = {} 
         for key, coefficients in self.function.coefficients.items():
@@ -746,26 +1244,33 @@ class IndexedFunctionNormalEvaluation(ExplicitOperation):
                 coefficients_csdl[key] = csdl_map.declare_variable(coefficients.name, shape=(num_coefficients, coefficients.shape[-1]),
                                                                     val=coefficients.value.reshape((-1, coefficients.shape[-1])))
 
+        self.map_summary = {}
+        points = None
         for key, value in associated_coords.items():
-            evaluation_matrix_u = self.function.space.spaces[key].compute_evaluation_map(value[1], parametric_derivative_order=(1,0))
-            evaluation_matrix_v = self.function.space.spaces[key].compute_evaluation_map(value[1], parametric_derivative_order=(0,1))
-            if sps.issparse(evaluation_matrix_u):
-                evaluation_matrix_u = evaluation_matrix_u.toarray()
-                evaluation_matrix_v = evaluation_matrix_v.toarray()
+            # Both tangents are evaluated with one product with the stacked (cached) derivative maps
+            tangent_map = get_tangent_map(self.function.space.spaces[key], value[1])
+            self.map_summary['tangent_map_'+key] = summarize_map(tangent_map)
 
-            evaluation_matrix_u_csdl = csdl_map.declare_variable('evaluation_matrix_u_'+key, val=evaluation_matrix_u, shape = evaluation_matrix_u.shape, computed_upstream=False)
-            evaluation_matrix_v_csdl = csdl_map.declare_variable('evaluation_matrix_v_'+key, val=evaluation_matrix_v, shape = evaluation_matrix_v.shape, computed_upstream=False)
+            normals = csdl.custom(coefficients_csdl[key], op=SurfaceNormals(tangent_map=tangent_map, input_name=self.function.coefficients[key].name,
+                                                                           output_name=f'{output_name}_{key}'))
 
-            associated_u_function_values = csdl.matmat(evaluation_matrix_u_csdl, coefficients_csdl[key])
-            associated_v_function_values = csdl.matmat(evaluation_matrix_v_csdl, coefficients_csdl[key])
-
-            normals = csdl.cross(associated_u_function_values, associated_v_function_values, axis=1)
-            normals = normals / csdl.expand(csdl.pnorm(normals, axis=1), normals.shape, 'i->ij')
-
-            for i in range(len(value[0])):
-                points[value[0][i],:] = normals[i,:]
+            scattered_normals = apply_map_csdl(csdl_map, sps.identity(len(value[0]), format='csc'), normals, 'scatter_map_'+key,
+                                               output_indices=value[0], num_outputs=output_shape[0])
+            if points is None:
+                points = scattered_normals
+            else:
+                points = points + scattered_normals
+        csdl_map.register_output(output_name, points)
 
         return csdl_map
+
+    def compute_in_line(self):
+        associated_coords = group_indexed_parametric_coordinates(self.indexed_mesh)
+        normals = np.zeros(get_indexed_output_shape(self.function, self.indexed_mesh))
+        for key, value in associated_coords.items():
+            tangent_map = get_tangent_map(self.function.space.spaces[key], value[1])
+            normals[value[0]], _, _ = compute_surface_normals(tangent_map, self.function.coefficients[key].value)
+        return normals
     
     def compute_derivates(self):
         '''
@@ -800,11 +1305,7 @@ class IndexedFunctionNormalEvaluation(ExplicitOperation):
             self.name = f'{self.function.name}_normal_evaluation'
 
         # Define operation arguments
-        surface_names = []
-        for item in self.indexed_mesh:
-            name = item[0]
-            if not name in surface_names:
-                surface_names.append(name)
+        surface_names = list(group_indexed_parametric_coordinates(self.indexed_mesh))
         self.arguments = {}
         coefficients = self.function.coefficients
         for name in surface_names:
@@ -812,21 +1313,23 @@ class IndexedFunctionNormalEvaluation(ExplicitOperation):
         # self.arguments = self.function.coefficients
 
         # Create the M3L variables that are being output
-        output_shape = (len(self.indexed_mesh), self.function.coefficients[self.indexed_mesh[0][0]].shape[-1])
+        output_shape = get_indexed_output_shape(self.function, self.indexed_mesh)
 
         output_name = f'evaluated_normal_{self.function.name}'
         if not self.input_name is None:
             output_name = output_name + '_' + self.input_name
 
         function_values = Variable(name=output_name, shape=output_shape, operation=self)
+        evaluate_in_line(self, function_values)
         return function_values
 
 class IndexedFunctionInverseEvaluation(ExplicitOperation):
     def initialize(self, kwargs):
         self.parameters.declare('function', types=IndexedFunction)
-        self.parameters.declare('indexed_parametric_coordinates', types=list)
+        self.parameters.declare('indexed_parametric_coordinates', types=(list, tuple, IndexedParametricCoordinates))
         self.parameters.declare('function_values')
         self.parameters.declare('regularization_coeff', default=None)
+        self.parameters.declare('fitting_method', values=('factorized', 'lsqr', 'dense'), default=None, allow_none=True)
 
     def assign_attributes(self):
         '''
@@ -835,6 +1338,29 @@ class IndexedFunctionInverseEvaluation(ExplicitOperation):
         self.function = self.parameters['function']
         self.indexed_mesh = self.parameters['indexed_parametric_coordinates']
         self.regularization_coeff = self.parameters['regularization_coeff']
+        self.fitting_method = self.parameters['fitting_method']
+        if self.fitting_method is None:
+            self.fitting_method = 'factorized' if self.regularization_coeff is not None else 'dense'
+
+    def get_fitting(self, key:str, parametric_coordinates:np.ndarray):
+        '''
+        Returns the fitting matrix or the (factorized) LeastSquaresFit of the coefficients of a surface.
+
+        Parameters
+        ----------
+        key : str
+            The name of the surface.
+        parametric_coordinates : np.ndarray
+            The parametric coordinates of the function values on the surface.
+        '''
+        return get_fitting_operator(self.function.space.spaces[key], parametric_coordinates,
+                                    regularization_coeff=self.regularization_coeff, fitting_method=self.fitting_method)
+
+    def get_fitted_coefficients(self) -> list:
+        '''
+        Returns the coefficient variables of the surfaces that have function values (the outputs of this operation).
+        '''
+        return [self.function.coefficients[key] for key in group_indexed_parametric_coordinates(self.indexed_mesh)]
     
     def compute(self):
         '''
@@ -845,44 +1371,47 @@ class IndexedFunctionInverseEvaluation(ExplicitOperation):
         csdl_model : {csdl.Model}
             The csdl model that computes the model/operation outputs.
         '''
-        associated_coords = {}
-        index = 0
-        for item in self.indexed_mesh:
-            key = item[0]
-            value = item[1]
-            if key not in associated_coords.keys():
-                associated_coords[key] = [[index], value]
-            else:
-                associated_coords[key][0].append(index)
-                associated_coords[key] = [associated_coords[key][0], np.vstack((associated_coords[key][1], value))]
-            index += 1
+        associated_coords = group_indexed_parametric_coordinates(self.indexed_mesh)
 
-        output_shape = (len(self.indexed_mesh), self.function.coefficients[self.indexed_mesh[0][0]].shape[-1])
+        output_shape = get_indexed_output_shape(self.function, self.indexed_mesh)
         csdl_model = csdl.Model()
         function_values = csdl_model.declare_variable('function_values', shape=self.arguments['function_values'].shape)
         function_values = csdl.reshape(function_values, output_shape)
         csdl_model.register_output('test_function_values', function_values)
+        self.map_summary = {}
         for key, value in associated_coords.items(): # in the future, use submodels from the function spaces?
-            if hasattr(self.function.space.spaces[key], 'compute_fitting_map'):
-                fitting_matrix = self.function.space.spaces[key].compute_fitting_map(value[1])
-            else:
-                evaluation_matrix = self.function.space.spaces[key].compute_evaluation_map(value[1])
-                if sps.issparse(evaluation_matrix):
-                    evaluation_matrix = evaluation_matrix.toarray()
-                if self.regularization_coeff is not None:
-                    fitting_matrix = np.linalg.inv(evaluation_matrix.T@evaluation_matrix + self.regularization_coeff*np.eye(evaluation_matrix.shape[1]))@evaluation_matrix.T # tested with 1e-3
-                else:
-                    fitting_matrix = linalg.pinv(evaluation_matrix)
-            fitting_matrix_csdl = csdl_model.declare_variable('fitting_matrix_'+key, val=fitting_matrix, shape = fitting_matrix.shape, computed_upstream=False)
-            associated_function_values = csdl_model.create_output(name = key + '_fn_values', shape=(len(value[0]), output_shape[-1]))
-            for i in range(len(value[0])):
-                associated_function_values[i,:] = function_values[value[0][i], :]
-            coefficients = csdl.matmat(fitting_matrix_csdl, associated_function_values)
+            fitting = self.get_fitting(key, value[1])
             coeff_name = self.function.coefficients[key].name
+            if isinstance(fitting, LeastSquaresFit):
+                # The map stays sparse and the factorized normal equations are solved in a custom operation
+                self.map_summary['evaluation_matrix_'+key] = summarize_map(fitting.evaluation_map)
+                associated_function_values = apply_map_csdl(csdl_model, sps.identity(len(value[0]), format='csc'), function_values,
+                                                            key + '_fn_values', input_indices=value[0])
+                associated_function_values = csdl_model.register_output(key + '_fn_values', associated_function_values)
+                coefficients = csdl.custom(associated_function_values, op=LeastSquaresSolve(fit=fitting, num_physical_dimensions=output_shape[-1],
+                                                                                           input_name=key + '_fn_values', output_name=coeff_name))
+            else:
+                self.map_summary['fitting_matrix_'+key] = summarize_map(fitting)
+                # The function values of this surface are selected with the same (sparse) product
+                coefficients = apply_map_csdl(csdl_model, fitting, function_values, 'fitting_matrix_'+key, input_indices=value[0])
             csdl_model.register_output(name = coeff_name, var = coefficients)
         
         return csdl_model
 
+    def compute_in_line(self):
+        associated_coords = group_indexed_parametric_coordinates(self.indexed_mesh)
+        output_shape = get_indexed_output_shape(self.function, self.indexed_mesh)
+        function_values = np.asarray(self.arguments['function_values'].value).reshape(output_shape)
+
+        coefficients = {}
+        for key, value in associated_coords.items():
+            fitting = self.get_fitting(key, value[1])
+            if isinstance(fitting, LeastSquaresFit):
+                coefficients[self.function.coefficients[key].name] = fitting.solve(function_values[value[0]])
+            else:
+                coefficients[self.function.coefficients[key].name] = fitting.dot(function_values[value[0]])
+        return coefficients
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -925,13 +1454,30 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
     A class for storing a group of M3L models. These can be used to establish coupling loops.
     '''
 
-    def __init__(self) -> None:
+    def __init__(self, lazy_evaluation:bool=False) -> None:
         '''
         Constructs a model group.
+
+        Parameters
+        ----------
+        lazy_evaluation : bool, optional, default: False
+            If True, the in-line evaluation of the operations downstream of the inputs created with create_input is
+            deferred until their values are accessed.
         '''
+        self.lazy_evaluation = lazy_evaluation
         self.models = {}
         # self.operations = {}
         self.operations = []
+        self.operation_ids = set()   # ids of the operations in self.operations for O(1) membership checks
+        self.operation_graph = OperationGraph()
+        self.operation_hashes = {}
+        self.assembly_hash = None
+        self.csdl_model = None
+        self.independent_variable_names = []
+        self.assembled_operation_ids = set()
+        self.assembled_user_inputs = []
+        self.assembled_constraints = []
+        self.assembled_objective = None
         self.outputs = {}
         self.parameters = None
         self.constraints = []
@@ -1030,6 +1576,8 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
             scaler=scaler,
         )
 
+        m3l_var.lazy_evaluation = self.lazy_evaluation
+
         # self.m3l_inputs.append(m3l_var)
         self.user_inputs.append(m3l_var)
 
@@ -1260,9 +1808,7 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
         '''
         Checks if this operation has already been added to the model.
         '''
-        for model_operation in self.operations:
-            if operation is model_operation:
-                return True
+        return id(operation) in self.operation_ids
             
     def check_if_variable_is_in_list(self, variable:Variable, stack:list):
         '''
@@ -1302,45 +1848,20 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
     #     self.operations.reverse()
 
     def gather_operations(self, variable: Variable):
-        from collections import deque
-        total_stack = []
-        stack = deque([variable])
-
-        while stack:
-            current_variable = stack.popleft()
-
-            if current_variable.operation is not None:
-                operation = current_variable.operation
-                is_already_added = self.check_if_operation_has_been_added(operation)
-
-                if not is_already_added:
-                # if operation.name not in self.operations:
-                    # self.operations[operation.name] = operation
-                    self.operations.append(operation)
-                # else:
-                #     print('------------------start------------------------')
-                #     print(is_already_added)
-                #     print(current_variable.name)
-                #     print(operation)
-                #     print(operation.name)
-                #     print(operation.arguments)
-                #     print('-------------------end----------------------')
-                # else:
-                #     print('------------------start------------------------')
-                #     print(is_already_added)
-                #     print(current_variable.name)
-                #     print(operation)
-                #     print(operation.name)
-                #     print(operation.arguments)
-                #     print('-------------------end----------------------')
-
-                for input_name, input in operation.arguments.items():
-                    variable_is_already_added = self.check_if_variable_is_in_list(input, total_stack)
-                    if not variable_is_already_added:
-                        stack.append(input)
-                        total_stack.append(input)
+        '''
+        Adds the operations upstream of a variable to self.operations in topological order, i.e., each operation is
+        added after the operations that compute its arguments. Operations are tracked by identity in a set, so the
+        traversal is linear in the size of the graph.
 
-        # self.operations.reverse()
+        Parameters
+        ----------
+        variable : Variable
+            The variable whose upstream operations are gathered.
+        '''
+        new_operations = self.operation_graph.add_upstream_operations(variable)
+        for operation in new_operations:
+            self.operation_ids.add(id(operation))
+            self.operations.append(operation)
 
 
     def gather_operations_implicit(self, variable:Variable):
@@ -1378,7 +1899,56 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
     #     return self.csdl_model
     
 
-    def assemble(self) -> csdl.Model:
+    def optimize(self, eliminate_common_subexpressions:bool=True, fuse_linear_operations:bool=True, 
+                 eliminate_dead_code:bool=True):
+        '''
+        Runs the graph optimization passes (common-subexpression elimination, linear operator fusion and dead-code
+        elimination) on the model.
+
+        Parameters
+        ----------
+        eliminate_common_subexpressions : bool, optional, default: True
+            If True, structurally identical operations that take the same arguments are merged.
+        fuse_linear_operations : bool, optional, default: True
+            If True, chains of MatVec, Add, Subtract, scalar Multiplication and Reshape operations are collapsed into
+            single LinearMap operations with precomputed sparse maps.
+        eliminate_dead_code : bool, optional, default: True
+            If True, operations that do not feed a registered output, constraint or objective are removed.
+
+        Returns
+        -------
+        statistics : GraphOptimizationStatistics
+            The number of operations that were merged/removed.
+        '''
+        self.graph_optimization_statistics = optimize_graph(self, eliminate_common_subexpressions=eliminate_common_subexpressions,
+                                                            fuse_linear_operations=fuse_linear_operations,
+                                                            eliminate_dead_code=eliminate_dead_code)
+        return self.graph_optimization_statistics
+
+
+    def assemble(self, incremental:bool=False, optimize:bool=False, num_workers:int=None) -> csdl.Model:
+        '''
+        Assembles the CSDL model of the operations upstream of the registered outputs.
+
+        Parameters
+        ----------
+        incremental : bool, optional, default: False
+            If True and the model was assembled before, only the newly reachable operations are gathered, hashed and
+            added (with their connections) to a copy of the previously assembled CSDL model. The previously returned
+            model is not modified. If False, the CSDL model is assembled from scratch, which also picks up changes to
+            the previously assembled operations.
+        optimize : bool, optional, default: False
+            If True, the graph optimization passes are run before assembly (see optimize()).
+        num_workers : int, optional
+            If given, the CSDL models of the operations that are not cached are computed concurrently by this many
+            threads before they are added and connected serially (see compute_csdl_models()). The assembled model is
+            the same as with the default sequential assembly.
+
+        Returns
+        -------
+        csdl_model : csdl.Model
+            The assembled CSDL model.
+        '''
         self.depth = 0
         
         # print(self.outputs.items())
@@ -1387,15 +1957,178 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
         for output_name, output in self.outputs.items():
             # print('------------------------------------------', output_name)
             self.gather_operations(output)
-        
+        if optimize:
+            self.optimize()
+        # Sort with stable tie-breaking so the assembled model does not depend on the order the outputs were registered
+        self.operations = self.operation_graph.topological_sort()
+
+        # Reuse the previously built models if the graph (or parts of it) has not changed
+        if not incremental:
+            self.operation_hashes = {}
+        new_operations = [operation for operation in self.operations if id(operation) not in self.operation_hashes]
+        compute_operation_hashes(new_operations, self.operation_hashes)
+        previous_assembly_hash = self.assembly_hash
+        self.assembly_hash = compute_assembly_hash(self.operations, self.operation_hashes, self.user_inputs, 
+                                                   self.constraints, self.objective)
+
+        # The previously returned model is extended as a copy, so neither the caller nor the cache see it change
+        extended_model = None
+        if incremental and self.can_extend_csdl_model(previous_assembly_hash) and not is_model_cached(self.assembly_hash, tag='assembly'):
+            extended_model = copy_model((self.csdl_model, self.independent_variable_names))
+
+        if extended_model is not None:
+            self.csdl_model, self.independent_variable_names = extended_model
+            new_operations = [operation for operation in self.operations if id(operation) not in self.assembled_operation_ids]
+            self.add_operations_to_csdl_model(self.csdl_model, new_operations, self.operation_hashes,
+                                              num_workers=num_workers)
+            self.add_user_inputs_to_csdl_model(self.csdl_model, 
+                                               user_inputs=self.user_inputs[len(self.assembled_user_inputs):],
+                                               constraints=self.constraints[len(self.assembled_constraints):],
+                                               objective=self.objective if self.assembled_objective is None else None)
+            cache_model(self.assembly_hash, (self.csdl_model, self.independent_variable_names), tag='assembly')
+        else:
+            self.csdl_model, self.independent_variable_names = get_cached_model(
+                self.assembly_hash, lambda: self.build_csdl_model(self.operation_hashes, num_workers=num_workers),
+                tag='assembly')
+
+        # Keep track of what was assembled for the next (incremental) assembly
+        self.assembled_operation_ids = set(self.operation_ids)
+        self.assembled_user_inputs = list(self.user_inputs)
+        self.assembled_constraints = list(self.constraints)
+        self.assembled_objective = self.objective
+        return self.csdl_model
+
+
+    def can_extend_csdl_model(self, previous_assembly_hash) -> bool:
+        '''
+        Checks if the previously assembled CSDL model can be extended with the operations, inputs, constraints and
+        objective that were added since. This is not possible if any of the previously assembled ones were removed or
+        replaced since CSDL does not support removing them.
+
+        Parameters
+        ----------
+        previous_assembly_hash : StructuralHash
+            The structural hash of the previously assembled model.
+        '''
+        if self.csdl_model is None or previous_assembly_hash is None:
+            return False
+        if not self.assembled_operation_ids.issubset(self.operation_ids):    # e.g., removed by optimize()
+            return False
+        if len(self.user_inputs) < len(self.assembled_user_inputs) or len(self.constraints) < len(self.assembled_constraints):
+            return False
+        for variable, assembled_variable in zip(self.user_inputs, self.assembled_user_inputs):
+            if variable is not assembled_variable:
+                return False
+        for variable, assembled_variable in zip(self.constraints, self.assembled_constraints):
+            if variable is not assembled_variable:
+                return False
+        if self.assembled_objective is not None and self.objective is not self.assembled_objective:
+            return False
+        for variable in self.user_inputs[len(self.assembled_user_inputs):]:
+            if variable.name in self.independent_variable_names:   # It was already created as an independent input
+                return False
+
+        # The previously assembled part must be unchanged (e.g., the values of its inputs)
+        assembled_operations = [operation for operation in self.operations if id(operation) in self.assembled_operation_ids]
+        assembled_part_hash = compute_assembly_hash(assembled_operations, self.operation_hashes, self.assembled_user_inputs, 
+                                                    self.assembled_constraints, self.assembled_objective)
+        return assembled_part_hash.digest == previous_assembly_hash.digest
+
+
+    def build_csdl_model(self, operation_hashes:dict, num_workers:int=None) -> tuple:
+        '''
+        Builds the CSDL model of the (sorted) operations of the model.
+
+        Parameters
+        ----------
+        operation_hashes : dict[int, StructuralHash]
+            The structural hashes of the operations, used to reuse their cached CSDL models.
+        num_workers : int, optional
+            The number of threads that compute the CSDL models of the operations concurrently (see assemble()).
+
+        Returns
+        -------
+        model_csdl : csdl.Model
+            The assembled CSDL model.
+        independent_variable_names : list[str]
+            The names of the top-level inputs that were created for the operation arguments.
+        '''
         model_csdl = csdl.Model()
         self.independent_variable_names = []
 
+        self.add_operations_to_csdl_model(model_csdl, self.operations, operation_hashes, num_workers=num_workers)
+        self.add_user_inputs_to_csdl_model(model_csdl, self.user_inputs, self.constraints, self.objective)
+
+        return model_csdl, self.independent_variable_names
+
+
+    def compute_csdl_models(self, operations:list, operation_hashes:dict, num_workers:int) -> dict:
+        '''
+        Computes the CSDL models of operations (compute() of the explicit and compute_derivatives() of the implicit
+        operations) that are not cached concurrently in a thread pool. The models are computed once per structural hash
+        (if the model cache is enabled) and collected in the order of the operations, so the result does not depend on
+        the order in which the workers finish. The workers are threads (not processes) so that the changes compute()
+        makes to the operations and the maps it adds to the evaluation map cache are kept, as in the sequential assembly.
+
+        Parameters
+        ----------
+        operations : list[Operation]
+            The operations whose CSDL models are computed.
+        operation_hashes : dict[int, StructuralHash]
+            The structural hashes of the operations.
+        num_workers : int
+            The maximum number of threads.
+
+        Returns
+        -------
+        csdl_models : dict[tuple, csdl.Model]
+            The computed CSDL models keyed by (id(operation), tag) with the model cache tag 'model' or 'derivatives'.
+        '''
+        tasks = {}  # task key -> [operation, method name, keys of the operations that share the model]
+        for operation in operations:
+            if issubclass(type(operation), ExplicitOperation):
+                method_name, tag = 'compute', 'model'
+            elif issubclass(type(operation), ImplicitOperation):
+                method_name, tag = 'compute_derivatives', 'derivatives'
+            else:
+                continue
+            definition_hash = operation_hashes[id(operation)].definition_hash
+            if is_model_cached(definition_hash, tag=tag):
+                continue
+            task_key = (definition_hash.digest, tag) if model_cache_options['enabled'] else (id(operation), tag)
+            tasks.setdefault(task_key, [operation, method_name, []])[2].append((id(operation), tag))
+
+        csdl_models = {}
+        if not tasks:
+            return csdl_models
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            futures = [(pool.submit(getattr(operation, method_name)), keys)
+                       for operation, method_name, keys in tasks.values()]
+            for future, keys in futures:
+                csdl_model = future.result()
+                for key in keys:
+                    csdl_models[key] = csdl_model
+        return csdl_models
+
+
+    def add_operations_to_csdl_model(self, model_csdl:csdl.Model, operations:list, operation_hashes:dict,
+                                     num_workers:int=None):
+        '''
+        Adds the CSDL models of operations (in topological order) and their connections to an assembled CSDL model. If
+        num_workers is given, the CSDL models are computed concurrently first (see compute_csdl_models()).
+        '''
+        csdl_models = {}
+        if num_workers is not None:
+            csdl_models = self.compute_csdl_models(operations, operation_hashes, num_workers)
+
         # for operation_name, operation in self.operations.items():   # Already in correct order due to recursion process
-        for operation in self.operations:
+        for operation in operations:
             operation_name = operation.name
             if issubclass(type(operation), ExplicitOperation):
-                operation_csdl = operation.compute()
+                compute = operation.compute
+                if (id(operation), 'model') in csdl_models:
+                    compute = lambda: csdl_models[(id(operation), 'model')]
+                operation_csdl = get_cached_model(operation_hashes[id(operation)].definition_hash, compute)
                 if issubclass(type(operation_csdl), csdl.Model):
                     # print(operation_name)
                     model_csdl.add(submodel=operation_csdl, name=operation_name, promotes=[]) # should I suppress promotions here-Yes?
@@ -1424,7 +2157,11 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
                                        
             if issubclass(type(operation), ImplicitOperation):
                 # TODO: also take input_jacobian
-                jacobian_csdl_model = operation.compute_derivatives()
+                compute_derivatives = operation.compute_derivatives
+                if (id(operation), 'derivatives') in csdl_models:
+                    compute_derivatives = lambda: csdl_models[(id(operation), 'derivatives')]
+                jacobian_csdl_model = get_cached_model(operation_hashes[id(operation)].definition_hash, compute_derivatives, 
+                                                       tag='derivatives')
                 if issubclass(type(jacobian_csdl_model), csdl.Model):
                 # if type(jacobian_csdl_model) is csdl.Model:
                     model_csdl.add(submodel=jacobian_csdl_model, name=operation_name, promotes=[]) # should I suppress promotions here?
@@ -1434,12 +2171,15 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
                 for input_name, input in operation.arguments.items():
                     if input.operation is not None and input is not None:
                         model_csdl.connect(input.operation.name+"."+input.name, operation_name+"."+input_name) # when not promoting
-                for key, value in operation.residual_partials.items():
-                    model_csdl.add(submodel=Eig(size=operation.size), name=operation.name + '_' + key + '_eig', promotes=[])
-                    
-                    model_csdl.connect(operation_name + '.' + key, operation.name + '_' + key + '_eig' + '.A')
+                self.add_eigenvalue_models(model_csdl, operation)
+
+
+    def add_user_inputs_to_csdl_model(self, model_csdl:csdl.Model, user_inputs:list, constraints:list, objective:Variable):
+        '''
+        Adds user-defined inputs, design variables, constraints and the objective to an assembled CSDL model.
+        '''
         # Create any user-defined inputs
-        for input in self.user_inputs:
+        for input in user_inputs:
             var_name = input.name
             var_val = input.value
             var_shape = input.shape
@@ -1455,7 +2195,7 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
 
         
         # Add constraints and objective
-        for var in self.constraints:
+        for var in constraints:
             var_name = var.name
             lower = var.lower
             upper = var.upper
@@ -1466,15 +2206,68 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
 
             model_csdl.add_constraint(name=f"{operation_name}.{var_name}", lower=lower, upper=upper, equals=equals, scaler=scaler)
 
-        if self.objective:
-            var_name = self.objective.name
-            scaler = self.objective.scaler
-            operation = self.objective.operation
-            operation_name = self.objective.operation.name
+        if objective:
+            var_name = objective.name
+            scaler = objective.scaler
+            operation = objective.operation
+            operation_name = objective.operation.name
             model_csdl.add_objective(name=f"{operation_name}.{var_name}", scaler=scaler)
 
-        self.csdl_model = model_csdl
-        return self.csdl_model
+    def add_eigenvalue_models(self, model_csdl:csdl.Model, operation, batched_partials:dict=None):
+        '''
+        Adds the eigenvalue models of the residual partials of an implicit operation to a modal CSDL model.
+
+        If the operation sets modal_matrices to the keys of its stiffness and mass residual partials, the lowest
+        num_modes modes of the generalized eigenproblem K v = w M v are computed from the sparse K and M directly (with
+        outputs 'eigenvalues' and 'eigenvectors'). Every other residual partial gets a standard eigenvalue model of the
+        num_modes eigenvalues closest to modal_shift (or of all eigenvalues if num_modes is not set). If batched_partials
+        is given, the full-spectrum partials are instead added to batched_partials[size] as (operation name, key)
+        tuples so that they can be added to a batched eigenvalue model (see add_batched_eigenvalue_models).
+        '''
+        operation_name = operation.name
+        modal_matrices = operation.modal_matrices
+        if modal_matrices is not None:
+            stiffness_key, mass_key = modal_matrices
+            eig_name = operation_name + '_' + stiffness_key + '_' + mass_key + '_eig'
+            model_csdl.add(submodel=GeneralizedEig(size=operation.size, num_eigenvalues=operation.num_modes,
+                                                   sigma=operation.modal_shift,
+                                                   sparsity_pattern=operation.modal_sparsity_pattern),
+                           name=eig_name, promotes=[])
+            model_csdl.connect(operation_name + '.' + stiffness_key, eig_name + '.K')
+            model_csdl.connect(operation_name + '.' + mass_key, eig_name + '.M')
+
+        for key, value in operation.residual_partials.items():
+            if modal_matrices is not None and key in modal_matrices:
+                continue
+            if batched_partials is not None and operation.num_modes is None:
+                batched_partials.setdefault(operation.size, []).append((operation_name, key))
+                continue
+            model_csdl.add(submodel=Eig(size=operation.size, num_eigenvalues=operation.num_modes,
+                                        sigma=operation.modal_shift),
+                           name=operation_name + '_' + key + '_eig', promotes=[])
+
+            model_csdl.connect(operation_name + '.' + key, operation_name + '_' + key + '_eig' + '.A')
+
+    def add_batched_eigenvalue_models(self, model_csdl:csdl.Model, batched_partials:dict, num_workers:int=None):
+        '''
+        Adds one batched eigenvalue model per matrix size to a modal CSDL model, which stacks the residual partials of
+        that size (in the order they were added) and computes all of their eigenvalues with one operation. The
+        (num_partials, size) eigenvalues are the outputs 'e_real' and 'e_imag' of the model 'batched_eig_<size>'.
+
+        Parameters
+        ----------
+        batched_partials : dict[int, list[tuple]]
+            The (operation name, key) tuples of the residual partials of each size.
+        num_workers : int, optional
+            The number of threads that each batch of eigenvalue problems is split over.
+        '''
+        for size, partials in batched_partials.items():
+            eig_name = f'batched_eig_{size}'
+            input_names = [operation_name + '_' + key for operation_name, key in partials]
+            model_csdl.add(submodel=BatchedEig(num_nodes=len(partials), size=size, input_names=input_names,
+                                               num_workers=num_workers), name=eig_name, promotes=[])
+            for (operation_name, key), input_name in zip(partials, input_names):
+                model_csdl.connect(operation_name + '.' + key, eig_name + '.' + input_name)
 
 
     def assemble_csdl(self) -> csdl.Model:
@@ -1486,10 +2279,12 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
     def assemble_derivative_model(self) -> csdl.Model:
         for output_name, output in self.outputs.items():
             self.gather_operations(output)
+        self.operations = self.operation_graph.topological_sort()
         
         derivative_model_csdl = csdl.Model()
 
-        for operation_name, operation in self.operations.items():   # Already in correct order due to recursion process
+        for operation in self.operations:
+            operation_name = operation.name
             if issubclass(type(operation), ExplicitOperation):
                 derivative_operation_csdl = operation.compute_derivatives()
                 if derivative_operation_csdl is not None:
@@ -1622,17 +2417,31 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
 
         return RunModel
 
-    def assemble_modal(self) -> csdl.Model:
+    def assemble_modal(self, batch_eigenvalues:bool=False, num_workers:int=None) -> csdl.Model:
+        '''
+        Assembles a CSDL model that computes the eigenvalues of the residual partials of the implicit operations.
+
+        Parameters
+        ----------
+        batch_eigenvalues : bool, optional, default: False
+            If True, the eigenvalues of all of the residual partials of the same size are computed with one batched
+            eigenvalue model (see add_batched_eigenvalue_models) instead of one model per residual partial.
+        num_workers : int, optional
+            The number of threads that each batch of eigenvalue problems is split over.
+        '''
             # Assemble output states'output_jacobian_name'
         # Assemble output states
         for output_name, output in self.outputs.items():
             self.gather_operations(output)
+        self.operations = self.operation_graph.topological_sort()
         
         model_csdl = csdl.Model()
         output_jacobian_names = []
         output_jacobian_vars = []
+        batched_partials = {} if batch_eigenvalues else None
 
-        for operation_name, operation in self.operations.items():   # Already in correct order due to recursion process
+        for operation in self.operations:
+            operation_name = operation.name
             if issubclass(type(operation), ExplicitOperation):
                 operation_csdl = operation.compute()
 
@@ -1658,10 +2467,9 @@ class Model:   # Implicit (or not implicit?) model groups should be an instance
                 for input_name, input in operation.arguments.items():
                     if input.operation is not None and input is not None:
                         model_csdl.connect(input.operation.name+"."+input.name, operation_name+"."+input_name) # when not promoting
-                for key, value in operation.residual_partials.items():
-                    model_csdl.add(submodel=Eig(size=operation.size), name=operation.name + '_' + key + '_eig', promotes=[])
-                    
-                    model_csdl.connect(operation_name + '.' + key, operation.name + '_' + key + '_eig' + '.A')
+                self.add_eigenvalue_models(model_csdl, operation, batched_partials=batched_partials)
+        if batch_eigenvalues:
+            self.add_batched_eigenvalue_models(model_csdl, batched_partials, num_workers=num_workers)
         self.modal_csdl_model = model_csdl
         return self.modal_csdl_model
 
@@ -1849,12 +2657,14 @@ class StructuralModalModel(Model):
         # Assemble output states
         for output_name, output in self.outputs.items():
             self.gather_operations(output)
+        self.operations = self.operation_graph.topological_sort()
         
         model_csdl = csdl.Model()
         output_jacobian_names = []
         output_jacobian_vars = []
 
-        for operation_name, operation in self.operations.items():   # Already in correct order due to recursion process
+        for operation in self.operations:
+            operation_name = operation.name
             if issubclass(type(operation), ExplicitOperation):
                 operation_csdl = operation.compute()
 
@@ -1878,9 +2688,6 @@ class StructuralModalModel(Model):
                 for input_name, input in operation.arguments.items():
                     if input.operation is not None and input is not None:
                         model_csdl.connect(input.operation.name+"."+input.name, operation_name+"."+input_name) # when not promoting
-                for key, value in operation.residual_partials.items():
-                    model_csdl.add(submodel=Eig(size=operation.size), name=operation.name + '_' + key + '_eig', promotes=[])
-                    
-                    model_csdl.connect(operation_name + '.' + key, operation.name + '_' + key + '_eig' + '.A')
+                self.add_eigenvalue_models(model_csdl, operation)
         self.csdl_model = model_csdl
         return self.csdl_model
\ No newline at end of file
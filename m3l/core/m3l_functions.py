@@ -7,9 +7,11 @@ def copy(x : Variable):
     """
     Performs a deep copy of an m3l variable
     """
-    copy_var = Variable(name=x.name, shape=x.shape, operation=x.operation, value=x.value,
+    # NOTE: x._value is used so copying a lazily evaluated variable does not force its evaluation
+    copy_var = Variable(name=x.name, shape=x.shape, operation=x.operation, value=x._value,
                         dv_flag=x.dv_flag, lower=x.lower, upper=x.upper, scaler=x.scaler,
                         equals=x.equals)
+    copy_var.lazy_evaluation = x.lazy_evaluation
     # copy_var = Variable(shape=x.shape, operation=x.operation, value=x.value,
     #                     dv_flag=x.dv_flag, lower=x.lower, upper=x.upper, scaler=x.scaler,
     #                     equals=x.equals)  # Threw an error.
@@ -199,9 +201,10 @@ def vstack(x1 : Variable, x2: Variable):
 
 
 def linear_combination(start : Variable, stop : Variable, num_steps:int=50, 
-                       start_weights:np.ndarray=None, stop_weights:np.ndarray=None) -> Variable:
+                       start_weights:np.ndarray=None, stop_weights:np.ndarray=None, fused:bool=False) -> Variable:
     """
     Performs a linear combination of two m3l variables. The linear combination is defined as:
+    output[i] = start_weights[i]*start + stop_weights[i]*stop
 
     Parameters:
     ----------
@@ -212,31 +215,34 @@ def linear_combination(start : Variable, stop : Variable, num_steps:int=50,
     num_steps : int (default = 50)
         The number of steps in the linear combination
     start_weights : np.ndarray (default = None)
-        The weights for the starting m3l variable
+        The weights for the starting m3l variable. If no weights are given, the steps are spaced linearly.
     stop_weights : np.ndarray (default = None)
         The weights for the stopping m3l variable
+    fused : bool (default = False)
+        If True, the linear combination is computed by a single LinearMap operation instead of two MatVecs, an Add and
+        a Reshape.
     """
     if num_steps is not None and start_weights is None and stop_weights is None:
-            linspace(start, stop, num_steps)
-
-    if len(start.shape) == 1:
-        num_per_step = start.shape[0]
-    else:
-        num_per_step = np.prod(start.shape)
+        if num_steps == 1:
+            stop_weights = np.array([0.5])
+        else:
+            stop_weights = np.arange(num_steps)/(num_steps-1)
+        start_weights = 1 - stop_weights
 
-    map_num_outputs = num_steps*num_per_step
-    map_num_inputs = num_per_step
-    map_start = sps.lil_matrix((map_num_outputs, map_num_inputs))
-    map_stop = sps.lil_matrix((map_num_outputs, map_num_inputs))
-    for i in range(num_steps):
-        start_step_map = (sps.eye(num_per_step)) * start_weights[i]
-        map_start[i*num_per_step:(i+1)*num_per_step, :] = start_step_map
+    start_weights = np.asarray(start_weights, dtype=float).reshape((-1,))
+    stop_weights = np.asarray(stop_weights, dtype=float).reshape((-1,))
+    num_steps = start_weights.shape[0]
+    num_per_step = int(np.prod(start.shape))
 
-        stop_step_map = (sps.eye(num_per_step)) * stop_weights[i]
-        map_stop[i*num_per_step:(i+1)*num_per_step, :] = stop_step_map
+    # Each step is a weighted identity block, i.e., map = weights (x) I
+    identity = sps.identity(num_per_step, format='csc')
+    map_start = sps.kron(start_weights.reshape((-1, 1)), identity, format='csc')
+    map_stop = sps.kron(stop_weights.reshape((-1, 1)), identity, format='csc')
 
-    map_start = map_start.tocsc()
-    map_stop = map_stop.tocsc()
+    output_shape = (num_steps,) + tuple(start.shape)
+    if fused:
+        linear_map_operation = LinearMap(maps=[map_start, map_stop])
+        return linear_map_operation.evaluate(arguments=[start, stop], shape=output_shape)
 
     flattened_start = start.reshape((num_per_step,))
     flattened_stop = stop.reshape((num_per_step,))
@@ -245,13 +251,13 @@ def linear_combination(start : Variable, stop : Variable, num_steps:int=50,
 
     flattened_output = mapped_start_array + mapped_stop_array
 
-    output = flattened_output.reshape((num_steps,) + tuple(start.shape))
+    output = flattened_output.reshape(output_shape)
     # output.name = f'{start.name}_to_{stop.name}_linear_combination'
 
     return output
 
 
-def linspace(start:Variable, stop:Variable, num_steps:int=50) -> Variable:
+def linspace(start:Variable, stop:Variable, num_steps:int=50, fused:bool=False) -> Variable:
     """
     Performs a linear combination of two m3l variables. The linear combination is defined as:
 
@@ -263,6 +269,8 @@ def linspace(start:Variable, stop:Variable, num_steps:int=50) -> Variable:
         The stopping m3l variable
     num_steps : int (default = 50)
         The number of steps in the linear combination
+    fused : bool (default = False)
+        If True, the linear combination is computed by a single LinearMap operation.
     """
     if num_steps == 1:
         stop_weights = np.array([0.5])
@@ -271,7 +279,7 @@ def linspace(start:Variable, stop:Variable, num_steps:int=50) -> Variable:
     start_weights = 1 - stop_weights
 
     return linear_combination(start=start, stop=stop, num_steps=num_steps, 
-                              start_weights=start_weights, stop_weights=stop_weights)
+                              start_weights=start_weights, stop_weights=stop_weights, fused=fused)
 
 
 def matvec(map : sps.csc_matrix, x : Variable):
@@ -300,80 +308,40 @@ def rotate(points:Variable, axis_origin:Variable, axis_vector:Variable, angles:V
     return rotation_operation.evaluate(points=points, axis_origin=axis_origin, axis_vector=axis_vector, angles=angles)
 
 
-def variable_get_item(x:Variable, indices:np.ndarray):
+def variable_get_item(x:Variable, indices):
     """
     Performs indexing of an m3l variable
-    """
-    # original_shape = x.shape
-    # if len(x.shape) > 1:
-    #     x_flat = x.reshape((np.prod(x.shape),))
-    # else:
-    #     x_flat = x
-
-    map_num_outputs = indices.shape[0]
-    map_num_inputs = x.shape[0]
-    # map = sps.lil_matrix((map_num_outputs, map_num_inputs))
-    # for i in range(map_num_outputs):
-    #     map[i, indices[i]] = 1
-    map = sps.coo_matrix((np.ones((map_num_outputs,)), (np.arange(map_num_outputs), indices)),
-                            shape=(map_num_outputs, map_num_inputs))
-
-    map = map.tocsc()
-
-    if len(x.shape) == 1:
-        indexed_x = matvec(map=map, x=x.copy())
-    else:
-        indexed_x = matmat(map=map, x=x.copy())
 
-    # if len(x.shape) > 1:
-    #     index_x = index_x_flat.reshape(original_shape)
-    # else:
-    #     index_x = index_x_flat
+    Parameters:
+    ----------
+    x : Variable
+        The m3l variable to be indexed
+    indices : int, slice, np.ndarray, list or tuple
+        The indices (as in NumPy), e.g., integer arrays, slices or boolean masks on any axis
+    """
+    get_item_operation = GetItem(indices=indices)
 
-    return indexed_x
+    return get_item_operation.evaluate(x=x.copy())
 
 
-def variable_set_item(x:Variable, indices:np.ndarray, value:Variable):
+def variable_set_item(x:Variable, indices, value:Variable):
     """
     Performs indexing/assignment of an m3l variable
+
+    Parameters:
+    ----------
+    x : Variable
+        The m3l variable to be assigned to
+    indices : int, slice, np.ndarray, list or tuple
+        The indices (as in NumPy), e.g., integer arrays, slices or boolean masks on any axis
+    value : Variable, np.ndarray, float or int
+        The values that are assigned to the indexed entries
     """
-    # original_shape = x.shape
-    # if len(x.shape) > 1:
-    #     x_flat = x.reshape((np.prod(x.shape),))
-    # else:
-    #     x_flat = x
-
-    import m3l
-
-    # updated component
-    map_num_outputs = x.shape[0]
-    map_num_inputs = indices.shape[0]
-    # map = sps.lil_matrix((map_num_outputs, map_num_inputs))
-    # for i in range(indices.shape[0]):
-    #     index = indices[i]
-    #     map[index, i] = 1
-    map = sps.coo_matrix((np.ones((map_num_inputs,)), (indices, np.arange(map_num_inputs))),
-                            shape=(map_num_outputs, map_num_inputs))
-    map = map.tocsc()
-    x_updated = matvec(map=map, x=value)
-
-    # unchanged component
-    data = np.ones((x.shape[0] - indices.shape[0],))
-    unchanged_indices = np.delete(np.arange(x.shape[0]), indices)
-    unchanged_indexing_map = sps.coo_matrix((data, (unchanged_indices, unchanged_indices)),
-                                shape=(x.shape[0], x.shape[0]))
-    unchanged_indexing_map = unchanged_indexing_map.tocsc()
-    # x_unchanged = matvec(map=unchanged_indexing_map, x=x)
-    x_unchanged = matvec(map=unchanged_indexing_map, x=x.copy())
-
-    new_x = x_updated + x_unchanged
-
-    # if len(x.shape) > 1:
-    #     index_x = index_x_flat.reshape(original_shape)
-    # else:
-    #     index_x = index_x_flat
-
-    return new_x
+    set_item_operation = SetItem(indices=indices)
+
+    # NOTE: x is copied so the operation does not reference x after x is re-pointed by Variable.__setitem__
+    return set_item_operation.evaluate(x=x.copy(), value=value)
+
 
 def check_if_variable_is_upstream(variable:Variable, upstream_variable:Variable):
     """
@@ -439,76 +407,30 @@ def check_if_variable_is_in_list(variable:Variable, variable_list:list):
 #             continue
 
 def compute_mapping_from_upstream_variable(variable:Variable, upstream_variable:Variable):
-    from m3l.core.m3l_standard_operations import MatVec
-    from m3l.core.m3l_standard_operations import Add
-    from m3l.core.m3l_standard_operations import Subtract
-    from m3l.core.m3l_standard_operations import Multiplication
-    from m3l.core.m3l_standard_operations import Division
-
-    current_map = None
-
-    # if variable is upstream_variable:
-    if variable == upstream_variable:
-        return sps.eye(variable.shape[0])
-
-    if variable.operation is not None:
-        operation = variable.operation
-        # input_upstream_maps = []
-        if type(operation) is MatVec:
-            upstream_map = compute_mapping_from_upstream_variable(operation.arguments['x'], upstream_variable)
-            if upstream_map is None:
-                return None
-            current_map = operation.map.dot(upstream_map)
-        elif type(operation) is Add:
-            current_map = None
-            for input_name, input in operation.arguments.items():
-                upstream_map = compute_mapping_from_upstream_variable(input, upstream_variable)
-                if upstream_map is None:
-                    continue
-                if current_map is None:
-                    current_map = upstream_map
-                else:
-                    current_map += upstream_map
-        elif type(operation) is Subtract:
-            current_map = None
-            counter = 0
-            for input_name, input in operation.arguments.items():
-                upstream_map = compute_mapping_from_upstream_variable(input, upstream_variable)
-                if upstream_map is None:
-                    counter += 1
-                    continue
-                if current_map is None:
-                    if counter == 0:
-                        current_map = upstream_map
-                    else:   # counter = 1
-                        current_map = -upstream_map
-                else:
-                    current_map -= upstream_map  # The second argument is always the subtracted one!
-                counter += 1
-        elif type(operation) is Multiplication:
-            upstream_map = compute_mapping_from_upstream_variable(operation.arguments['x1'], upstream_variable)
-            if upstream_map is None:
-                return None
-            for input_name, input in operation.arguments.items():
-                if input.operation is None:
-                    constant_term = input.value
-                else:
-                    upstream_map = compute_mapping_from_upstream_variable(input, upstream_variable)
-            current_map = upstream_map * constant_term
-        elif type(operation) is Division:
-            upstream_map = compute_mapping_from_upstream_variable(operation.arguments['x1'], upstream_variable)
-            if upstream_map is None:
-                return None
-            for input_name, input in operation.arguments.items():
-                if input.operation is None:
-                    constant_term = input.value
-                else:
-                    upstream_map = compute_mapping_from_upstream_variable(input, upstream_variable)
-            current_map = upstream_map / constant_term
-        else:
-            return None
-            # raise Exception(f'The manually computed maps for the parameterization solver does not support graphs with operation type: {type(operation)}')
-    else:
+    """
+    Computes the (sparse) map from an upstream variable to a downstream variable through the linear operations
+    (MatVec, Add, Subtract, Reshape, LinearMap and multiplication/division by constants) between them. Top-level inputs
+    other than the upstream variable are treated as constants. Returns None if the variable does not depend linearly
+    on the upstream variable.
+    """
+    from m3l.core.graph_optimization import get_linear_terms, compose_linear_expression, get_variable_key
+
+    if variable is upstream_variable:
+        return sps.eye(np.prod(variable.shape))
+    if variable.operation is None:
+        return None
+
+    def is_constant(input):
+        return input.operation is None and input is not upstream_variable
+
+    def is_frontier(input):
+        return input is upstream_variable or input.operation is None or get_linear_terms(input.operation, is_constant) is None
+
+    if get_linear_terms(variable.operation, is_constant) is None:
         return None
 
-    return current_map
\ No newline at end of file
+    terms, offset = compose_linear_expression(variable.operation, is_frontier, is_constant)
+    upstream_key = get_variable_key(upstream_variable)
+    if upstream_key not in terms:
+        return None
+    return terms[upstream_key][1]
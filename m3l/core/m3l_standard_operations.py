@@ -2,6 +2,8 @@ import csdl
 from m3l.core.m3l_classes import ExplicitOperation, Variable
 import numpy as np
 import scipy.sparse as sps
+from m3l.core.in_line_evaluation import evaluate_in_line
+from m3l.core.csdl_operations import RotationExplicit, rotate_points
 from m3l.utils.utility_functions import replace_periods_with_underscores, generate_random_string
 from python_csdl_backend import Simulator
 
@@ -30,8 +32,15 @@ class Norm(ExplicitOperation):
             y = csdl.pnorm(x_csdl, pnorm_type=order, axis=axes)
         csdl_model.register_output(name=self.output_name, var=y)
         self.csdl_model = csdl_model
-        self.sim = Simulator(csdl_model)
         return csdl_model
+
+    def compute_in_line(self):
+        x = self.arguments['x'].value
+        p = self.order
+        if len(x.shape) == len(self.axes):
+            return np.sum(np.abs(x)**p)**(1/p)
+        else:
+            return np.sum(np.abs(x)**p, axis=self.axes)**(1/p)
     
     def compute_derivatives(self): # Really this is compute 2nd derivatives 
         norm_derivative_model = csdl.Model()
@@ -82,13 +91,8 @@ class Norm(ExplicitOperation):
         self.output_name = norm.name
 
 
-        # create csdl model for in-line evaluations
-        if x.value is not None:
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x'] = x.value
-            sim.run()
-            norm.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, norm)
 
         return norm
 
@@ -112,6 +116,10 @@ class Cos(ExplicitOperation):
 
         return csdl_model
 
+    def compute_in_line(self):
+        x = self.arguments['x'].value
+        return np.cos(x)
+
     def evaluate(self, x : Variable):
         self.name = f"{x.name}_cos_operation"
         
@@ -123,12 +131,8 @@ class Cos(ExplicitOperation):
         self.output_name = output.name
         
 
-        if x.value is not None:
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim['x'] = x.value
-            sim.run()
-            output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
 
         return output
 
@@ -151,6 +155,10 @@ class Sin(ExplicitOperation):
         csdl_model.register_output(self.output_name, sin_output)
         return csdl_model
 
+    def compute_in_line(self):
+        x = self.arguments['x'].value
+        return np.sin(x)
+
     def evaluate(self, x : Variable):
         self.name = f"{x.name}_sin_operation"
         self.arguments = {
@@ -160,12 +168,8 @@ class Sin(ExplicitOperation):
         output = Variable(shape=x.shape, operation=self)
         self.output_name = output.name
 
-        if x.value is not None:
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim['x'] = x.value
-            sim.run()
-            output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
 
         return output
     
@@ -187,22 +191,21 @@ class ArcCos(ExplicitOperation):
         csdl_model.register_output(self.output_name, arccos_output)
         return csdl_model
 
+    def compute_in_line(self):
+        x = self.arguments['x'].value
+        return np.arccos(x)
+
     def evaluate(self, x : Variable):
         self.name = f"{x.name}_arccos_operation"
-        
-
-        output = Variable(shape=x.shape, operation=self)
-        self.output_name = output.name
         self.arguments = {
             f'x' : x,
         }
 
-        if x.value is not None:
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x'] = x.value
-            sim.run()
-            output.value = sim[self.output_name]
+        output = Variable(shape=x.shape, operation=self)
+        self.output_name = output.name
+
+        # in-line evaluation
+        evaluate_in_line(self, output)
 
         return output
 
@@ -225,6 +228,10 @@ class ArcSin(ExplicitOperation):
         csdl_model.register_output(self.output_name, arcsin_output)
         return csdl_model
 
+    def compute_in_line(self):
+        x = self.arguments['x'].value
+        return np.arcsin(x)
+
     def evaluate(self, x : Variable):
         self.name = f"{x.name}_arcsin_operation"
         self.arguments = {
@@ -234,17 +241,15 @@ class ArcSin(ExplicitOperation):
         output = Variable(shape=x.shape, operation=self)
         self.output_name = output.name
 
-        if x.value is not None:
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim['x'] = x.value
-            sim.run()
-            output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
 
         return output
 
 
 class Dot(ExplicitOperation):
+    definition_attributes = ExplicitOperation.definition_attributes + ('axis',)
+
     def initialize(self, kwargs):
         self.parameters.declare('name', default='dot_operation', types=str)
 
@@ -265,6 +270,14 @@ class Dot(ExplicitOperation):
         csdl_model.register_output(self.output_name, dot)
 
         return csdl_model
+
+    def compute_in_line(self):
+        x1 = self.arguments['x1'].value
+        x2 = self.arguments['x2'].value
+        if self.axis is None:
+            return np.sum(x1*x2)
+        else:
+            return np.sum(x1*x2, axis=self.axis)
     
     def compute_derivates(self):
         # TODO: Come back and implement this!
@@ -284,21 +297,16 @@ class Dot(ExplicitOperation):
         else:
             new_shape = (1, )
 
-        output = Variable(shape=new_shape, operation=self)
-        self.output_name = output.name
-        
         self.arguments = {
             f'x1' : x1,
             f'x2' : x2,
         }
-        
-        if (x1.value is not None) and (x2.value is not None):
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x1'] = x1.value
-            sim[f'x2'] = x2.value
-            sim.run()
-            output.value = sim[self.output_name]
+
+        output = Variable(shape=new_shape, operation=self)
+        self.output_name = output.name
+
+        # in-line evaluation
+        evaluate_in_line(self, output)
 
         return output
 
@@ -323,26 +331,33 @@ class Expand(ExplicitOperation):
 
         return csdl_model
 
+    def compute_in_line(self):
+        x = self.arguments['x'].value
+        if self.indices is None:
+            return np.broadcast_to(x.reshape(()), self.new_shape).copy()
+
+        # Move the existing axes into their output order and broadcast along the new ones
+        input_indices, output_indices = self.indices.split('->')
+        transposed_x = np.transpose(x, [input_indices.index(index) for index in output_indices if index in input_indices])
+        broadcastable_shape = tuple(size if index in input_indices else 1 for index, size in zip(output_indices, self.new_shape))
+        return np.broadcast_to(transposed_x.reshape(broadcastable_shape), self.new_shape).copy()
+
     def evaluate(self, x : Variable):
         self.name = f'{x.name}_expand_operation'
-
+        self.arguments = {f'x' : x}
 
         output = Variable(shape=self.new_shape, operation=self)
         self.output_name = output.name
-        self.arguments = {f'x' : x}
-
 
-        if x.value is not None:
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x'] = x.value
-            sim.run()
-            output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
 
         return output
 
 
 class Power(ExplicitOperation):
+    definition_attributes = ExplicitOperation.definition_attributes + ('scalers',)
+
     def initialize(self, kwargs):
         self.parameters.declare('name', default='to_the_power_operation', types=str)
 
@@ -363,6 +378,11 @@ class Power(ExplicitOperation):
 
         return csdl_model
 
+    def compute_in_line(self):
+        x1 = self.arguments['x1'].value
+        x2 = self.scalers['x2']
+        return x1**x2
+
     def evaluate(self, x1 : Variable, x2 : Variable):
         random_name = generate_random_string()
         self.name = f'{x1.name}_to_the_power_operation_{random_name}'
@@ -381,9 +401,14 @@ class Power(ExplicitOperation):
             output = Variable(shape=x1.shape, operation=self)
             self.output_name = output.name
 
+            # in-line evaluation
+            evaluate_in_line(self, output)
+
             return output
 
 class Subtract(ExplicitOperation):
+    definition_attributes = ExplicitOperation.definition_attributes + ('scalers',)
+
     def initialize(self, kwargs):
         self.parameters.declare('name', default='subtraction_operation', types=str)
 
@@ -431,6 +456,17 @@ class Subtract(ExplicitOperation):
         
         return csdl_model
 
+    def compute_in_line(self):
+        scalers = self.scalers
+        arguments = self.arguments
+
+        if 'x1' in scalers:
+            return scalers['x1'] - arguments['x2'].value
+        elif 'x2' in scalers:
+            return arguments['x1'].value - scalers['x2']
+        else:
+            return arguments['x1'].value - arguments['x2'].value
+
     def evaluate(self, x1 : Variable, x2 : Variable):
         random_name = generate_random_string()
         if isinstance(x1, (float, int)):
@@ -447,13 +483,8 @@ class Subtract(ExplicitOperation):
             # self.arguments[f'x2'] = x2
             
             # NOTE: in-line evaluations only work if all solver developers implement them
-            # create csdl model for in-line evaluations
-            if x2.value is not None:
-                operation_csdl = self.compute()
-                sim = Simulator(operation_csdl)
-                sim[f'x2'] = x2.value
-                sim.run()
-                output.value = sim[self.output_name]
+            # in-line evaluation
+            evaluate_in_line(self, output)
 
         elif isinstance(x2, (float, int)):
             self.name = f'{x1.name}_minus_scaler_operation_{random_name}'
@@ -467,13 +498,8 @@ class Subtract(ExplicitOperation):
             # self.scalers[f'x2'] = x2
             # self.arguments[f'x1'] = x1
 
-            # create csdl model for in-line evaluations
-            if x1.value is not None:
-                operation_csdl = self.compute()
-                sim = Simulator(operation_csdl)
-                sim[f'x1'] = x1.value
-                sim.run()
-                output.value = sim[self.output_name]
+            # in-line evaluation
+            evaluate_in_line(self, output)
         
         else:
             self.name = f'{x1.name}_minus_{x2.name}_operation_{random_name}'
@@ -487,16 +513,8 @@ class Subtract(ExplicitOperation):
             # self.arguments[f'{self.output_name}_x1'] = x1
             # self.arguments[f'{self.output_name}_x2'] = x2
 
-            # create csdl model for in-line evaluations
-            if (x1.value is not None) and (x2.value is not None):
-                operation_csdl = self.compute()
-                sim = Simulator(operation_csdl)
-                # sim[f'{self.output_name}_x1'] = x1.value
-                # sim[f'{self.output_name}_x2'] = x2.value
-                sim[f'x1'] = x1.value
-                sim[f'x2'] = x2.value
-                sim.run()
-                output.value = sim[self.output_name]
+            # in-line evaluation
+            evaluate_in_line(self, output)
 
         
         return output
@@ -529,6 +547,9 @@ class Add(ExplicitOperation):
         csdl_model.register_output(name=self.output_name, var=y)
         return csdl_model
 
+    def compute_in_line(self):
+        return self.arguments['x1'].value + self.arguments['x2'].value
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -568,14 +589,8 @@ class Add(ExplicitOperation):
         output = Variable(shape=x1.shape, operation=self)
         self.output_name = output.name
         # Define operation arguments
-        # create csdl model for in-line evaluations
-        if (x1.value is not None) and (x2.value is not None):
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x1'] = x1.value
-            sim[f'x2'] = x2.value
-            sim.run()
-            output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
 
         return output
 
@@ -584,6 +599,8 @@ class Multiplication(ExplicitOperation):
     """
     Multiplcation class. Subclass of M3Ls ExplicitOperation 
     """
+    definition_attributes = ExplicitOperation.definition_attributes + ('scalers',)
+
     def initialize(self, kwargs):
         self.parameters.declare('name', types=str, default='multiplication_operation')
 
@@ -620,6 +637,17 @@ class Multiplication(ExplicitOperation):
             csdl_model.register_output(name=self.output_name, var=y)
 
         return csdl_model
+
+    def compute_in_line(self):
+        scalers = self.scalers
+        arguments = self.arguments
+
+        if 'x1' in scalers:
+            return scalers['x1'] * arguments['x2'].value
+        elif 'x2' in scalers:
+            return arguments['x1'].value * scalers['x2']
+        else:
+            return arguments['x1'].value * arguments['x2'].value
     
     def evaluate(self, x1 : Variable, x2 : Variable) -> Variable:
         random_name = generate_random_string()
@@ -635,12 +663,8 @@ class Multiplication(ExplicitOperation):
             
 
             # NOTE: in-line evaluations only work if all solver developers implement them
-            # create csdl model for in-line evaluations
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x2'] = x2.value
-            sim.run()
-            output.value = sim[self.output_name]
+            # in-line evaluation
+            evaluate_in_line(self, output)
 
         elif isinstance(x2, (float, int)):
             self.name = f'{x1.name}_times_scaler_operation_{random_name}'
@@ -652,12 +676,8 @@ class Multiplication(ExplicitOperation):
             output = Variable(shape=x1.shape, operation=self)
             self.output_name = output.name
             
-            # create csdl model for in-line evaluations
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x1'] = x1.value
-            sim.run()
-            output.value = sim[self.output_name]
+            # in-line evaluation
+            evaluate_in_line(self, output)
         
         else:
             self.name = f'{x1.name}_times_{x2.name}_operation_{random_name}'
@@ -669,13 +689,8 @@ class Multiplication(ExplicitOperation):
             output = Variable(shape=x1.shape, operation=self)
             self.output_name = output.name
 
-            # create csdl model for in-line evaluations
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x1'] = x1.value
-            sim[f'x2'] = x2.value
-            sim.run()
-            output.value = sim[self.output_name]
+            # in-line evaluation
+            evaluate_in_line(self, output)
 
         return output
 
@@ -709,6 +724,9 @@ class Division(ExplicitOperation):
         
         csdl_model.register_output(name=self.output_name, var=y)
         return csdl_model
+
+    def compute_in_line(self):
+        return self.arguments['x1'].value / self.arguments['x2'].value
     
     def evaluate(self, x1 : Variable, x2 : Variable) -> Variable:
         self.name = f'{x1.name}_division_{x2.name}_operation'
@@ -719,14 +737,8 @@ class Division(ExplicitOperation):
         output = Variable(shape=x1.shape, operation=self)
         self.output_name = output.name
 
-        if (x1.value is not None) and (x2.value is not None):
-            # create csdl model for in-line evaluations
-            operation_csdl = self.compute()
-            sim = Simulator(operation_csdl)
-            sim[f'x1'] = x1.value
-            sim[f'x2'] = x2.value
-            sim.run()
-            output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
         return output
     
 
@@ -734,6 +746,8 @@ class Reshape(ExplicitOperation):
     '''
     Reshapes the variable to a new shape.
     '''
+    definition_attributes = ExplicitOperation.definition_attributes + ('shape',)
+
     def initialize(self, kwargs):
         self.parameters.declare('shape', types=tuple)
         self.parameters.declare('name', types=str, default='reshape_operation')
@@ -755,22 +769,15 @@ class Reshape(ExplicitOperation):
 
         operation_csdl = csdl.Model()
         x_csdl = operation_csdl.declare_variable(name='x', shape=x.shape)
-        
-        size = np.prod(x.value.shape)
-        new_shape = list(shape)
-        for i in range(len(shape)):
-            if shape[i] == -1:
-                size_others = np.prod(shape)/(-1)
-                new_shape[i] = int(size/size_others)
-                break
-        shape = tuple(new_shape)
-        self.shape = shape
         x_reshaped = csdl.reshape(x_csdl, shape)
 
         # self.output_name = replace_periods_with_underscores( f'{x.name}_reshaped')
         operation_csdl.register_output(name=self.output_name, var=x_reshaped)
         return operation_csdl
 
+    def compute_in_line(self):
+        return self.arguments['x'].value.reshape(self.shape)
+
     def evaluate(self, x : Variable) -> Variable:
         '''
         User-facing method that the user will call to define a model evaluation.
@@ -795,22 +802,23 @@ class Reshape(ExplicitOperation):
         # Define operation arguments
         self.arguments = {'x' : x}
 
-        output = Variable(shape=self.shape, operation=self)
-        self.output_name = output.name
-
-        operation_csdl = self.compute()
-        output.shape = self.shape
+        # Resolve any -1 in the new shape from the size of x
+        size = np.prod(x.shape)
+        new_shape = list(self.shape)
+        for i in range(len(self.shape)):
+            if self.shape[i] == -1:
+                size_others = np.prod(self.shape)/(-1)
+                new_shape[i] = int(size/size_others)
+                break
+        self.shape = tuple(new_shape)
 
         # Create the M3L variables that are being output
         # output_name = replace_periods_with_underscores(f'{x.name}_reshaped')
-        # self.output_name = output.name
+        output = Variable(shape=self.shape, operation=self)
+        self.output_name = output.name
 
-        
-        # create csdl model for in-line evaluations
-        sim = Simulator(operation_csdl)
-        sim['x'] = x.value
-        sim.run()
-        output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
 
         return output
 
@@ -836,6 +844,9 @@ class Sum(ExplicitOperation):
 
         return csdl_model
 
+    def compute_in_line(self):
+        return np.sum(self.arguments['x'].value, axis=self.axes)
+
     def evaluate(self, x : Variable) -> Variable:
         self.name = f"sum_{x.name}_along_{self.axes[0]}_operation"
         self.arguments = {'x': x}
@@ -850,12 +861,8 @@ class Sum(ExplicitOperation):
         output = Variable(shape=output_shape, operation=self)
         self.output_name = output.name
 
-        # create csdl model for in-line evaluations
-        operation_csdl = self.compute()
-        sim = Simulator(operation_csdl, display_scripts=1)
-        sim['x'] = x.value
-        sim.run()
-        output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
         
         return output
 
@@ -889,6 +896,9 @@ class CrossProduct(ExplicitOperation):
 
         return csdl_model
 
+    def compute_in_line(self):
+        return np.cross(self.arguments['x1'].value, self.arguments['x2'].value, axis=self.axis)
+
     def evaluate(self, x1 : Variable, x2 : Variable) -> Variable:
         self.name = f"{x1.name}_cross_{x2.name}_operation"
         self.arguments = {'x1':x1, 'x2':x2}
@@ -897,15 +907,8 @@ class CrossProduct(ExplicitOperation):
         self.output_name = output.name
         # self.arguments = {f'{self.output_name}_x1': x1, f'{self.output_name}_x2' : x2}
 
-        # create csdl model for in-line evaluations
-        operation_csdl = self.compute()
-        sim = Simulator(operation_csdl)
-        # sim[f'{self.output_name}_x1'] = x1.value
-        # sim[f'{self.output_name}_x2'] = x2.value
-        sim['x1'] = x1.value
-        sim['x2'] = x2.value
-        sim.run()
-        output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
         
         return output
 
@@ -914,6 +917,8 @@ class VStack(ExplicitOperation):
     """
     v-stack class for stacking two m3l variables vertically
     """
+    definition_attributes = ExplicitOperation.definition_attributes + ('shape',)
+
     def initialize(self, kwargs):
         self.parameters.declare('name', types=str, default='vstack_operation')
     
@@ -940,6 +945,9 @@ class VStack(ExplicitOperation):
         # operation_csdl.register_output(name=output_name, var=y)
         return operation_csdl
 
+    def compute_in_line(self):
+        return np.concatenate((self.arguments['x1'].value, self.arguments['x2'].value), axis=0)
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -979,14 +987,8 @@ class VStack(ExplicitOperation):
         function_values = Variable(shape=self.shape, operation=self)
         self.output_name = function_values.name
         
-         # create csdl model for in-line evaluations
-        operation_csdl = self.compute()
-        sim = Simulator(operation_csdl)
-        sim['x1'] = x1.value
-        sim['x2'] = x2.value
-        sim.run()
-        function_values.value = sim[self.output_name]
-        
+        # in-line evaluation
+        evaluate_in_line(self, function_values)
         
         return function_values
 
@@ -1026,6 +1028,9 @@ class MatVec(ExplicitOperation):
 
         return operation_csdl
 
+    def compute_in_line(self):
+        return self.map.dot(self.arguments['x'].value)
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -1073,15 +1078,8 @@ class MatVec(ExplicitOperation):
         output = Variable(shape=output_shape, operation=self)
         self.output_name = output.name
         
-        # create csdl model for in-line evaluations
-        operation_csdl = self.compute()
-        sim = Simulator(operation_csdl)
-        # import sys
-        # print('matvec name size', sys.getsizeof(self.name)/1024/1024)
-        # sim['map'] = map.value
-        sim['x'] = x.value
-        sim.run()
-        output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
         
         return output
 
@@ -1114,6 +1112,9 @@ class MatMat(ExplicitOperation):
 
         return operation_csdl
 
+    def compute_in_line(self):
+        return self.arguments['map'].value.dot(self.arguments['x'].value)
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -1152,21 +1153,103 @@ class MatMat(ExplicitOperation):
         self.arguments = {'map' : map, 'x' : x}
 
         # Create the M3L variables that are being output
-        output_shape = (map.shape[0],)
+        output_shape = (map.shape[0],) + tuple(x.shape[1:])
         output = Variable(shape=output_shape, operation=self)
         self.output_name = output.name
         
-        # create csdl model for in-line evaluations
-        operation_csdl = self.compute()
-        sim = Simulator(operation_csdl)
-        sim['map'] = map.value
-        sim['x'] = x.value
-        sim.run()
-        output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
         
         return output
 
 
+class LinearMap(ExplicitOperation):
+    '''
+    Class for a (fused) linear operation y = sum_i(map_i x_i) + offset where the arguments x_i and the output y are
+    flattened. This is created by the linear operator fusion pass to replace chains of MatVec, Add, Subtract, scalar
+    Multiplication and Reshape operations.
+    '''
+    definition_attributes = ExplicitOperation.definition_attributes + ('shape',)
+
+    def initialize(self, kwargs):
+        self.parameters.declare('name', types=str, default='linear_map_operation')
+        self.parameters.declare('maps', types=list)
+        self.parameters.declare('offset', types=np.ndarray, default=None, allow_none=True)
+
+    def assign_attributes(self):
+        self.maps = [sps.csc_matrix(map) for map in self.parameters['maps']]
+        self.offset = self.parameters['offset']
+
+    def compute(self):
+        '''
+        Creates the CSDL model to compute the function evaluation.
+
+        Returns
+        -------
+        csdl_model : {csdl.Model}
+            The csdl model that computes the model/operation outputs.
+        '''
+        csdl_model = csdl.Model()
+        y = None
+        for map, (argument_name, argument) in zip(self.maps, self.arguments.items()):
+            x_csdl = csdl_model.declare_variable(name=argument_name, shape=argument.shape)
+            if len(argument.shape) != 1:
+                x_csdl = csdl.reshape(x_csdl, (int(np.prod(argument.shape)),))
+            mapped_x = csdl.matvec(map, x_csdl)
+            if y is None:
+                y = mapped_x
+            else:
+                y = y + mapped_x
+
+        if self.offset is not None:
+            y = y + self.offset
+        if len(self.shape) != 1:
+            y = csdl.reshape(y, self.shape)
+
+        csdl_model.register_output(name=self.output_name, var=y)
+        return csdl_model
+
+    def compute_in_line(self):
+        y = np.zeros((self.maps[0].shape[0],))
+        for map, argument in zip(self.maps, self.arguments.values()):
+            y += map.dot(np.asarray(argument.value).reshape((-1,)))
+        if self.offset is not None:
+            y += self.offset
+        return y.reshape(self.shape)
+
+    def evaluate(self, arguments:list, shape:tuple) -> Variable:
+        '''
+        User-facing method that the user will call to define a model evaluation.
+
+        Parameters
+        ----------
+        arguments : list[Variable]
+            The variables x_i that are multiplied with the maps (in the same order).
+        shape : tuple
+            The shape of the output.
+
+        Returns
+        -------
+        output : Variable
+            The output of the linear map.
+        '''
+        random_string = generate_random_string()
+        self.name = f'{arguments[0].name}_linear_map_operation_{random_string}'
+
+        # Define operation arguments
+        self.arguments = {f'x{i}' : argument for i, argument in enumerate(arguments)}
+        self.shape = tuple(shape)
+
+        # Create the M3L variables that are being output
+        output = Variable(shape=self.shape, operation=self)
+        self.output_name = output.name
+
+        # in-line evaluation
+        evaluate_in_line(self, output)
+
+        return output
+
+
 class Rotate(ExplicitOperation):
     '''
     Class for the rotate operation.
@@ -1198,51 +1281,30 @@ class Rotate(ExplicitOperation):
         axis_vector_csdl = operation_csdl.declare_variable(name='axis_vector', shape=axis_vector.shape)
         angles_csdl = operation_csdl.declare_variable(name='angles', shape=angles.shape)
 
-        num_points = np.prod(points.shape[:-1])
-        num_angles = np.prod(angles.shape)
-
-        normalized_axis = axis_vector_csdl / csdl.expand(csdl.pnorm(axis_vector_csdl), axis_vector_csdl.shape, 'i->ij')
-        normalized_axis = csdl.reshape(normalized_axis, new_shape=(normalized_axis.shape[-1],))
-
-        angles_flattened = csdl.reshape(angles_csdl, new_shape=((num_angles,))) # This rotate only works for 3D rotations
-
-        # Translate control points into actuation origin frame
-        axis_origin_csdl_expanded = csdl.expand(csdl.reshape(axis_origin_csdl, new_shape=(axis_origin_csdl.shape[-1],)),
-                                                shape=(num_points,axis_origin_csdl.shape[-1]), indices='i->ji')
-        points_origin_frame = points_csdl - axis_origin_csdl_expanded
-
-        # Construct quaternion from rotation value
-        rotated_points_flattened = operation_csdl.create_output(
-                name='rotated_points_flattened', shape=(num_angles*num_points,) + points.shape[-1:])
-        angle_counter = 0
-        for i in range(len(angles.shape)):
-            for t in range(angles.shape[i]):
-                rotation_value = angles_flattened[angle_counter]
-                if self.units == 'degrees':
-                    rotation_value = rotation_value * np.pi/180
-
-                quaternion = operation_csdl.create_output(f'quat_{t}', shape=(num_points,) + (4,))
-                quaternion[:, 0] = csdl.expand(csdl.cos(rotation_value / 2), (num_points,) + (1,), 'i->ij')
-                quaternion[:, 1] = csdl.expand(csdl.sin(rotation_value / 2) * normalized_axis[0], (num_points,) + (1,), 'i->ij')
-                quaternion[:, 2] = csdl.expand(csdl.sin(rotation_value / 2) * normalized_axis[1], (num_points,) + (1,), 'i->ij')
-                quaternion[:, 3] = csdl.expand(csdl.sin(rotation_value / 2) * normalized_axis[2], (num_points,) + (1,), 'i->ij')
-
-                # Apply rotation
-                rotated_points_origin_frame = csdl.quatrotvec(quaternion, points_origin_frame)
-
-                # Translate rotated control points back into original coordinate frame
-                rotated_points_t = rotated_points_origin_frame + axis_origin_csdl_expanded
-
-                rotated_points_flattened[angle_counter*num_points:(angle_counter+1)*num_points,:] = rotated_points_t
-
-                angle_counter += 1
-        
-        rotated_points = csdl.reshape(rotated_points_flattened, new_shape=(angles.shape + points.shape))
+        # All of the rotation matrices are built at once and applied with a single einsum (with analytic derivatives)
+        angle_scaling = np.pi/180 if self.units == 'degrees' else 1.
+        rotated_points = csdl.custom(points_csdl, axis_origin_csdl, axis_vector_csdl, angles_csdl,
+                                     op=RotationExplicit(points_shape=tuple(points.shape), axis_origin_shape=tuple(axis_origin.shape),
+                                                         axis_vector_shape=tuple(axis_vector.shape), angles_shape=tuple(angles.shape),
+                                                         output_shape=self.get_output_shape(points, angles), output_name=self.output_name,
+                                                         angle_scaling=angle_scaling))
 
         operation_csdl.register_output(name=self.output_name, var=rotated_points)
 
         return operation_csdl
 
+    def compute_in_line(self):
+        angles = np.asarray(self.arguments['angles'].value, dtype=float)
+        if self.units == 'degrees':
+            angles = angles * np.pi/180
+        return rotate_points(self.arguments['points'].value, self.arguments['axis_origin'].value,
+                             self.arguments['axis_vector'].value, angles)
+
+    def get_output_shape(self, points:Variable, angles:Variable) -> tuple:
+        if len(angles.shape) > 1 or angles.shape[0] > 1:
+            return tuple(angles.shape) + tuple(points.shape)
+        return tuple(points.shape)
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -1305,37 +1367,119 @@ class Rotate(ExplicitOperation):
 
         # Create the M3L variables that are being output
         
-        if len(angles.shape) > 1 or angles.shape[0] > 1:
-            output_shape = angles.shape + points.shape
-        else:
-            output_shape = points.shape
-
-        output = Variable(shape=output_shape, operation=self)
+        output = Variable(shape=self.get_output_shape(points, angles), operation=self)
         self.output_name = output.name
         
-        # create csdl model for in-line evaluations
-        operation_csdl = self.compute()
-        sim = Simulator(operation_csdl)
-        sim['points'] = points.value
-        sim['axis_origin'] = axis_origin.value
-        sim['axis_vector'] = axis_vector.value
-        sim['angles'] = angles.value
-        sim.run()
-        output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
         
         return output
     
 
+def normalize_indices(indices) -> tuple:
+    '''
+    Converts an index (int, slice, integer array, boolean mask, list or a tuple of these) into a tuple that can be
+    used to index NumPy arrays.
+    '''
+    if not isinstance(indices, tuple):
+        indices = (indices,)
+    normalized_indices = []
+    for index in indices:
+        if isinstance(index, list):
+            index = np.array(index)
+        normalized_indices.append(index)
+    return tuple(normalized_indices)
+
+
+def get_indexed_shape(shape:tuple, indices:tuple) -> tuple:
+    '''
+    Returns the shape of an array of the given shape after indexing (without allocating the array).
+    '''
+    return np.broadcast_to(np.empty(()), shape)[indices].shape
+
+
+def check_assignment_shape(value_shape:tuple, indexed_shape:tuple):
+    '''
+    Raises the same error as NumPy if a value of the given shape can not be assigned to (broadcast into) the indexed
+    entries of an array.
+    '''
+    value_shape, indexed_shape = tuple(value_shape), tuple(indexed_shape)
+    # Like NumPy, leading dimensions of length one of the value are dropped
+    num_leading_dimensions = len(value_shape) - len(indexed_shape)
+    trimmed_value_shape = value_shape
+    if num_leading_dimensions > 0 and all(length == 1 for length in value_shape[:num_leading_dimensions]):
+        trimmed_value_shape = value_shape[num_leading_dimensions:]
+    try:
+        is_broadcastable = np.broadcast_shapes(trimmed_value_shape, indexed_shape) == indexed_shape
+    except ValueError:
+        is_broadcastable = False
+    if not is_broadcastable:
+        format_shape = lambda shape : '(' + ','.join(str(length) for length in shape) + (',)' if len(shape) == 1 else ')')
+        raise ValueError(f'could not broadcast input array from shape {format_shape(value_shape)} into shape '
+                         f'{format_shape(indexed_shape)}')
+
+
+def get_flat_indices(shape:tuple, indices:tuple) -> np.ndarray:
+    '''
+    Returns the (row-major) flat indices of the entries that are selected by indexing an array of the given shape.
+    '''
+    return np.arange(int(np.prod(shape))).reshape(shape)[indices].reshape((-1,))
+
+
+def get_native_slices(shape:tuple, indices:tuple):
+    '''
+    Converts an index that only consists of integers and unit-step slices into a tuple of slices that CSDL variables
+    can be indexed with natively. Returns None if this is not possible (e.g., for integer arrays or boolean masks).
+    '''
+    if len(indices) > len(shape):
+        return None
+    native_slices = []
+    for axis, index in enumerate(indices):
+        if isinstance(index, (int, np.integer)) and not isinstance(index, bool):
+            index = int(index)
+            if index < -shape[axis] or index >= shape[axis]:
+                return None
+            index = index % shape[axis]
+            native_slices.append(slice(index, index+1))
+        elif isinstance(index, slice):
+            start, stop, step = index.indices(shape[axis])
+            if step != 1 or stop <= start:
+                return None
+            native_slices.append(slice(start, stop))
+        else:
+            return None
+    for axis in range(len(indices), len(shape)):
+        native_slices.append(slice(0, shape[axis]))
+    return tuple(native_slices)
+
+
+def get_complement_slices(shape:tuple, native_slices:tuple) -> list:
+    '''
+    Returns the native slices of the (at most 2*len(shape)) disjoint boxes that cover the entries of an array of the
+    given shape that are outside of the box selected by the native slices.
+    '''
+    complement_slices = []
+    for axis, box_slice in enumerate(native_slices):
+        preceding_slices = list(native_slices[:axis])
+        following_slices = [slice(0, size) for size in shape[axis+1:]]
+        if box_slice.start > 0:
+            complement_slices.append(tuple(preceding_slices + [slice(0, box_slice.start)] + following_slices))
+        if box_slice.stop < shape[axis]:
+            complement_slices.append(tuple(preceding_slices + [slice(box_slice.stop, shape[axis])] + following_slices))
+    return complement_slices
+
+
 class GetItem(ExplicitOperation):
     '''
-    Class for the indexing operation.
+    Class for the indexing operation. Supports the NumPy indexing of slices, integers, integer arrays and boolean masks
+    on any axis.
     '''
     def initialize(self, kwargs):
-        self.parameters.declare('name', types=str, default='rotate_operation')
-        self.parameters.declare('indices', types=tuple)
+        self.parameters.declare('name', types=str, default='get_item_operation')
+        self.parameters.declare('indices')
 
     def assign_attributes(self):
-        self.indices = self.parameters['indices']
+        self.indices = normalize_indices(self.parameters['indices'])
     
     def compute(self):
         '''
@@ -1347,20 +1491,38 @@ class GetItem(ExplicitOperation):
             The csdl model or module that computes the model/operation outputs.
         '''
         x = self.arguments['x']
-        indices = self.indices
 
         operation_csdl = csdl.Model()
         x_csdl = operation_csdl.declare_variable(name='x', shape=x.shape)
 
+        native_slices = get_native_slices(x.shape, self.indices)
+        if native_slices is not None:
+            x_indexed = x_csdl[native_slices]
+        else:   # Select the entries with a sparse map
+            if len(x.shape) != 1:
+                x_csdl = csdl.reshape(x_csdl, (int(np.prod(x.shape)),))
+            x_indexed = csdl.matvec(self.get_selection_map(), x_csdl)
 
-
-        x_indexed = x_csdl[indices]
-
+        if tuple(x_indexed.shape) != tuple(self.shape):
+            x_indexed = csdl.reshape(x_indexed, self.shape)
 
         operation_csdl.register_output(name=self.output_name, var=x_indexed)
 
         return operation_csdl
 
+    def compute_in_line(self):
+        return np.array(self.arguments['x'].value[self.indices])
+
+    def get_selection_map(self) -> sps.csc_matrix:
+        '''
+        Returns the sparse map that selects the indexed entries from the flattened variable.
+        '''
+        x = self.arguments['x']
+        flat_indices = get_flat_indices(x.shape, self.indices)
+        num_outputs = flat_indices.shape[0]
+        return sps.csc_matrix((np.ones((num_outputs,)), (np.arange(num_outputs), flat_indices)),
+                              shape=(num_outputs, int(np.prod(x.shape))))
+
     def compute_derivates(self):
         '''
         -- optional --
@@ -1385,26 +1547,175 @@ class GetItem(ExplicitOperation):
 
         Returns
         -------
-        function_values : Variable
-            The values of the function at the mesh locations.
+        output : Variable
+            The indexed variable.
         '''
-
-        self.name = f'{x.name}[{self.indices}]_operation'
+        random_string = generate_random_string()
+        self.name = f'{x.name}_get_item_operation_{random_string}'
 
         # Define operation arguments
         self.arguments = {'x' : x}
 
         # Create the M3L variables that are being output
-        output_shape = tuple([len(self.indices)] + list(x.shape))
-
-        output = Variable(shape=output_shape, operation=self)
+        self.shape = get_indexed_shape(x.shape, self.indices)
+        output = Variable(shape=self.shape, operation=self)
         self.output_name = output.name
         
-        # create csdl model for in-line evaluations
-        operation_csdl = self.compute()
-        sim = Simulator(operation_csdl)
-        sim['x'] = x.value
-        sim.run()
-        output.value = sim[self.output_name]
+        # in-line evaluation
+        evaluate_in_line(self, output)
         
-        return output
\ No newline at end of file
+        return output
+
+
+class SetItem(ExplicitOperation):
+    '''
+    Class for the indexed assignment operation, i.e., a copy of x with x[indices] = value. Supports the same indices as
+    GetItem and values that are Variables or constants (broadcast like in NumPy).
+    '''
+    definition_attributes = ExplicitOperation.definition_attributes + ('constant',)
+
+    def initialize(self, kwargs):
+        self.parameters.declare('name', types=str, default='set_item_operation')
+        self.parameters.declare('indices')
+
+    def assign_attributes(self):
+        self.indices = normalize_indices(self.parameters['indices'])
+
+    def compute(self):
+        '''
+        Creates the CSDL model to compute the indexed assignment.
+
+        Returns
+        -------
+        csdl_model : {csdl.Model, lsdo_modules.ModuleCSDL}
+            The csdl model or module that computes the model/operation outputs.
+        '''
+        x = self.arguments['x']
+        size = int(np.prod(x.shape))
+
+        operation_csdl = csdl.Model()
+        x_csdl = operation_csdl.declare_variable(name='x', shape=x.shape)
+
+        # A value of the same size as the indexed entries is only reshaped if NumPy would broadcast it
+        value_shape = self.arguments['value'].shape if 'value' in self.arguments else self.constant.shape
+        check_assignment_shape(value_shape, get_indexed_shape(x.shape, self.indices))
+
+        native_slices = get_native_slices(x.shape, self.indices)
+        if native_slices is not None:
+            complement_slices = get_complement_slices(x.shape, native_slices)
+            indexed_shape = tuple(box_slice.stop - box_slice.start for box_slice in native_slices)
+            if 'value' in self.arguments:
+                value = self.arguments['value']
+                is_native = int(np.prod(value.shape)) == int(np.prod(indexed_shape))
+            else:
+                is_native = len(complement_slices) > 0    # Otherwise, the output would not be assigned at all
+        else:
+            is_native = False
+
+        if is_native:   # Copy the unassigned boxes of x and assign the value with native indexed assignments
+            default_value = np.zeros(x.shape)
+            if 'value' not in self.arguments:
+                constant = np.broadcast_to(self.constant, get_indexed_shape(x.shape, self.indices))
+                default_value[native_slices] = constant.reshape(indexed_shape)
+            y = operation_csdl.create_output(name=self.output_name, shape=x.shape, val=default_value)
+            for complement_slice in complement_slices:
+                y[complement_slice] = x_csdl[complement_slice]
+            if 'value' in self.arguments:
+                value_csdl = operation_csdl.declare_variable(name='value', shape=value.shape)
+                if tuple(value.shape) != indexed_shape:
+                    value_csdl = csdl.reshape(value_csdl, indexed_shape)
+                y[native_slices] = value_csdl
+            return operation_csdl
+
+        # Fancy (integer array or boolean) indices are assigned with sparse maps
+        unchanged_map, set_map = self.get_maps()
+        if len(x.shape) != 1:
+            x_csdl = csdl.reshape(x_csdl, (size,))
+        y = csdl.matvec(unchanged_map, x_csdl)
+
+        if 'value' in self.arguments:
+            value = self.arguments['value']
+            value_csdl = operation_csdl.declare_variable(name='value', shape=value.shape)
+            if len(value.shape) != 1:
+                value_csdl = csdl.reshape(value_csdl, (int(np.prod(value.shape)),))
+            y = y + csdl.matvec(set_map, value_csdl)
+        else:
+            y = y + set_map.dot(self.constant.reshape((-1,)))
+
+        if len(x.shape) != 1:
+            y = csdl.reshape(y, x.shape)
+        operation_csdl.register_output(name=self.output_name, var=y)
+
+        return operation_csdl
+
+    def compute_in_line(self):
+        y = np.array(self.arguments['x'].value, dtype=float)
+        if 'value' in self.arguments:
+            y[self.indices] = self.arguments['value'].value
+        else:
+            y[self.indices] = self.constant
+        return y
+
+    def get_maps(self) -> tuple:
+        '''
+        Returns the sparse maps from the flattened x to the entries that are not assigned and from the flattened value to
+        the entries that are assigned. If an entry is assigned more than once, the last assignment is used (as in NumPy).
+        These are only used for indices that can not be assigned natively (integer arrays and boolean masks).
+        '''
+        x = self.arguments['x']
+        size = int(np.prod(x.shape))
+        flat_indices = get_flat_indices(x.shape, self.indices)
+        indexed_shape = get_indexed_shape(x.shape, self.indices)
+
+        value_shape = self.arguments['value'].shape if 'value' in self.arguments else self.constant.shape
+        value_size = int(np.prod(value_shape))
+        value_indices = np.broadcast_to(np.arange(value_size).reshape(value_shape), indexed_shape).reshape((-1,))
+
+        # Keep the last assignment to each entry
+        reversed_flat_indices = flat_indices[::-1]
+        unique_flat_indices, unique_positions = np.unique(reversed_flat_indices, return_index=True)
+        unique_value_indices = value_indices[::-1][unique_positions]
+
+        is_unchanged = np.ones((size,))
+        is_unchanged[unique_flat_indices] = 0.
+        unchanged_map = sps.diags(is_unchanged, format='csc')
+        set_map = sps.csc_matrix((np.ones(unique_flat_indices.shape), (unique_flat_indices, unique_value_indices)),
+                                 shape=(size, value_size))
+        return unchanged_map, set_map
+
+    def evaluate(self, x:Variable, value) -> Variable:
+        '''
+        User-facing method that the user will call to assign to the indexed entries of a Variable.
+
+        Parameters
+        ----------
+        x : Variable
+            The variable to be assigned to.
+        value : Variable, np.ndarray, float or int
+            The values that are assigned to the indexed entries.
+
+        Returns
+        -------
+        output : Variable
+            The copy of x with the assigned entries.
+        '''
+        random_string = generate_random_string()
+        self.name = f'{x.name}_set_item_operation_{random_string}'
+
+        # Define operation arguments
+        if isinstance(value, Variable):
+            self.arguments = {'x' : x, 'value' : value}
+        else:
+            self.arguments = {'x' : x}
+            self.constant = np.array(value, dtype=float)
+        value_shape = value.shape if isinstance(value, Variable) else self.constant.shape
+        check_assignment_shape(value_shape, get_indexed_shape(x.shape, self.indices))
+
+        # Create the M3L variables that are being output
+        output = Variable(shape=x.shape, operation=self)
+        self.output_name = output.name
+
+        # in-line evaluation
+        evaluate_in_line(self, output)
+
+        return output
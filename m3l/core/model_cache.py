@@ -0,0 +1,395 @@
+'''
+Content-addressed cache for the CSDL models built during assembly. The cache is disabled by default and is turned on
+with set_model_cache().
+
+Every operation gets a structural hash of its class, declared parameters, definition attributes (see
+Operation.definition_attributes), argument names/shapes and the hashes of its upstream operations. The CSDL model
+returned by compute() is cached under the hash of the operation alone and the assembled model under the hash of the
+whole graph, so assembling an unchanged graph again reuses the previously built models and changing one operation only
+rebuilds the model of that operation. This requires that compute() only depends on what is hashed.
+
+Variables that are parameters or definition attributes of an operation (rather than its arguments) are also hashed by
+their values. Objects that can not be hashed by their contents (e.g., geometry or function space objects) are hashed by identity.
+Hashes containing such objects are only valid in the current process, so they are only cached in memory. All other
+hashes are portable and, if a cache directory is set, the models are also pickled to disk.
+
+The cache stores a pickled (or deep) copy of each model and every call returns a new copy of it, so the returned
+models can be modified without affecting the cache or the other callers.
+'''
+import copy
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sps
+
+
+model_cache_options = {
+    'enabled' : False,
+    'directory' : None,
+    'max_entries' : 10000,
+}
+
+model_cache = OrderedDict()     # key -> [model template, referents], least recently used first
+
+
+def set_model_cache(enabled:bool=True, directory:str=None, max_entries:int=10000):
+    '''
+    Sets the options of the cache for the CSDL models built during assembly.
+
+    Parameters
+    ----------
+    enabled : bool, optional, default: True
+        If False (which is the initial setting), every operation is computed again on each assembly.
+    directory : str, optional
+        The directory to also store the (portable) models in so they can be reused between runs.
+    max_entries : int, optional, default: 10000
+        The maximum number of models kept in memory. The least recently used models are evicted first.
+    '''
+    model_cache_options['enabled'] = enabled
+    model_cache_options['directory'] = directory
+    model_cache_options['max_entries'] = max_entries
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    _evict()
+
+
+def clear_model_cache():
+    '''
+    Empties the in-memory model cache. Files in the cache directory are not deleted.
+    '''
+    model_cache.clear()
+
+
+class StructuralHash:
+    '''
+    The structural hash of an object.
+
+    Attributes
+    ----------
+    digest : str
+        The hex digest of the hash.
+    portable : bool
+        False if the hash contains the identity of an object, so it is only valid in the current process.
+    referents : list
+        The objects that were hashed by identity (and the hashes of the upstream operations). These are kept alive with
+        the cached models so that their ids can not be reused by other objects.
+    definition_hash : StructuralHash
+        For operations, the hash of the operation alone (without its upstream operations).
+    '''
+    def __init__(self, digest:str, portable:bool, referents:list) -> None:
+        self.digest = digest
+        self.portable = portable
+        self.referents = referents
+        self.definition_hash = None
+
+
+class _Hasher:
+    def __init__(self) -> None:
+        self.hasher = hashlib.sha256()
+        self.portable = True
+        self.referents = []
+        self.active_ids = set()
+
+    def update(self, *tokens):
+        for token in tokens:
+            self.hasher.update(str(token).encode())
+            self.hasher.update(b'\x00')
+
+    def add(self, obj):
+        from m3l.core.m3l_classes import Variable, Operation, IndexedParametricCoordinates
+        from m3l.utils.parameters import Parameters
+
+        if obj is None or obj is Ellipsis or isinstance(obj, (bool, int, float, complex, str, bytes, slice)):
+            self.update(type(obj).__name__, repr(obj))
+        elif isinstance(obj, np.generic):
+            self.update('np.generic', obj.dtype.str, repr(obj.item()))
+        elif isinstance(obj, np.ndarray):
+            self.update('np.ndarray', obj.dtype.str, obj.shape)
+            if obj.dtype == object:
+                for element in obj.flat:
+                    self.add(element)
+            else:
+                self.hasher.update(np.ascontiguousarray(obj).tobytes())
+        elif sps.issparse(obj):
+            matrix = sps.csr_matrix(obj)
+            matrix.sum_duplicates()
+            self.update('sparse', matrix.dtype.str, matrix.shape)
+            for array in (matrix.indptr, matrix.indices, matrix.data):
+                self.hasher.update(np.ascontiguousarray(array).tobytes())
+        elif isinstance(obj, Variable):
+            # Arguments are hashed by name and shape only, so a Variable that is hashed here is a parameter or
+            # definition attribute (e.g., the mesh of a function evaluation) whose value compute() can depend on
+            self.update('Variable', obj.name, tuple(obj.shape))
+            self.add(obj.value)
+        elif isinstance(obj, Operation):
+            self.update('Operation', type(obj).__module__, type(obj).__qualname__, obj.name)
+        elif isinstance(obj, IndexedParametricCoordinates):
+            self.update('IndexedParametricCoordinates')
+            for attribute in (obj.surface_names, obj.surface_ids, obj.parametric_coordinates):
+                self.add(attribute)
+        elif id(obj) in self.active_ids:
+            self.add_identity(obj)
+        elif isinstance(obj, (list, tuple, set, frozenset, dict, Parameters)):
+            self.active_ids.add(id(obj))
+            if isinstance(obj, (list, tuple)):
+                self.update(type(obj).__name__, len(obj))
+                for item in obj:
+                    self.add(item)
+            elif isinstance(obj, (set, frozenset)):
+                item_digests = sorted(_digest_of(item, self) for item in obj)
+                self.update('set', *item_digests)
+            else:
+                keys = list(obj)
+                self.update('dict', len(keys))
+                for key in keys:
+                    self.add(key)
+                    try:
+                        self.add(obj[key])
+                    except Exception:   # A required parameter that was never set
+                        self.update('undefined')
+            self.active_ids.remove(id(obj))
+        else:
+            self.add_identity(obj)
+
+    def add_identity(self, obj):
+        self.update('object', type(obj).__module__, type(obj).__qualname__, id(obj))
+        self.portable = False
+        self.referents.append(obj)
+
+    def finish(self) -> StructuralHash:
+        return StructuralHash(digest=self.hasher.hexdigest(), portable=self.portable, referents=self.referents)
+
+
+def _digest_of(obj, parent_hasher:_Hasher) -> str:
+    hasher = _Hasher()
+    hasher.add(obj)
+    parent_hasher.portable = parent_hasher.portable and hasher.portable
+    parent_hasher.referents.extend(hasher.referents)
+    return hasher.hasher.hexdigest()
+
+
+def compute_definition_hash(operation, ignore_names:bool=False) -> StructuralHash:
+    '''
+    Computes the structural hash of the definition of an operation (its class, declared parameters, definition
+    attributes and argument names/shapes). This is all that the compute() method of the operation may depend on. Other
+    attributes (e.g., the state that compute() itself sets) are not hashed, so the hash does not change once the
+    operation has been computed.
+
+    Parameters
+    ----------
+    operation : Operation
+        The operation to hash.
+    ignore_names : bool, optional, default: False
+        If True, the names of the operation, its output and its arguments are not hashed. This is used to find
+        operations that compute the same thing under different names.
+    '''
+    hasher = _Hasher()
+    hasher.update('operation', type(operation).__module__, type(operation).__qualname__)
+    for parameter_name in operation.parameters:
+        if ignore_names and parameter_name == 'name':
+            continue
+        hasher.update('parameter', parameter_name)
+        try:
+            hasher.add(operation.parameters[parameter_name])
+        except Exception:   # A required parameter that was never set
+            hasher.update('undefined')
+    for attribute_name in getattr(operation, 'definition_attributes', ()):
+        if ignore_names and attribute_name in ('name', 'output_name'):
+            continue
+        hasher.update('attribute', attribute_name)
+        if hasattr(operation, attribute_name):
+            hasher.add(getattr(operation, attribute_name))
+        else:
+            hasher.update('undefined')
+    for argument_name, argument in operation.arguments.items():
+        hasher.update('argument', argument_name)
+        if argument is None:
+            hasher.update('None')
+        elif ignore_names:
+            hasher.update(tuple(argument.shape))
+        else:
+            hasher.update(argument.name, tuple(argument.shape))
+    return hasher.finish()
+
+
+def compute_operation_hashes(operations:list, operation_hashes:dict=None) -> dict:
+    '''
+    Computes the structural hashes of operations. The hash of each operation also has a definition_hash attribute with
+    the hash of the operation alone (without its upstream operations) that its CSDL model is cached under.
+
+    Parameters
+    ----------
+    operations : list[Operation]
+        The operations in topological order.
+    operation_hashes : dict[int, StructuralHash], optional
+        Previously computed hashes (e.g., of the upstream operations). The new hashes are added to this dictionary.
+
+    Returns
+    -------
+    operation_hashes : dict[int, StructuralHash]
+        The hashes keyed by the ids of the operations.
+    '''
+    if operation_hashes is None:
+        operation_hashes = {}
+    for operation in operations:
+        definition_hash = compute_definition_hash(operation)
+
+        # The definition of the operation combined with the hashes of its upstream operations
+        hasher = _Hasher()
+        hasher.update(definition_hash.digest)
+        hasher.portable = definition_hash.portable
+        hasher.referents.append(definition_hash)
+        for argument in operation.arguments.values():
+            if argument is None or argument.operation is None:
+                hasher.update('input')
+                continue
+            upstream_hash = operation_hashes.get(id(argument.operation))
+            if upstream_hash is None:
+                hasher.add_identity(argument.operation)
+            else:
+                hasher.update(upstream_hash.digest)
+                hasher.portable = hasher.portable and upstream_hash.portable
+                hasher.referents.append(upstream_hash)
+        operation_hash = hasher.finish()
+        operation_hash.definition_hash = definition_hash
+        operation_hashes[id(operation)] = operation_hash
+    return operation_hashes
+
+
+def compute_assembly_hash(operations:list, operation_hashes:dict, user_inputs:list=(), constraints:list=(),
+                          objective=None) -> StructuralHash:
+    '''
+    Computes the structural hash of an assembled model from the hashes of its (sorted) operations and the inputs,
+    design variables, constraints and objective that are added during assembly.
+    '''
+    hasher = _Hasher()
+    hasher.update('assembly')
+    for operation in operations:
+        operation_hash = operation_hashes[id(operation)]
+        hasher.update(operation_hash.digest)
+        hasher.portable = hasher.portable and operation_hash.portable
+        hasher.referents.append(operation_hash)
+        for argument in operation.arguments.values():
+            if argument is not None and argument.operation is None:     # The values of the inputs are set in assembly
+                hasher.add(argument.value)
+
+    for variable in user_inputs:
+        hasher.update('user_input', variable.name, variable.shape, variable.dv_flag)
+        for attribute in (variable.value, variable.lower, variable.upper, variable.scaler):
+            hasher.add(attribute)
+    for variable in constraints:
+        hasher.update('constraint', variable.name, variable.operation.name)
+        for attribute in (variable.lower, variable.upper, variable.equals, variable.scaler):
+            hasher.add(attribute)
+    if objective:
+        hasher.update('objective', objective.name, objective.operation.name)
+        hasher.add(objective.scaler)
+    return hasher.finish()
+
+
+def get_cached_model(structural_hash:StructuralHash, build_model, tag:str='model'):
+    '''
+    Returns a copy of the model cached under a structural hash or builds (and caches) it if there is none. Models that
+    can neither be pickled nor deep copied are not cached.
+
+    Parameters
+    ----------
+    structural_hash : StructuralHash
+        The hash of the operation/assembly that the model is built from.
+    build_model : callable
+        Builds the model if it is not cached.
+    tag : str, optional, default: 'model'
+        Distinguishes different models built from the same operation (e.g., compute() and compute_derivatives()).
+    '''
+    if not model_cache_options['enabled']:
+        return build_model()
+
+    key = f'{structural_hash.digest}_{tag}'
+    if key in model_cache:
+        model_cache.move_to_end(key)
+        return _copy_model_template(model_cache[key][0])
+
+    model = None
+    file_path = _get_file_path(structural_hash, key)
+    if file_path is not None and os.path.isfile(file_path):
+        try:
+            with open(file_path, 'rb') as file:
+                model = pickle.load(file)
+        except Exception:
+            model = None
+
+    if model is None:
+        model = build_model()
+
+    template = _get_model_template(model)
+    if template is None:
+        return model
+    if file_path is not None and isinstance(template, bytes) and not os.path.isfile(file_path):
+        with open(file_path, 'wb') as file:
+            file.write(template)
+
+    model_cache[key] = [template, structural_hash.referents]
+    _evict()
+    return model
+
+
+def cache_model(structural_hash:StructuralHash, model, tag:str='model'):
+    '''
+    Caches a copy of a model under a structural hash (e.g., a model that was extended after it was built).
+    '''
+    if not model_cache_options['enabled']:
+        return
+    template = _get_model_template(model)
+    if template is not None:
+        model_cache[f'{structural_hash.digest}_{tag}'] = [template, structural_hash.referents]
+        _evict()
+
+
+def copy_model(model):
+    '''
+    Returns an independent copy of a model, or None if it can neither be pickled nor deep copied.
+    '''
+    template = _get_model_template(model)
+    if template is None:
+        return None
+    return _copy_model_template(template)
+
+
+def _get_model_template(model):
+    # Models are stored pickled if possible since unpickling is a cheap way to create independent copies
+    try:
+        return pickle.dumps(model)
+    except Exception:
+        pass
+    try:
+        return [copy.deepcopy(model)]
+    except Exception:
+        return None
+
+
+def _copy_model_template(template):
+    if isinstance(template, bytes):
+        return pickle.loads(template)
+    return copy.deepcopy(template[0])
+
+
+def is_model_cached(structural_hash:StructuralHash, tag:str='model') -> bool:
+    '''
+    Checks if a model is cached in memory under a structural hash.
+    '''
+    return model_cache_options['enabled'] and f'{structural_hash.digest}_{tag}' in model_cache
+
+
+def _get_file_path(structural_hash:StructuralHash, key:str):
+    directory = model_cache_options['directory']
+    if directory is None or not structural_hash.portable:
+        return None
+    return os.path.join(directory, f'{key}.pkl')
+
+
+def _evict():
+    while len(model_cache) > model_cache_options['max_entries']:
+        model_cache.popitem(last=False)
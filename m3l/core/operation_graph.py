@@ -0,0 +1,117 @@
+import heapq
+
+
+class OperationGraph:
+    '''
+    Directed acyclic graph of M3L operations. The nodes are the operations and there is an edge from operation A to
+    operation B if an output Variable of A is an argument of B. Operations are tracked by identity (id()).
+
+    Attributes
+    ----------
+    operations : dict[int, Operation]
+        The operations in the graph keyed by their id, in the order they were added.
+    predecessors : dict[int, list[int]]
+        The ids of the operations that compute the arguments of each operation.
+    successors : dict[int, list[int]]
+        The ids of the operations that take an output of each operation as an argument.
+    '''
+
+    def __init__(self) -> None:
+        self.operations = {}
+        self.predecessors = {}
+        self.successors = {}
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __contains__(self, operation):
+        return id(operation) in self.operations
+
+    def add_upstream_operations(self, variable) -> list:
+        '''
+        Adds the operations upstream of a variable (and the edges between them) to the graph.
+
+        Parameters
+        ----------
+        variable : Variable
+            The variable whose upstream operations are added.
+
+        Returns
+        -------
+        new_operations : list[Operation]
+            The operations that were not already in the graph, in topological order.
+        '''
+        new_operations = []
+
+        # Iterative depth-first post-order traversal to avoid the recursion limit on deep graphs
+        entered_operation_ids = set()
+        stack = [(variable.operation, False)]
+        while stack:
+            operation, is_expanded = stack.pop()
+            if is_expanded:
+                self.add_operation(operation)
+                new_operations.append(operation)
+                continue
+
+            if operation is None or id(operation) in self.operations or id(operation) in entered_operation_ids:
+                continue
+            entered_operation_ids.add(id(operation))
+            stack.append((operation, True))
+
+            for argument in reversed(list(operation.arguments.values())):
+                if argument is not None and argument.operation is not None \
+                    and id(argument.operation) not in self.operations and id(argument.operation) not in entered_operation_ids:
+                    stack.append((argument.operation, False))
+
+        return new_operations
+
+    def add_operation(self, operation):
+        '''
+        Adds an operation to the graph along with the edges from the (already added) operations computing its arguments.
+        '''
+        operation_id = id(operation)
+        self.operations[operation_id] = operation
+        self.predecessors[operation_id] = []
+        self.successors[operation_id] = []
+        for argument in operation.arguments.values():
+            if argument is None or argument.operation is None:
+                continue
+            argument_operation_id = id(argument.operation)
+            if argument_operation_id in self.operations and argument_operation_id not in self.predecessors[operation_id]:
+                self.predecessors[operation_id].append(argument_operation_id)
+                self.successors[argument_operation_id].append(operation_id)
+
+    def topological_sort(self) -> list:
+        '''
+        Sorts the operations with Kahn's algorithm. Ties are broken by the order in which the operations were created,
+        so the result does not depend on the order in which the outputs were registered or the graph was traversed.
+
+        Returns
+        -------
+        operations : list[Operation]
+            The operations such that each one comes after the operations that compute its arguments.
+        '''
+        discovery_positions = {operation_id : i for i, operation_id in enumerate(self.operations)}
+
+        def sort_key(operation_id):
+            operation_index = getattr(self.operations[operation_id], 'operation_index', None)
+            if operation_index is None:
+                operation_index = float('inf')
+            return (operation_index, discovery_positions[operation_id], operation_id)
+
+        num_unsorted_predecessors = {operation_id : len(predecessors) for operation_id, predecessors in self.predecessors.items()}
+        heap = [sort_key(operation_id) for operation_id, num_predecessors in num_unsorted_predecessors.items() if num_predecessors == 0]
+        heapq.heapify(heap)
+
+        sorted_operations = []
+        while heap:
+            operation_id = heapq.heappop(heap)[-1]
+            sorted_operations.append(self.operations[operation_id])
+            for successor_id in self.successors[operation_id]:
+                num_unsorted_predecessors[successor_id] -= 1
+                if num_unsorted_predecessors[successor_id] == 0:
+                    heapq.heappush(heap, sort_key(successor_id))
+
+        if len(sorted_operations) != len(self.operations):
+            raise Exception('The M3L graph contains a cycle, so the operations can not be sorted topologically.')
+        return sorted_operations
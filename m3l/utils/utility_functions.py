@@ -1,6 +1,10 @@
 import random
 import string
 
+# Dedicated generator with a fixed seed so the generated operation names (and therefore the assembled CSDL models) are
+# the same between runs.
+random_generator = random.Random(0)
+
 
 def replace_periods_with_underscores(input_string):
     # Use the replace method to replace periods with underscores
@@ -13,6 +17,6 @@ def generate_random_string(length=5):
     characters = string.ascii_letters + string.digits  # Alphanumeric characters
 
     # Generate a random string of the specified length
-    random_string = ''.join(random.choice(characters) for _ in range(length))
+    random_string = ''.join(random_generator.choice(characters) for _ in range(length))
     
     return random_string
@@ -0,0 +1,172 @@
+import numpy as np
+import scipy.sparse as sps
+from m3l.core.csdl_operations import compute_eigenpairs, compute_eigenvalue_derivatives, get_sparsity_pattern, \
+    compute_generalized_eigenpairs, compute_generalized_eigenpair_jacvec_product, \
+    compute_generalized_eigenpair_vecjac_product, get_symmetric_part, compute_batched_eigenpairs, \
+    compute_batched_eigenvalue_derivatives, get_batched_eig_executor
+
+
+def get_tridiagonal_matrix(size:int, symmetric:bool) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    lower = rng.random(size - 1)
+    upper = lower if symmetric else rng.random(size - 1)
+    return np.diag(2 + np.arange(size, dtype=float)) + np.diag(lower, -1) + np.diag(upper, 1)
+
+
+def test_partial_eigenvalues():
+    '''
+    Test description: the eigenvalues closest to sigma from the sparse iterations should match the dense eigenvalues.
+    '''
+    for symmetric in (True, False):
+        A = get_tridiagonal_matrix(40, symmetric)
+        eigenvalues, right_eigenvectors, left_eigenvectors = compute_eigenpairs(sps.csr_matrix(A), num_eigenvalues=4,
+                                                                                sigma=0., symmetric=symmetric)
+        dense_eigenvalues = np.linalg.eigvals(A)
+        dense_eigenvalues = dense_eigenvalues[np.argsort(np.abs(dense_eigenvalues))][:4]
+        np.testing.assert_allclose(np.real(eigenvalues), np.real(dense_eigenvalues), rtol=1e-8)
+        np.testing.assert_allclose(A.dot(right_eigenvectors), right_eigenvectors*eigenvalues, atol=1e-8)
+        np.testing.assert_allclose(np.sum(left_eigenvectors*right_eigenvectors, axis=0), 1., rtol=1e-8)
+
+
+def test_eigenvalue_derivatives():
+    '''
+    Test description: the vectorized (dense and sparse) eigenvalue derivatives should match central finite differences.
+    '''
+    size = 12
+    step = 1e-6
+    for symmetric in (True, False):
+        A = get_tridiagonal_matrix(size, symmetric)
+        sparsity_pattern = get_sparsity_pattern(A)
+        _, right_eigenvectors, left_eigenvectors = compute_eigenpairs(sps.csr_matrix(A), num_eigenvalues=3,
+                                                                      symmetric=symmetric)
+        derivatives = compute_eigenvalue_derivatives(right_eigenvectors, left_eigenvectors)
+        sparse_derivatives = compute_eigenvalue_derivatives(right_eigenvectors, left_eigenvectors,
+                                                            sparsity_pattern=sparsity_pattern)
+
+        for index, (row, col) in enumerate(zip(*sparsity_pattern)):
+            perturbation = np.zeros((size, size))
+            perturbation[row, col] = step
+            if symmetric and row != col:    # Perturbs the symmetric matrix with its lower and upper entries at once
+                perturbation[col, row] = step
+            forward_eigenvalues = compute_eigenpairs(A + perturbation, num_eigenvalues=3, symmetric=symmetric)[0]
+            backward_eigenvalues = compute_eigenpairs(A - perturbation, num_eigenvalues=3, symmetric=symmetric)[0]
+            finite_difference = (forward_eigenvalues - backward_eigenvalues)/(2*step)
+
+            derivative = sparse_derivatives[:,index]
+            if symmetric and row != col:
+                derivative = derivative + sparse_derivatives[:,np.flatnonzero((sparsity_pattern[0] == col) & (sparsity_pattern[1] == row))[0]]
+            np.testing.assert_allclose(np.real(derivative), np.real(finite_difference), atol=1e-6)
+            np.testing.assert_allclose(sparse_derivatives[:,index], derivatives[:,row*size + col])
+
+
+def test_complex_eigenvalue_derivatives():
+    '''
+    Test description: for real matrices with complex conjugate pairs of eigenvalues, the left eigenvectors from the
+    sparse iterations should belong to their right eigenvectors (also if num_eigenvalues splits a pair) and the
+    eigenvalue derivatives should match central finite differences.
+    '''
+    size = 30
+    step = 1e-7
+    rng = np.random.default_rng(3)
+    num_complex_eigenvalues = 0
+    for num_eigenvalues in (1, 2, 3, 4, 5, 6, 7, 3, 3, 3):
+        A = rng.standard_normal((size, size))
+        eigenvalues, right_eigenvectors, left_eigenvectors = compute_eigenpairs(sps.csr_matrix(A),
+                                                                                num_eigenvalues=num_eigenvalues, sigma=0.)
+        num_complex_eigenvalues += np.count_nonzero(np.imag(eigenvalues))
+        np.testing.assert_allclose(left_eigenvectors.T.dot(A), eigenvalues[:,None]*left_eigenvectors.T, atol=1e-8)
+        np.testing.assert_allclose(np.sum(left_eigenvectors*right_eigenvectors, axis=0), 1., rtol=1e-8)
+
+        perturbation = rng.standard_normal((size, size))
+        get_eigenvalues = lambda A : compute_eigenpairs(sps.csr_matrix(A), num_eigenvalues=num_eigenvalues, sigma=0.)[0]
+        finite_difference = (get_eigenvalues(A + step*perturbation) - get_eigenvalues(A - step*perturbation))/(2*step)
+        derivative = compute_eigenvalue_derivatives(right_eigenvectors, left_eigenvectors).dot(perturbation.flatten())
+        np.testing.assert_allclose(derivative, finite_difference, rtol=1e-5, atol=1e-6)
+    assert num_complex_eigenvalues > 0
+
+
+def get_stiffness_and_mass_matrices(size:int) -> tuple:
+    rng = np.random.default_rng(1)
+    stiffness_matrix = np.diag(2 + rng.random(size)) - np.diag(np.ones(size - 1), 1) - np.diag(np.ones(size - 1), -1)
+    off_diagonal = 0.1*rng.random(size - 1)
+    mass_matrix = np.diag(1 + rng.random(size)) + np.diag(off_diagonal, 1) + np.diag(off_diagonal, -1)
+    return stiffness_matrix, mass_matrix
+
+
+def test_generalized_eigenpairs():
+    '''
+    Test description: the lowest modes of K v = w M v from the sparse iterations should match the dense modes.
+    '''
+    stiffness_matrix, mass_matrix = get_stiffness_and_mass_matrices(50)
+    eigenvalues, eigenvectors = compute_generalized_eigenpairs(sps.csr_matrix(stiffness_matrix),
+                                                               sps.csr_matrix(mass_matrix), num_eigenvalues=5)
+    dense_eigenvalues, dense_eigenvectors = compute_generalized_eigenpairs(stiffness_matrix, mass_matrix)
+    np.testing.assert_allclose(eigenvalues, dense_eigenvalues[:5], rtol=1e-8)
+    np.testing.assert_allclose(eigenvectors, dense_eigenvectors[:,:5], atol=1e-7)
+    np.testing.assert_allclose(eigenvectors.T.dot(mass_matrix).dot(eigenvectors), np.eye(5), atol=1e-10)
+
+
+def test_generalized_eigenpair_derivatives():
+    '''
+    Test description: the directional derivatives of the eigenvalues and the eigenvectors should match central finite
+    differences of the eigenpairs of the symmetrized matrices for non-symmetric perturbations of K and M, and the
+    (adjoint) products with the seeds should be their transpose.
+    '''
+    size = 8
+    step = 1e-6
+    rng = np.random.default_rng(2)
+    stiffness_matrix, mass_matrix = get_stiffness_and_mass_matrices(size)
+    sparsity_pattern = get_sparsity_pattern(stiffness_matrix)
+    eigenvalues, eigenvectors = compute_generalized_eigenpairs(sps.csr_matrix(stiffness_matrix),
+                                                               sps.csr_matrix(mass_matrix), num_eigenvalues=3)
+    stiffness_perturbation, mass_perturbation = rng.random((size, size)), rng.random((size, size))
+    eigenvalue_perturbations, eigenvector_perturbations = compute_generalized_eigenpair_jacvec_product(
+        stiffness_matrix, mass_matrix, eigenvalues, eigenvectors, stiffness_perturbation, mass_perturbation)
+
+    get_outputs = lambda sign : compute_generalized_eigenpairs(
+        get_symmetric_part(stiffness_matrix + sign*step*stiffness_perturbation),
+        get_symmetric_part(mass_matrix + sign*step*mass_perturbation), num_eigenvalues=3)
+    forward_outputs, backward_outputs = get_outputs(1.), get_outputs(-1.)
+    np.testing.assert_allclose(eigenvalue_perturbations, (forward_outputs[0] - backward_outputs[0])/(2*step), atol=1e-6)
+    np.testing.assert_allclose(eigenvector_perturbations, (forward_outputs[1] - backward_outputs[1])/(2*step), atol=1e-6)
+
+    eigenvalue_seeds, eigenvector_seeds = rng.random(3), rng.random((size, 3))
+    output_product = eigenvalue_seeds.dot(eigenvalue_perturbations) + np.sum(eigenvector_seeds*eigenvector_perturbations)
+    stiffness_seeds, mass_seeds = compute_generalized_eigenpair_vecjac_product(
+        stiffness_matrix, mass_matrix, eigenvalues, eigenvectors, eigenvalue_seeds, eigenvector_seeds)
+    np.testing.assert_allclose(np.sum(stiffness_seeds*stiffness_perturbation) + np.sum(mass_seeds*mass_perturbation),
+                               output_product)
+
+    # With a sparsity pattern, only the products with the entries in the pattern are computed
+    rows, cols = sparsity_pattern
+    pattern_perturbations = [sps.csr_matrix((perturbation[rows, cols], (rows, cols)), shape=(size, size))
+                             for perturbation in (stiffness_perturbation, mass_perturbation)]
+    eigenvalue_perturbations, eigenvector_perturbations = compute_generalized_eigenpair_jacvec_product(
+        stiffness_matrix, mass_matrix, eigenvalues, eigenvectors, *pattern_perturbations)
+    output_product = eigenvalue_seeds.dot(eigenvalue_perturbations) + np.sum(eigenvector_seeds*eigenvector_perturbations)
+    stiffness_seeds, mass_seeds = compute_generalized_eigenpair_vecjac_product(
+        stiffness_matrix, mass_matrix, eigenvalues, eigenvectors, eigenvalue_seeds, eigenvector_seeds,
+        sparsity_pattern=sparsity_pattern)
+    np.testing.assert_allclose(stiffness_seeds.dot(stiffness_perturbation[rows, cols])
+                               + mass_seeds.dot(mass_perturbation[rows, cols]), output_product)
+
+
+def test_batched_eigenvalues():
+    '''
+    Test description: the batched eigenvalues and derivatives (in one thread or on a thread pool) should match the
+    eigenvalues and derivatives of each matrix.
+    '''
+    size = 5
+    matrices = np.random.default_rng(2).random((6, size, size))
+    eigenvalues, right_eigenvectors, left_eigenvectors = compute_batched_eigenpairs(matrices)
+    executor = get_batched_eig_executor(2)
+    assert get_batched_eig_executor(2) is executor     # The pool is shared instead of created per operation
+    pool_eigenvalues, _, _ = compute_batched_eigenpairs(matrices, executor=executor, num_chunks=2)
+    derivatives = compute_batched_eigenvalue_derivatives(right_eigenvectors, left_eigenvectors)
+
+    np.testing.assert_allclose(pool_eigenvalues, eigenvalues)
+    for i, matrix in enumerate(matrices):
+        node_eigenvalues, node_right_eigenvectors, node_left_eigenvectors = compute_eigenpairs(matrix)
+        np.testing.assert_allclose(eigenvalues[i], node_eigenvalues)
+        np.testing.assert_allclose(derivatives[i*size:(i + 1)*size],
+                                   compute_eigenvalue_derivatives(node_right_eigenvectors, node_left_eigenvectors), atol=1e-12)
@@ -0,0 +1,91 @@
+import gc
+
+import numpy as np
+
+import m3l
+from m3l.core.evaluation_map_cache import get_evaluation_map, evaluation_map_cache, spilled_evaluation_maps
+from m3l.core.function_spaces import IDWFunctionSpace2
+
+
+class CountingFunctionSpace(IDWFunctionSpace2):
+    '''
+    Function space that counts how many times its evaluation map is computed.
+    '''
+    num_evaluations = 0
+
+    def compute_evaluation_map(self, parametric_coordinates:np.ndarray):
+        CountingFunctionSpace.num_evaluations += 1
+        return super().compute_evaluation_map(parametric_coordinates)
+
+
+def test_evaluation_map_cache(tmp_path):
+    '''
+    Test description: maps should be computed once per space and set of coordinates, evicted maps should be spilled to
+    disk and loaded again instead of being recomputed.
+    '''
+    m3l.clear_evaluation_map_cache()
+    m3l.set_evaluation_map_cache()
+    rng = np.random.default_rng(0)
+    space = CountingFunctionSpace(name='space', points=rng.random((20, 2)), order=2, coefficients_shape=(20, 3),
+                                  num_neighbors=4)
+    other_space = CountingFunctionSpace(name='other_space', points=space.points, order=2, coefficients_shape=(20, 3),
+                                        num_neighbors=4)
+    parametric_coordinates = rng.random((10, 2))
+
+    CountingFunctionSpace.num_evaluations = 0
+    map = get_evaluation_map(space, parametric_coordinates)
+    assert get_evaluation_map(space, parametric_coordinates.copy()) is map
+    assert CountingFunctionSpace.num_evaluations == 1
+    get_evaluation_map(space, parametric_coordinates[:5])
+    get_evaluation_map(other_space, parametric_coordinates)
+    assert CountingFunctionSpace.num_evaluations == 3
+
+    # The indexed evaluations share the cache
+    indexed_space = m3l.IndexedFunctionSpace(name='indexed_space', spaces={'surface' : space})
+    indexed_space.compute_evaluation_map((np.array(['surface']*10), parametric_coordinates))
+    assert CountingFunctionSpace.num_evaluations == 3
+
+    # Maps over the memory budget are spilled and loaded back
+    m3l.set_evaluation_map_cache(max_memory=1, directory=str(tmp_path))
+    assert len(evaluation_map_cache) == 0
+    assert len(spilled_evaluation_maps) == 3
+    spilled_map = get_evaluation_map(space, parametric_coordinates)
+    assert CountingFunctionSpace.num_evaluations == 3
+    assert np.allclose(spilled_map.toarray(), map.toarray())
+    assert len(evaluation_map_cache) == 1     # The most recently used map is kept even if it is over the budget
+    assert len(spilled_evaluation_maps) == 2
+
+    m3l.clear_evaluation_map_cache()
+    assert not list(tmp_path.iterdir())
+    m3l.set_evaluation_map_cache(enabled=False)
+
+
+def test_evaluation_map_cache_invalidation():
+    '''
+    Test description: changing the fields of a space in place should compute new maps and the maps of a freed space
+    should be dropped from the cache.
+    '''
+    m3l.clear_evaluation_map_cache()
+    m3l.set_evaluation_map_cache()
+    rng = np.random.default_rng(0)
+    space = CountingFunctionSpace(name='space', points=rng.random((20, 2)), order=2, coefficients_shape=(20, 3),
+                                  num_neighbors=4)
+    parametric_coordinates = rng.random((10, 2))
+
+    CountingFunctionSpace.num_evaluations = 0
+    map = get_evaluation_map(space, parametric_coordinates)
+    space.num_neighbors = 8
+    new_map = get_evaluation_map(space, parametric_coordinates)
+    assert CountingFunctionSpace.num_evaluations == 2
+    assert new_map.nnz == 80 and map.nnz == 40
+
+    del space
+    gc.collect()
+    get_evaluation_map(CountingFunctionSpace(name='other_space', points=rng.random((20, 2)), order=2,
+                                             coefficients_shape=(20, 3), num_neighbors=4), parametric_coordinates)
+    gc.collect()
+    get_evaluation_map(CountingFunctionSpace(name='other_space', points=rng.random((20, 2)), order=2,
+                                             coefficients_shape=(20, 3), num_neighbors=4), parametric_coordinates)
+    assert len(evaluation_map_cache) <= 1
+    m3l.clear_evaluation_map_cache()
+    m3l.set_evaluation_map_cache(enabled=False)
@@ -0,0 +1,222 @@
+import numpy as np
+import scipy.sparse as sps
+
+import m3l
+from m3l.core.csdl_operations import LeastSquaresFit, compute_surface_normals, compute_surface_normal_derivatives
+from m3l.core.evaluation_map_cache import get_least_squares_fit
+from m3l.core.function_spaces import IDWFunctionSpace, IDWFunctionSpace2
+
+
+def test_sparse_idw_maps():
+    rng = np.random.default_rng(0)
+    points = rng.random((40, 3))
+    parametric_coordinates = np.vstack((rng.random((25, 3)), points[:5]))     # Includes exact matches
+
+    # Using all neighbors reproduces the dense maps
+    for space_class in (IDWFunctionSpace, IDWFunctionSpace2):
+        dense_space = space_class(name='dense', points=points, order=2, coefficients_shape=(40, 3))
+        sparse_space = space_class(name='sparse', points=points, order=2, coefficients_shape=(40, 3),
+                                   num_neighbors=100)
+        sparse_map = sparse_space.compute_evaluation_map(parametric_coordinates)
+        assert sps.isspmatrix_csr(sparse_map)
+        assert np.allclose(sparse_map.toarray(), dense_space.compute_evaluation_map(parametric_coordinates))
+
+    dense_space = IDWFunctionSpace(name='dense', points=points, order=2, coefficients_shape=(40, 3))
+    sparse_space = IDWFunctionSpace(name='sparse', points=points, order=2, coefficients_shape=(40, 3), num_neighbors=100)
+    assert np.allclose(sparse_space.compute_fitting_map(parametric_coordinates).toarray(),
+                       dense_space.compute_fitting_map(parametric_coordinates))
+
+    # Limiting the neighbors keeps the number of nonzeros linear and the rows normalized
+    space = IDWFunctionSpace2(name='knn', points=points, order=2, coefficients_shape=(40, 3), num_neighbors=4)
+    evaluation_map = space.compute_evaluation_map(parametric_coordinates)
+    assert evaluation_map.nnz <= 4*parametric_coordinates.shape[0]
+    assert np.allclose(evaluation_map.sum(axis=1), 1.)
+    assert np.allclose(evaluation_map[25:].toarray(), np.eye(5, 40))
+
+    space = IDWFunctionSpace2(name='radius', points=points, order=2, coefficients_shape=(40, 3), radius=0.3)
+    evaluation_map = space.compute_evaluation_map(parametric_coordinates)
+    distances = np.linalg.norm(parametric_coordinates[:,None,:] - points[None,:,:], axis=-1)
+    assert np.all(distances[evaluation_map.nonzero()] <= 0.3)
+
+
+def test_group_indexed_parametric_coordinates():
+    rng = np.random.default_rng(0)
+    surface_names = rng.choice(['wing', 'tail', 'fuselage'], size=50)
+    parametric_coordinates = rng.random((50, 2))
+    indexed_parametric_coordinates = [(name, coordinate.reshape((1, 2))) for name, coordinate in
+                                      zip(surface_names, parametric_coordinates)]
+
+    for coordinates in (indexed_parametric_coordinates, (surface_names, parametric_coordinates)):
+        grouped_coordinates = m3l.group_indexed_parametric_coordinates(coordinates)
+        assert list(grouped_coordinates) == list(dict.fromkeys(surface_names))
+        for name, (indices, surface_coordinates) in grouped_coordinates.items():
+            expected_indices = np.flatnonzero(surface_names == name)
+            assert np.array_equal(indices, expected_indices)
+            assert np.array_equal(surface_coordinates, parametric_coordinates[expected_indices])
+
+    # The list and columnar forms evaluate to the same values
+    points = rng.random((20, 2))
+    space = IDWFunctionSpace2(name='space', points=points, order=2, coefficients_shape=(20, 3), num_neighbors=5)
+    indexed_space = m3l.IndexedFunctionSpace(name='indexed_space', spaces={name : space for name in ('wing', 'tail', 'fuselage')})
+    coefficients = {name : rng.random((20, 3)) for name in ('wing', 'tail', 'fuselage')}
+    function = m3l.IndexedFunction(name='function', space=indexed_space)
+    values = function.compute(indexed_parametric_coordinates, coefficients)
+    assert values.shape == (50, 3)
+    assert np.allclose(values, function.compute((surface_names, parametric_coordinates), coefficients))
+    assert np.allclose(values[0], space.compute_evaluation_map(parametric_coordinates[:1]).dot(coefficients[surface_names[0]]))
+
+
+def test_indexed_parametric_coordinates(tmp_path):
+    rng = np.random.default_rng(0)
+    surface_names = rng.choice(['wing', 'tail'], size=30)
+    parametric_coordinates = rng.random((30, 2))
+    coordinates = m3l.IndexedParametricCoordinates.from_surface_names(surface_names, parametric_coordinates)
+    assert coordinates.surface_names == list(dict.fromkeys(surface_names))
+    assert np.array_equal(coordinates.get_surface_name_array(), surface_names)
+    assert coordinates[3][0] == surface_names[3]
+    assert np.array_equal(coordinates[3][1], parametric_coordinates[3:4])
+
+    # Slices are views
+    sliced_coordinates = coordinates[10:20]
+    assert len(sliced_coordinates) == 10
+    assert np.shares_memory(sliced_coordinates.parametric_coordinates, coordinates.parametric_coordinates)
+
+    other_coordinates = m3l.IndexedParametricCoordinates.convert([('fuselage', np.array([[0.5, 0.5]])),
+                                                                  ('tail', np.array([[0.1, 0.2]]))])
+    concatenated_coordinates = m3l.IndexedParametricCoordinates.concatenate([coordinates[:10], other_coordinates])
+    assert np.array_equal(concatenated_coordinates.get_surface_name_array(),
+                          np.concatenate((surface_names[:10], ['fuselage', 'tail'])))
+
+    file_path = tmp_path / 'coordinates.npz'
+    coordinates.save(file_path)
+    loaded_coordinates = m3l.IndexedParametricCoordinates.load(file_path)
+    assert loaded_coordinates.surface_names == coordinates.surface_names
+    assert np.array_equal(loaded_coordinates.surface_ids, coordinates.surface_ids)
+    assert np.array_equal(loaded_coordinates.parametric_coordinates, coordinates.parametric_coordinates)
+
+    grouped_coordinates = coordinates.group_by_surface()
+    expected_grouped_coordinates = m3l.group_indexed_parametric_coordinates(list(coordinates))
+    for name, (indices, surface_coordinates) in expected_grouped_coordinates.items():
+        assert np.array_equal(grouped_coordinates[name][0], indices)
+        assert np.array_equal(grouped_coordinates[name][1], surface_coordinates)
+
+
+def test_indexed_function_space_evaluation_map():
+    rng = np.random.default_rng(0)
+    spaces = {name : IDWFunctionSpace2(name=name, points=rng.random((num_points, 2)), order=2,
+                                       coefficients_shape=(num_points, 3), num_neighbors=3)
+              for name, num_points in (('wing', 10), ('tail', 6), ('fuselage', 8))}
+    indexed_space = m3l.IndexedFunctionSpace(name='indexed_space', spaces=spaces)
+    surface_names = np.array(['tail', 'wing', 'tail', 'wing', 'wing'])
+    parametric_coordinates = rng.random((5, 2))
+
+    evaluation_map = indexed_space.compute_evaluation_map((surface_names, parametric_coordinates))
+    assert sps.isspmatrix_csr(evaluation_map)
+    assert evaluation_map.shape == (5, 16)      # The fuselage has no points, so its coefficients are not included
+    for i, (name, coordinate) in enumerate(zip(surface_names, parametric_coordinates)):
+        offset = 0 if name == 'wing' else 10
+        expected_row = spaces[name].compute_evaluation_map(coordinate.reshape((1, 2))).toarray()
+        assert np.allclose(evaluation_map[i, offset:offset+spaces[name].points.shape[0]].toarray(), expected_row)
+    assert np.allclose(evaluation_map.sum(axis=1), 1.)
+
+
+def test_factorized_inverse_evaluation():
+    rng = np.random.default_rng(0)
+    space = IDWFunctionSpace2(name='space', points=rng.random((30, 2)), order=2, coefficients_shape=(30, 3), num_neighbors=4)
+    indexed_space = m3l.IndexedFunctionSpace(name='indexed_space', spaces={'surface' : space})
+    coefficients = m3l.Variable(name='coefficients', shape=(30, 3), value=np.zeros((30, 3)))
+    function = m3l.IndexedFunction(name='function', space=indexed_space, coefficients={'surface' : coefficients})
+    parametric_coordinates = (np.array(['surface']*80), rng.random((80, 2)))
+    function_values = m3l.Variable(name='function_values', shape=(80, 3), value=rng.random((80, 3)))
+
+    fitted_coefficients = {}
+    for fitting_method in ('factorized', 'lsqr', 'dense'):
+        function.inverse_evaluate(parametric_coordinates, function_values, regularization_coeff=1e-3,
+                                  fitting_method=fitting_method)
+        fitted_coefficients[fitting_method] = coefficients.value.copy()
+    assert np.allclose(fitted_coefficients['factorized'], fitted_coefficients['dense'])
+    assert np.allclose(fitted_coefficients['lsqr'], fitted_coefficients['dense'], atol=1e-6)
+
+    # The factorized fit is equivalent to the dense fitting matrix
+    m3l.set_evaluation_map_cache()
+    try:
+        fit = get_least_squares_fit(space, parametric_coordinates[1], regularization_coeff=1e-3)
+        assert get_least_squares_fit(space, parametric_coordinates[1], regularization_coeff=1e-3) is fit
+    finally:
+        m3l.set_evaluation_map_cache(enabled=False)
+        m3l.clear_evaluation_map_cache()
+    assert np.allclose(fit.get_fitting_matrix()@function_values.value, fitted_coefficients['dense'])
+
+    # The transposed fit (used for the reverse derivatives) is the adjoint of the fit for both solvers
+    value_seeds = rng.random((80, 3))
+    coefficient_seeds = rng.random(fitted_coefficients['dense'].shape)
+    for solver in ('factorized', 'lsqr'):
+        fit = LeastSquaresFit(fit.evaluation_map, regularization_coeff=1e-3, solver=solver)
+        assert np.isclose(np.sum(fit.solve(value_seeds)*coefficient_seeds),
+                          np.sum(value_seeds*fit.solve_transpose(coefficient_seeds)))
+
+
+class BilinearFunctionSpace(m3l.FunctionSpace):
+    '''
+    Function space of bilinear patches (coefficients at the corners (0,0), (1,0), (0,1) and (1,1)).
+    '''
+    def compute_evaluation_map(self, parametric_coordinates:np.ndarray, parametric_derivative_order:tuple=(0,0)):
+        u, v = np.asarray(parametric_coordinates).reshape((-1, 2)).T
+        u_basis = [1 - u, u] if parametric_derivative_order[0] == 0 else [-np.ones_like(u), np.ones_like(u)]
+        v_basis = [1 - v, v] if parametric_derivative_order[1] == 0 else [-np.ones_like(v), np.ones_like(v)]
+        return sps.csr_matrix(np.stack([u_basis[0]*v_basis[0], u_basis[1]*v_basis[0], u_basis[0]*v_basis[1],
+                                        u_basis[1]*v_basis[1]], axis=1))
+
+
+def test_surface_normals():
+    rng = np.random.default_rng(0)
+    space = BilinearFunctionSpace()
+    corners = np.array([[0., 0., 0.], [1., 0., 0.], [0., 1., 0.], [1., 1., 0.5]])
+    coefficients = m3l.Variable(name='coefficients', shape=(4, 3), value=corners)
+    indexed_space = m3l.IndexedFunctionSpace(name='indexed_space', spaces={'surface' : space})
+    function = m3l.IndexedFunction(name='function', space=indexed_space, coefficients={'surface' : coefficients})
+    parametric_coordinates = rng.random((6, 2))
+
+    normals = function.evaluate_normals((np.array(['surface']*6), parametric_coordinates))
+    u, v = parametric_coordinates.T
+    expected_normals = np.cross(np.stack((np.ones_like(u), np.zeros_like(u), 0.5*v), axis=1),
+                                np.stack((np.zeros_like(u), np.ones_like(u), 0.5*u), axis=1))
+    expected_normals /= np.linalg.norm(expected_normals, axis=1, keepdims=True)
+    assert np.allclose(normals.value, expected_normals)
+
+    # Analytic derivatives match central finite differences
+    tangent_map = sps.vstack((space.compute_evaluation_map(parametric_coordinates, (1,0)),
+                              space.compute_evaluation_map(parametric_coordinates, (0,1))), format='csr')
+    perturbed_corners = corners + 0.1*rng.random((4, 3))
+    derivatives = compute_surface_normal_derivatives(tangent_map, perturbed_corners).toarray()
+    step = 1e-6
+    for i in range(12):
+        perturbation = np.zeros((12,))
+        perturbation[i] = step
+        finite_difference = (compute_surface_normals(tangent_map, perturbed_corners + perturbation.reshape((4, 3)))[0]
+                             - compute_surface_normals(tangent_map, perturbed_corners - perturbation.reshape((4, 3)))[0])/(2*step)
+        assert np.allclose(derivatives[:,i], finite_difference.ravel(), atol=1e-7)
+
+
+def test_function_evaluation():
+    rng = np.random.default_rng(0)
+    points = rng.random((25, 2))
+    space = IDWFunctionSpace2(name='space', points=points, order=2, coefficients_shape=(25, 3), num_neighbors=4)
+    coefficients = m3l.Variable(name='coefficients', shape=(25, 3), value=rng.random((25, 3)))
+    function = m3l.Function(name='function', space=space, coefficients=coefficients)
+    mesh = rng.random((4, 5, 2))
+
+    function_values = function.evaluate(mesh)
+    assert function_values.shape == (4, 5, 3)
+    expected_values = space.compute_evaluation_map(mesh.reshape((-1, 2))).dot(coefficients.value)
+    assert np.allclose(function_values.value, expected_values.reshape((4, 5, 3)))
+
+    # Fitting the coefficients to the values over a finer mesh and evaluating them again
+    fitting_mesh = m3l.Variable(name='fitting_mesh', shape=(60, 2), value=rng.random((60, 2)))
+    fitting_values = m3l.Variable(name='fitting_values', shape=(60, 3), value=rng.random((60, 3)))
+    fitted_coefficients = function.inverse_evaluate(fitting_values, fitting_mesh, regularization_coeff=1e-3)
+    assert function.coefficients is fitted_coefficients
+    assert fitted_coefficients.shape == (25, 3)
+    evaluation_map = space.compute_evaluation_map(fitting_mesh.value).toarray()
+    normal_matrix = evaluation_map.T@evaluation_map + 1e-3*np.eye(25)
+    assert np.allclose(fitted_coefficients.value, np.linalg.solve(normal_matrix, evaluation_map.T@fitting_values.value))
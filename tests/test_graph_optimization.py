@@ -0,0 +1,79 @@
+import numpy as np
+import m3l
+
+
+def test_common_subexpression_elimination():
+    '''
+    Test description: creating the same operation twice should result in a single operation after optimization.
+    '''
+    m3l_model = m3l.Model()
+    x = m3l_model.create_input('x', val=np.array([3., 4.]))
+    norm_1 = m3l.norm(x)
+    norm_2 = m3l.norm(x)
+    sum_of_norms = norm_1 + norm_2
+    m3l_model.register_output(sum_of_norms)
+
+    statistics = m3l_model.optimize()
+    assert statistics.num_operations_before == 3
+    assert statistics.num_merged_operations == 1
+    assert statistics.num_operations_after == 2
+
+    add_operation = sum_of_norms.operation
+    assert add_operation.arguments['x1'].operation is add_operation.arguments['x2'].operation
+    assert add_operation.arguments['x1'].name == add_operation.arguments['x2'].name
+    np.testing.assert_almost_equal(norm_2.value, 5.)
+
+
+def test_dead_code_elimination():
+    '''
+    Test description: operations that no longer feed a registered output should be removed.
+    '''
+    m3l_model = m3l.Model()
+    x = m3l_model.create_input('x', val=np.array([3., 4.]))
+    y = m3l.norm(x)
+    z = x*2.
+    m3l_model.register_output(y)
+    m3l_model.register_output(z)
+    for output in m3l_model.outputs.values():
+        m3l_model.gather_operations(output)
+
+    m3l_model.outputs = {name : output for name, output in m3l_model.outputs.items() if output is y}
+    statistics = m3l_model.optimize()
+    assert statistics.num_dead_operations == 1
+    assert statistics.num_removed_operations == 1
+    assert m3l_model.operations == [y.operation]
+
+
+def test_linear_operator_fusion():
+    '''
+    Test description: chains of linear operations should be collapsed into single LinearMap operations with the same
+    values, and the composed map should match compute_mapping_from_upstream_variable.
+    '''
+    import scipy.sparse as sps
+    np.random.seed(0)
+    map_1 = sps.random(4, 4, density=0.7, format='csc')
+    map_2 = sps.random(6, 4, density=0.7, format='csc')
+
+    m3l_model = m3l.Model()
+    x = m3l_model.create_input('x', val=np.random.rand(4))
+    y = m3l_model.create_input('y', val=np.random.rand(4))
+    a = m3l.matvec(map_1, x)
+    b = (a + y)*2. - 1.
+    c = m3l.matvec(map_2, b).reshape((2, 3))
+    norm_of_c = m3l.norm(c)
+    d = 3. - a
+    m3l_model.register_output(norm_of_c)
+    m3l_model.register_output(d)
+    c_value = c.value.copy()
+    d_value = d.value.copy()
+
+    np.testing.assert_almost_equal(m3l.compute_mapping_from_upstream_variable(c, x).toarray(),
+                                   2*map_2.toarray().dot(map_1.toarray()))
+
+    statistics = m3l_model.optimize()
+    assert statistics.num_operations_after == 3
+    assert statistics.num_fused_operations == statistics.num_operations_before - 3
+    assert type(c.operation) is m3l.LinearMap and type(d.operation) is m3l.LinearMap
+    np.testing.assert_almost_equal(c.operation.compute_in_line(), c_value)
+    np.testing.assert_almost_equal(d.operation.compute_in_line(), d_value)
+    assert norm_of_c.operation.arguments['x'].operation is c.operation
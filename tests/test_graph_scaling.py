@@ -0,0 +1,91 @@
+import sys
+
+import numpy as np
+import m3l
+
+
+class CountingArguments(dict):
+    '''
+    Arguments dictionary that counts how many times the arguments of the operations are iterated over.
+    '''
+    num_visits = 0
+
+    def values(self):
+        CountingArguments.num_visits += 1
+        return super().values()
+
+
+class PassThrough(m3l.ExplicitOperation):
+    '''
+    Lightweight operation used to build large synthetic graphs without any in-line evaluation.
+    '''
+    def evaluate(self, x1:m3l.Variable, x2:m3l.Variable) -> m3l.Variable:
+        self.arguments = CountingArguments(x1=x1, x2=x2)
+        return m3l.Variable(shape=(1,), operation=self)
+
+
+def build_synthetic_graph(num_operations:int) -> m3l.Variable:
+    '''
+    Builds a graph where operation i takes the outputs of operations i-1 and i//2 (so variables are shared).
+    '''
+    outputs = [m3l.Variable(name='synthetic_input', shape=(1,), value=np.ones((1,)))]
+    for i in range(num_operations):
+        operation = PassThrough(name=f'synthetic_operation_{i}')
+        outputs.append(operation.evaluate(outputs[-1], outputs[(i+1)//2]))
+    return outputs[-1]
+
+
+def test_gather_operations_topological_order():
+    '''
+    Test description: every operation should be gathered after the operations that compute its arguments.
+    '''
+    output = build_synthetic_graph(100)
+    m3l_model = m3l.Model()
+    m3l_model.gather_operations(output)
+
+    positions = {id(operation) : i for i, operation in enumerate(m3l_model.operations)}
+    for operation in m3l_model.operations:
+        for argument in operation.arguments.values():
+            if argument.operation is not None:
+                assert positions[id(argument.operation)] < positions[id(operation)]
+
+
+def test_gather_operations_scaling():
+    '''
+    Test description: gathering a graph that is much deeper than the recursion limit should visit the arguments of each
+    operation a constant number of times (a quadratic traversal would revisit them for every output).
+    '''
+    for num_operations in [1000, 4*sys.getrecursionlimit()]:
+        output = build_synthetic_graph(num_operations)
+        m3l_model = m3l.Model()
+        CountingArguments.num_visits = 0
+        m3l_model.gather_operations(output)
+
+        assert len(m3l_model.operations) == num_operations
+        assert CountingArguments.num_visits <= 2*num_operations
+
+
+def test_topological_sort_is_deterministic():
+    '''
+    Test description: the sorted operations should not depend on the order in which the outputs are registered.
+    '''
+    x = m3l.Variable(name='x', shape=(1,), value=np.ones((1,)))
+    branches = []
+    for i in range(5):
+        a = PassThrough(name=f'branch_{i}_a').evaluate(x, x)
+        b = PassThrough(name=f'branch_{i}_b').evaluate(a, x)
+        branches.append(b)
+    joined = PassThrough(name='joined').evaluate(branches[3], branches[1])
+
+    sorted_operation_names = []
+    for outputs in [branches + [joined], [joined] + branches[::-1], branches[::2] + [joined] + branches[1::2]]:
+        m3l_model = m3l.Model()
+        for output in outputs:
+            m3l_model.gather_operations(output)
+        sorted_operations = m3l_model.operation_graph.topological_sort()
+        sorted_operation_names.append([operation.name for operation in sorted_operations])
+
+    assert len(sorted_operation_names[0]) == 11
+    assert sorted_operation_names[0] == sorted_operation_names[1] == sorted_operation_names[2]
+    assert sorted_operation_names[0][:2] == ['branch_0_a', 'branch_0_b']
+    assert sorted_operation_names[0][-1] == 'joined'
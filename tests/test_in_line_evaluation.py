@@ -1,5 +1,10 @@
+import re
+
 import m3l
 import numpy as np
+import pytest
+from m3l.core.csdl_operations import RotationExplicit
+from m3l.core.m3l_standard_operations import get_native_slices, get_complement_slices, normalize_indices
 
 
 m3l_model = m3l.Model()
@@ -23,4 +28,216 @@ print(test_multiplication.value)
 print(test_division.value)
 print(test_norm.value)
 print(test_cross.value)
-print(test_vstack.value)
\ No newline at end of file
+print(test_vstack.value)
+
+def test_in_line_kernels():
+    '''
+    Test description: the in-line values of the standard operations should match NumPy.
+    '''
+    m3l_model = m3l.Model()
+    x1_val = np.arange(6.).reshape((2, 3)) + 1.
+    x2_val = np.ones((2, 3))*2.
+    x1 = m3l_model.create_input('x1', val=x1_val)
+    x2 = m3l_model.create_input('x2', val=x2_val)
+
+    np.testing.assert_almost_equal((x1 + x2).value, x1_val + x2_val)
+    np.testing.assert_almost_equal((x1 - x2).value, x1_val - x2_val)
+    np.testing.assert_almost_equal((3.*x1).value, 3.*x1_val)
+    np.testing.assert_almost_equal((x1 / x2).value, x1_val / x2_val)
+    np.testing.assert_almost_equal((x1**2).value, x1_val**2)
+    np.testing.assert_almost_equal(m3l.norm(x1).value, np.linalg.norm(x1_val, axis=-1))
+    np.testing.assert_almost_equal(m3l.cross(x1, x2, axis=1).value, np.cross(x1_val, x2_val, axis=1))
+    np.testing.assert_almost_equal(m3l.vstack(x1, x2).value, np.vstack((x1_val, x2_val)))
+    np.testing.assert_almost_equal(m3l.sum(x1, axes=(0,)).value, np.sum(x1_val, axis=0))
+    np.testing.assert_almost_equal(x1.reshape((-1,)).value, x1_val.reshape((-1,)))
+    np.testing.assert_almost_equal(m3l.expand(m3l.norm(x1), (2, 3), 'i->ij').value,
+                                   np.repeat(np.linalg.norm(x1_val, axis=-1)[:, None], 3, axis=1))
+
+
+def test_in_line_rotation():
+    '''
+    Test description: rotating by 90 degrees about the z-axis should map the x-axis to the y-axis.
+    '''
+    points = np.array([[1., 0., 0.], [0., 1., 0.]])
+    rotated_points = m3l.rotate(points=points, axis_origin=np.zeros((1, 3)), axis_vector=np.array([[0., 0., 1.]]), angles=90.)
+
+    np.testing.assert_almost_equal(rotated_points.value, np.array([[0., 1., 0.], [-1., 0., 0.]]))
+
+    # Several angles are applied at once
+    rotated_points = m3l.rotate(points=points, axis_origin=np.zeros((1, 3)), axis_vector=np.array([[0., 0., 1.]]),
+                                angles=np.array([90., 180.]))
+    assert rotated_points.shape == (2, 2, 3)
+    np.testing.assert_almost_equal(rotated_points.value[1], -points)
+
+
+def test_rotation_derivatives():
+    '''
+    Test description: the analytic derivatives of the batched rotation should match central finite differences.
+    '''
+    rng = np.random.default_rng(0)
+    inputs = {'points' : rng.random((5, 3)), 'axis_origin' : rng.random((1, 3)), 'axis_vector' : rng.random((1, 3)),
+              'angles' : 90*rng.random((4,))}
+    operation = RotationExplicit(points_shape=(5, 3), axis_origin_shape=(1, 3), axis_vector_shape=(1, 3), angles_shape=(4,),
+                                 output_shape=(4, 5, 3), angle_scaling=np.pi/180)
+
+    def rotate(inputs):
+        outputs = {}
+        operation.compute(inputs, outputs)
+        return outputs['rotated_points'].reshape((-1,))
+
+    derivatives = {}
+    operation.compute_derivatives(inputs, derivatives)
+    step = 1e-6
+    for input_name, value in inputs.items():
+        derivative = derivatives['rotated_points', input_name]
+        derivative = derivative.toarray() if hasattr(derivative, 'toarray') else derivative
+        for i in range(value.size):
+            perturbation = np.zeros((value.size,))
+            perturbation[i] = step
+            forward_inputs = dict(inputs, **{input_name : value + perturbation.reshape(value.shape)})
+            backward_inputs = dict(inputs, **{input_name : value - perturbation.reshape(value.shape)})
+            finite_difference = (rotate(forward_inputs) - rotate(backward_inputs))/(2*step)
+            np.testing.assert_allclose(derivative[:,i], finite_difference, atol=1e-7)
+
+
+def test_in_line_backends():
+    '''
+    Test description: the NumPy kernels and the CSDL Simulator fallback should give the same values.
+    '''
+    m3l_model = m3l.Model()
+    x = m3l_model.create_input('x', val=np.array([[1., 2., 3.], [4., 5., 6.]]))
+
+    numpy_norm = m3l.norm(x).value
+    m3l.set_in_line_evaluation_backend('csdl')
+    try:
+        csdl_norm = m3l.norm(x).value
+    finally:
+        m3l.set_in_line_evaluation_backend('numpy')
+
+    np.testing.assert_almost_equal(numpy_norm, csdl_norm)
+
+
+def test_lazy_in_line_evaluation():
+    '''
+    Test description: in lazy mode, values should only be computed when accessed and recomputed when an input changes.
+    '''
+    m3l_model = m3l.Model(lazy_evaluation=True)
+    x1 = m3l_model.create_input('x1', val=np.array([1., 2., 3.]))
+    x2 = m3l_model.create_input('x2', val=np.array([1., 1., 1.]))
+
+    y = 2.*(x1 + x2)
+    assert y.operation.in_line_values is None
+
+    np.testing.assert_almost_equal(y.value, np.array([4., 6., 8.]))
+
+    x1.value = np.array([0., 0., 0.])
+    np.testing.assert_almost_equal(y.value, np.array([2., 2., 2.]))
+
+
+def test_lazy_in_line_evaluation_memoization(monkeypatch):
+    '''
+    Test description: reading a lazily evaluated value again should not revisit the upstream graph, even after new
+    variables were created, until an input changes.
+    '''
+    import m3l.core.in_line_evaluation as in_line_evaluation
+    m3l_model = m3l.Model(lazy_evaluation=True)
+    x = m3l_model.create_input('x', val=np.array([1., 2., 3.]))
+    y = x
+    for _ in range(10):
+        y = 2.*y + x
+    y.value
+
+    num_refreshes = [0]
+    refresh_upstream_operations = in_line_evaluation.refresh_upstream_operations
+    def counting_refresh_upstream_operations(operation):
+        num_refreshes[0] += 1
+        refresh_upstream_operations(operation)
+    monkeypatch.setattr(in_line_evaluation, 'refresh_upstream_operations', counting_refresh_upstream_operations)
+
+    z = y + x   # Creating (and evaluating) new variables does not invalidate the memoized values
+    y.value
+    assert num_refreshes[0] == 0
+
+    x.value = np.array([0., 0., 1.])
+    np.testing.assert_almost_equal(y.value, 2047.*np.array([0., 0., 1.]))
+    assert num_refreshes[0] == 1
+    np.testing.assert_almost_equal(z.value, 2048.*np.array([0., 0., 1.]))
+
+
+def test_lazy_in_line_evaluation_refit():
+    '''
+    Test description: in lazy mode, the consumers of the coefficients of a function should see the new coefficients
+    after the function is fit again.
+    '''
+    from m3l.core.function_spaces import IDWFunctionSpace2
+    rng = np.random.default_rng(0)
+    m3l_model = m3l.Model(lazy_evaluation=True)
+    space = IDWFunctionSpace2(name='space', points=rng.random((10, 2)), order=2, coefficients_shape=(10, 1),
+                              num_neighbors=4)
+    indexed_space = m3l.IndexedFunctionSpace(name='indexed_space', spaces={'w' : space})
+    coefficients = m3l_model.create_input('coefficients', val=rng.random((10, 1)))
+    function = m3l.IndexedFunction(name='function', space=indexed_space, coefficients={'w' : coefficients})
+    parametric_coordinates = (np.array(['w']*30), rng.random((30, 2)))
+    function_values = m3l_model.create_input('function_values', val=100. + rng.random((30, 1)))
+
+    doubled_coefficients = coefficients*2.
+    np.testing.assert_almost_equal(doubled_coefficients.value, 2.*coefficients.value)
+    fitted_coefficients = function.inverse_evaluate(parametric_coordinates, function_values, regularization_coeff=1e-3)
+    np.testing.assert_almost_equal(doubled_coefficients.value, 2.*fitted_coefficients['w'].value)
+    assert np.all(doubled_coefficients.value > 50.)
+
+
+def test_linspace():
+    '''
+    Test description: the unfused and fused linspace should both match the NumPy linear interpolation.
+    '''
+    start = m3l.Variable(name='start', shape=(3, 2), value=np.arange(6.).reshape((3, 2)))
+    stop = m3l.Variable(name='stop', shape=(3, 2), value=np.ones((3, 2)))
+    desired_value = np.array([start.value*(1 - t) + stop.value*t for t in np.linspace(0., 1., 5)])
+
+    np.testing.assert_almost_equal(m3l.linspace(start, stop, 5).value, desired_value)
+    fused_linspace = m3l.linspace(start, stop, 5, fused=True)
+    assert type(fused_linspace.operation) is m3l.LinearMap
+    np.testing.assert_almost_equal(fused_linspace.value, desired_value)
+    np.testing.assert_almost_equal(m3l.linear_combination(start, stop, num_steps=5).value, desired_value)
+
+
+def test_get_and_set_item():
+    '''
+    Test description: indexing and indexed assignment should follow NumPy for slices, integer arrays and boolean masks.
+    '''
+    x = m3l.Variable(name='x', shape=(4, 5), value=np.arange(20.).reshape((4, 5)))
+    for indices in [np.array([0, 2]), (slice(1, 3), 2), (slice(None), np.array([True, False, True, False, True])),
+                    (np.array([3, 1]), slice(None, None, 2))]:
+        x_indexed = x[indices]
+        assert x_indexed.shape == x.value[indices].shape
+        np.testing.assert_almost_equal(x_indexed.value, x.value[indices])
+
+    desired_value = x.value.copy()
+    value = m3l.Variable(name='value', shape=(2,), value=np.array([-1., -2.]))
+    x[1, 1:3] = value
+    desired_value[1, 1:3] = value.value
+    x[np.array([0, 0, 2]), 4] = 7.
+    desired_value[np.array([0, 0, 2]), 4] = 7.
+    np.testing.assert_almost_equal(x.value, desired_value)
+
+    # Values are only accepted if NumPy would broadcast them (not just reshaped if they have the same size)
+    y = m3l.Variable(name='y', shape=(4, 4), value=np.zeros((4, 4)))
+    with pytest.raises(ValueError, match=re.escape('could not broadcast input array from shape (3,2) into shape (2,3)')):
+        y[:2, :3] = m3l.Variable(name='value', shape=(3, 2), value=np.ones((3, 2)))
+    y[1, 1:3] = m3l.Variable(name='value', shape=(1, 2), value=np.array([[1., 2.]]))
+    np.testing.assert_almost_equal(y.value[1], [0., 1., 2., 0.])
+
+    # Slices and integers are assigned natively by copying the boxes of x around the assigned box
+    for shape, indices in [((4, 5), (1, slice(1, 3))), ((4, 5, 3), (slice(0, 2), 3)), ((6,), (slice(None),))]:
+        native_slices = get_native_slices(shape, normalize_indices(indices))
+        is_covered = np.zeros(shape, dtype=int)
+        is_covered[native_slices] += 1
+        for complement_slice in get_complement_slices(shape, native_slices):
+            is_covered[complement_slice] += 1
+        assert np.all(is_covered == 1)
+
+    # The indexed assignment is linear, so it can be fused into a single map
+    unchanged_map, set_map = x.operation.get_maps()
+    np.testing.assert_almost_equal(unchanged_map.dot(x.operation.arguments['x'].value.reshape((-1,))) 
+                                   + set_map.dot(x.operation.constant.reshape((-1,))), desired_value.reshape((-1,)))
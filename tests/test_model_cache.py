@@ -0,0 +1,198 @@
+import numpy as np
+import pytest
+import csdl
+import m3l
+from m3l.core.function_spaces import IDWFunctionSpace2
+from m3l.core.model_cache import compute_definition_hash
+
+
+class CountingOperation(m3l.ExplicitOperation):
+    '''
+    Operation that counts how many times its CSDL model is built.
+    '''
+    num_computes = 0
+
+    def initialize(self, kwargs):
+        super().initialize(kwargs)
+        self.parameters.declare('scaler', types=float, default=1.)
+
+    def compute(self):
+        CountingOperation.num_computes += 1
+        csdl_model = csdl.Model()
+        x = csdl_model.declare_variable(name='x', shape=self.arguments['x'].shape)
+        csdl_model.register_output(self.output_name, x*self.parameters['scaler'])
+        self.csdl_model = csdl_model    # State set by compute() is not part of the definition of the operation
+        return csdl_model
+
+    def evaluate(self, x:m3l.Variable) -> m3l.Variable:
+        self.arguments = {'x' : x}
+        self.output_name = f'{self.name}_output'
+        return m3l.Variable(name=self.output_name, shape=x.shape, operation=self)
+
+
+def build_model(scaler:float=2.) -> m3l.Model:
+    m3l_model = m3l.Model()
+    x = m3l_model.create_input('x', val=np.ones((3,)))
+    y = CountingOperation(name='first', scaler=scaler).evaluate(x)
+    z = CountingOperation(name='second', scaler=3.).evaluate(y)
+    m3l_model.register_output(z)
+    return m3l_model
+
+
+@pytest.fixture(autouse=True)
+def enable_model_cache():
+    '''
+    The model cache is opt-in, so it is turned on for each test and turned off again afterwards.
+    '''
+    m3l.clear_model_cache()
+    m3l.set_model_cache(enabled=True)
+    yield
+    m3l.set_model_cache(enabled=False)
+    m3l.clear_model_cache()
+
+
+def test_model_cache():
+    '''
+    Test description: assembling an unchanged graph should reuse the cached models and changing one operation should
+    only rebuild that operation.
+    '''
+    m3l.clear_model_cache()
+    CountingOperation.num_computes = 0
+
+    csdl_model = build_model().assemble()
+    assert CountingOperation.num_computes == 2
+
+    # A structurally identical graph (e.g., an optimization restart) reuses (a copy of) the whole assembled model
+    csdl_model_again = build_model().assemble()
+    assert CountingOperation.num_computes == 2
+    assert csdl_model_again is not csdl_model
+    assert [name for name, _ in csdl_model_again.submodels] == [name for name, _ in csdl_model.submodels]
+
+    # Changing a parameter of the first operation only rebuilds that operation
+    csdl_model_changed = build_model(scaler=4.).assemble()
+    assert CountingOperation.num_computes == 3
+    assert csdl_model_changed is not csdl_model
+
+    m3l.set_model_cache(enabled=False)
+    build_model().assemble()
+    assert CountingOperation.num_computes == 5
+    m3l.set_model_cache(enabled=True)
+
+
+def test_model_cache_on_disk(tmp_path):
+    '''
+    Test description: portable models should be stored in (and loaded from) the cache directory.
+    '''
+    m3l.clear_model_cache()
+    m3l.set_model_cache(directory=str(tmp_path))
+    try:
+        CountingOperation.num_computes = 0
+        build_model(scaler=5.).assemble()
+        assert CountingOperation.num_computes == 2
+
+        m3l.clear_model_cache()
+        build_model(scaler=5.).assemble()
+        assert CountingOperation.num_computes == 2
+    finally:
+        m3l.set_model_cache(directory=None)
+
+
+def test_incremental_assembly():
+    '''
+    Test description: registering another output on an assembled model should only add the new operation to a copy of
+    the previously assembled CSDL model.
+    '''
+    m3l.clear_model_cache()
+    CountingOperation.num_computes = 0
+
+    m3l_model = build_model(scaler=6.)
+    csdl_model = m3l_model.assemble()
+    assert CountingOperation.num_computes == 2
+
+    y = m3l_model.outputs[list(m3l_model.outputs)[0]]
+    w = CountingOperation(name='third').evaluate(y)
+    m3l_model.register_output(w)
+    csdl_model_extended = m3l_model.assemble(incremental=True)
+    assert CountingOperation.num_computes == 3
+    assert len(m3l_model.assembled_operation_ids) == 3
+
+    # The extension is built on a copy, so the previously returned model is unchanged
+    assert csdl_model_extended is not csdl_model
+    assert len(csdl_model.submodels) == 2
+    assert len(csdl_model_extended.submodels) == 3
+
+    # Changing the value of a previously assembled input requires a new CSDL model (built from the cached submodels)
+    m3l_model.user_inputs[0].value = 2*np.ones((3,))
+    csdl_model_changed = m3l_model.assemble(incremental=True)
+    assert CountingOperation.num_computes == 3
+    assert csdl_model_changed is not csdl_model
+
+
+def build_wide_model(scalers:list) -> m3l.Model:
+    m3l_model = m3l.Model()
+    x = m3l_model.create_input('x', val=np.ones((3,)))
+    for i, scaler in enumerate(scalers):
+        y = CountingOperation(name=f'branch_{i}', scaler=scaler).evaluate(x)
+        m3l_model.register_output(CountingOperation(name=f'output_{i}').evaluate(y))
+    return m3l_model
+
+
+def test_parallel_assembly():
+    '''
+    Test description: computing the CSDL models concurrently should give the same assembled model as the sequential
+    assembly, keep the state that compute() sets on the operations and cache the computed models.
+    '''
+    scalers = [2., 3., 2., 5., 7., 3.]
+    m3l.clear_model_cache()
+    m3l.set_model_cache(enabled=False)
+    try:
+        sequential_model = build_wide_model(scalers).assemble()
+        parallel_m3l_model = build_wide_model(scalers)
+        parallel_model = parallel_m3l_model.assemble(num_workers=4)
+    finally:
+        m3l.set_model_cache(enabled=True)
+    assert [name for name, _ in parallel_model.submodels] == [name for name, _ in sequential_model.submodels]
+    assert parallel_model.connections == sequential_model.connections
+    assert all(isinstance(operation.csdl_model, csdl.Model) for operation in parallel_m3l_model.operations)
+
+    # The models computed by the workers are cached, so assembling the same graph again computes none of them
+    m3l.clear_model_cache()
+    CountingOperation.num_computes = 0
+    build_wide_model(scalers).assemble(num_workers=4)
+    assert CountingOperation.num_computes == 2*len(scalers)
+    build_wide_model(scalers).assemble(num_workers=4)
+    assert CountingOperation.num_computes == 2*len(scalers)
+
+
+def test_definition_hash():
+    '''
+    Test description: the definition hash should not change when the operation is computed and should be the same in
+    every process for operations that only hold plain data.
+    '''
+    x = m3l.Variable(name='x', shape=(3,), value=np.ones((3,)))
+    operation = CountingOperation(name='hashed', scaler=2.)
+    operation.evaluate(x)
+    definition_hash = compute_definition_hash(operation)
+    operation.compute()
+    assert compute_definition_hash(operation).digest == definition_hash.digest
+    assert definition_hash.portable
+
+
+
+def test_variable_parameter_hash():
+    '''
+    Test description: evaluations of the same function over meshes with the same name and shape but different values
+    should have different definition hashes, so they do not share their cached models.
+    '''
+    rng = np.random.default_rng(0)
+    space = IDWFunctionSpace2(name='space', points=rng.random((10, 2)), order=2, coefficients_shape=(10, 3),
+                              num_neighbors=4)
+    coefficients = m3l.Variable(name='coefficients', shape=(10, 3), value=rng.random((10, 3)))
+    function = m3l.Function(name='function', space=space, coefficients=coefficients)
+
+    definition_hashes = []
+    for mesh_value in (rng.random((6, 2)), rng.random((6, 2))):
+        mesh = m3l.Variable(name='mesh', shape=(6, 2), value=mesh_value)
+        function_values = function.evaluate(mesh)
+        definition_hashes.append(compute_definition_hash(function_values.operation).digest)
+    assert definition_hashes[0] != definition_hashes[1]